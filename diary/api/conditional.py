@@ -0,0 +1,73 @@
+import hashlib
+from calendar import timegm
+from datetime import datetime, timezone
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from stories.page_cache import generations, is_shared, purged_at
+from stories.utils import MARKDOWN_CONFIG_VERSION
+
+
+def generation_stamp(*tags):
+    """ A stamp from the page cache generations of the tags (see stories.page_cache), bumped by
+          every save or delete they cover and read without touching the database.  The last
+          purge of them is the Last-Modified, when the cache knows it.  None unless the page
+          cache is shared by every worker, in one of each process only the worker that made
+          the save would see the new generation """
+    if not is_shared():
+        return None
+    current = generations(tags)
+    purged = max(purged_at(generation) for generation in current.values())
+    last_modified = datetime.fromtimestamp(purged, timezone.utc) if purged else None
+    return (last_modified,) + tuple(current[key] for key in sorted(current))
+
+
+class ConditionalGetMixin(object):
+    """ ETag / Last-Modified for retrieve and list, worked out from a version stamp (a cache
+          read or one cheap query) before anything is loaded, rendered or serialized, so a
+          client that already has the current body gets a 304 for the price of the stamp.
+
+          A viewset provides detail_stamp(pk) and list_stamp(queryset), each returning
+          (last_modified, *anything else the body depends on) or None if there is nothing
+          to stamp.  Without a last_modified only the ETag is sent.  The requesting user (can_edit and friends) and the markdown setup (the
+          html) are part of every ETag """
+
+    def detail_stamp(self, pk):
+        raise NotImplementedError
+
+    def list_stamp(self, queryset):
+        raise NotImplementedError
+
+    def make_etag(self, request, stamp):
+        parts = [MARKDOWN_CONFIG_VERSION, request.user.id, request.get_full_path()] + list(stamp)
+        return quote_etag(hashlib.sha1(repr(parts).encode('utf-8')).hexdigest())
+
+    def conditional(self, request, stamp, respond):
+        """ Answer with a 304 if the client has what the stamp describes, otherwise call
+              respond() and label its response """
+        if stamp is None:
+            return respond()
+
+        etag = self.make_etag(request, stamp)
+        last_modified = timegm(stamp[0].utctimetuple()) if stamp[0] else None
+        not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        response = respond()
+        if response.status_code == 200:
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        stamp = self.detail_stamp(kwargs[self.lookup_url_kwarg or self.lookup_field])
+        parent = super(ConditionalGetMixin, self).retrieve
+        return self.conditional(request, stamp, lambda: parent(request, *args, **kwargs))
+
+    def list(self, request, *args, **kwargs):
+        stamp = self.list_stamp(self.filter_queryset(self.get_queryset()))
+        parent = super(ConditionalGetMixin, self).list
+        return self.conditional(request, stamp, lambda: parent(request, *args, **kwargs))
@@ -0,0 +1,41 @@
+from collections import OrderedDict
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from stories.pagination import KeysetPage, RankedPage
+
+
+class StoryKeysetPagination(BasePagination):
+    """ Keyset pagination on (published_at, id) for the story lists, (rank, id) for searches.  No COUNT(*) and no OFFSET,
+          so a deep page is as cheap as the first one.  The next link carries the cursor. """
+    page_size = 20
+    cursor_query_param = 'after'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        # Search results (see stories.search) come annotated with their rank, page on that
+        page_class = RankedPage if 'rank' in queryset.query.annotations else KeysetPage
+        try:
+            self.page = page_class(queryset, request.query_params.get(self.cursor_query_param),
+                                   self.page_size)
+        except ValueError:
+            raise NotFound("Invalid cursor")
+        return self.page.object_list
+
+    def get_next_link(self):
+        if not self.page.has_next:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param, self.page.next_cursor)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data),
+        ])
+        if getattr(self.page, 'truncated', False): # There were more matches than we ranked
+            response['truncated'] = True
+        return Response(response)
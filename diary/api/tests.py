@@ -1,14 +1,18 @@
 import json
+import tempfile
 from datetime import timedelta
-from django.test import TestCase
+from django.conf import settings
+from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils import timezone
 
-from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
 
 from model_mommy import mommy
 
+from stories.models import UpVotes, Flag
 from stories.serializers import Story, StorySerializer
+from stories.votes import vote_buffer
 from api.views import StoryViewSet, AuthorViewSet
 
 # Create your tests here.
@@ -22,9 +26,7 @@ class TestStoryApi(TestCase):
 
     def assertValidResponse(self, request, response, data):
         expected = {
-            "count": len(data),
             "next": None,
-            "previous": None,
             "results": StorySerializer(instance=data, many=True, 
                                        context={"request": request}).data
         }
@@ -72,4 +74,156 @@ class TestStoryApi(TestCase):
         response.render()
         
         self.assertValidResponse(request, response, [self.story2])
-        
\ No newline at end of file
+
+    def test_list_view_pages(self):
+        stories = mommy.make(Story, published_at=timezone.now() - timedelta(days=1), _quantity=25)
+        expected = ([self.story2, self.story1]
+                    + sorted(stories, key=lambda story: story.id, reverse=True))
+
+        factory = APIRequestFactory()
+        view = StoryViewSet.as_view({'get': 'list'})
+        url = reverse("story-list")
+        seen = []
+        while url:
+            request = factory.get(url, format='json')
+            request.user = self.story1.author.user
+            response = view(request)
+            response.render()
+            data = json.loads(response.rendered_content)
+            seen.extend(story['url'] for story in data['results'])
+            url = data['next']
+
+        self.assertEqual(["http://testserver/api/stories/%d/" % story.id for story in expected],
+                         seen)
+
+        request = factory.get(reverse("story-list") + "?after=garbage", format='json')
+        request.user = self.story1.author.user
+        self.assertEqual(404, view(request).status_code)
+
+
+class TestVoteApi(TestCase):
+
+    def setUp(self):
+        self.story = mommy.make(Story, published_at=timezone.now())
+        self.draft = mommy.make(Story)
+        self.user = mommy.make(settings.AUTH_USER_MODEL)
+
+    def tearDown(self):
+        vote_buffer.flush()
+
+    def post(self, action, story, user=None, data=None):
+        client = APIClient()
+        if user:
+            client.force_authenticate(user=user)
+        return client.post(reverse("story-%s" % action, args=(story.id,)), data or {},
+                           format='json')
+
+    def test_upvote(self):
+        response = self.post('upvote', self.story, self.user)
+        self.assertEqual(202, response.status_code)
+        self.assertEqual({'queued': True}, response.data)
+
+        response = self.post('upvote', self.story, self.user)
+        self.assertEqual({'queued': False}, response.data) # Coalesced with the first click
+
+        vote_buffer.flush()
+        self.assertEqual(1, UpVotes.objects.filter(entry=self.story, user=self.user).count())
+        self.story.refresh_from_db()
+        self.assertEqual(1, self.story.upvote_count)
+
+    def test_login_required(self):
+        self.assertIn(self.post('downvote', self.story).status_code, (401, 403))
+        self.assertEqual(0, len(vote_buffer))
+
+    def test_only_published_stories(self):
+        self.assertEqual(404, self.post('upvote', self.draft, self.user).status_code)
+
+    def test_flag(self):
+        self.assertEqual(400, self.post('flag', self.story, self.user).status_code)
+        self.assertEqual(400, self.post('flag', self.story, self.user, {'reason': 42}).status_code)
+
+        response = self.post('flag', self.story, self.user, {'reason': Flag.EXPLICIT})
+        self.assertEqual(202, response.status_code)
+        vote_buffer.flush()
+        self.assertEqual(Flag.EXPLICIT, Flag.objects.get(entry=self.story).reason)
+
+
+    def test_trending(self):
+        self.post('upvote', self.story, self.user)
+        vote_buffer.flush()
+
+        response = APIClient().get(reverse("story-trending"))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([self.story.title], [story['title'] for story in response.data])
+
+
+class TestConditionalGet(TestCase):
+
+    def setUp(self):
+        self.story = mommy.make(Story, published_at=timezone.now())
+        self.url = reverse("story-detail", args=(self.story.id,))
+
+    def test_detail_not_modified(self):
+        client = APIClient()
+        response = client.get(self.url)
+        self.assertEqual(200, response.status_code)
+
+        with self.assertNumQueries(1): # Just the stamp, nothing loaded or rendered
+            response = client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+
+    def test_next_chapter_changes_the_etag(self):
+        client = APIClient()
+        etag = client.get(self.url)['ETag']
+        mommy.make(Story, preceded_by=self.story, author=self.story.author,
+                   published_at=timezone.now())
+
+        response = client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertIsNotNone(response.data['next_chapter'])
+
+    def test_deleting_the_next_chapter_changes_the_etag(self):
+        chapter = mommy.make(Story, preceded_by=self.story, author=self.story.author,
+                             published_at=timezone.now())
+        client = APIClient()
+        etag = client.get(self.url)['ETag']
+        chapter.delete()
+
+        response = client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(200, response.status_code)
+        self.assertIsNone(response.data['next_chapter'])
+
+    def test_list_not_modified_until_a_save(self):
+        client = APIClient()
+        url = reverse("story-list")
+        etag = client.get(url)['ETag']
+        self.assertEqual(304, client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        self.story.title = "Edited"
+        self.story.save()
+        self.assertEqual(200, client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+        etag = client.get(url)['ETag']
+        self.story.delete()
+        self.assertEqual(200, client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+    def test_stamped_from_a_shared_page_cache(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(PAGE_CACHE='pages', CACHES={
+                'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+                'pages': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                          'LOCATION': directory}}):
+            client = APIClient()
+            url = reverse("story-list")
+            etag = client.get(url)['ETag']
+            with self.assertNumQueries(0): # The generation is all it takes
+                self.assertEqual(304, client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+            self.story.save()
+            self.assertEqual(200, client.get(url, HTTP_IF_NONE_MATCH=etag).status_code)
+
+    def test_author_detail(self):
+        client = APIClient()
+        url = reverse("author-detail", args=(self.story.author_id,))
+        response = client.get(url)
+        self.assertEqual(304, client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code)
+        self.assertEqual(304, client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code)
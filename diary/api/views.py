@@ -1,28 +1,150 @@
-from django.shortcuts import render
+from django.db.models import Count, Max, Q
+from django.shortcuts import render, get_object_or_404
 
 # Create your views here.
-from rest_framework import viewsets
-from stories.serializers import Story, StorySerializer
+from rest_framework import status, viewsets
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.response import Response
+from api.conditional import ConditionalGetMixin, generation_stamp
+from api.pagination import StoryKeysetPagination
+from stories.models import UpVotes, DownVotes, Flag
+from stories.inspiration import tree
+from stories.search import search_stories
+from stories.serializers import Story, StorySerializer, InspirationNodeSerializer
+from stories.views import length_range
+from stories.votes import vote_buffer
 from authors.serializers import Author, AuthorSerializer
 
 
-class StoryViewSet(viewsets.ModelViewSet):
+class StoryViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows stories to be viewed or edited.
     """
     serializer_class = StorySerializer
+    pagination_class = StoryKeysetPagination
     queryset = Story.objects.all()
     
     def get_queryset(self):
+        q = self.request.GET.get('q', '').strip()
         author_id = self.request.GET.get('author_id')
-        if author_id:
-            return Story.objects.by_author(author_id).all()
-        return Story.objects.recent().all()
+        if q:
+            # Ranked, the paginator pages these on (rank, id)
+            stories = search_stories(q)
+            if author_id:
+                stories = stories.filter(author=author_id)
+        elif author_id:
+            stories = Story.objects.by_author(author_id)
+        else:
+            stories = Story.objects.recent()
+        return stories.by_length(*length_range(self.request.GET)).with_text()
 
+    @action(detail=True)
+    def series(self, request, pk=None):
+        """ Every chapter of the series this story is part of, first to last """
+        story = self.get_object()
+        chapters = Story.objects.series(story)
+        return Response(self.get_serializer(chapters, many=True).data)
 
-class AuthorViewSet(viewsets.ModelViewSet):
+    @action(detail=True)
+    def inspiration(self, request, pk=None):
+        """ The stories that led to this one (root first) and the tree of stories it inspired,
+              ?depth= levels of it """
+        try:
+            depth = int(request.GET['depth']) if 'depth' in request.GET else None
+        except ValueError:
+            return Response({'depth': ['Must be a number']}, status=status.HTTP_400_BAD_REQUEST)
+        if depth is not None and depth < 1:
+            return Response({'depth': ['Must be at least 1']}, status=status.HTTP_400_BAD_REQUEST)
+
+        ancestors, root = tree(self.get_object(), depth)
+        context = self.get_serializer_context()
+        return Response({
+            'ancestors': InspirationNodeSerializer(ancestors, many=True, context=context).data,
+            'tree': InspirationNodeSerializer(root, context=context).data,
+        })
+
+    def detail_stamp(self, pk):
+        """ A story shows the link to its next chapter, saving or deleting a chapter bumps the
+              story's tag as well.  Without a shared page cache the story and its chapters are
+              read instead, the number of chapters covers one being deleted """
+        try:
+            pk = int(pk)
+        except (TypeError, ValueError):
+            return None
+        stamp = generation_stamp('story:%d' % pk)
+        if stamp:
+            return stamp
+
+        stamp = (Story.objects.filter(Q(pk=pk) | Q(preceded_by=pk))
+                 .aggregate(story=Max('updated_at', filter=Q(pk=pk)),
+                            chapters=Max('updated_at', filter=Q(preceded_by=pk)),
+                            count=Count('pk', filter=Q(preceded_by=pk))))
+        if stamp['story'] is None:
+            return None
+        return (max(stamp['story'], stamp['chapters'] or stamp['story']), stamp['count'])
+
+    def list_stamp(self, queryset):
+        """ Any story being saved (published, hidden, given a next chapter...) or deleted can
+              change a page of the list, they all bump the stories tag.  Without a shared page
+              cache one aggregate over all of them covers every case """
+        stamp = generation_stamp('stories')
+        if stamp:
+            return stamp
+        stamp = Story.objects.aggregate(updated=Max('updated_at'), count=Count('pk'))
+        return (stamp['updated'], stamp['count'])
+
+    @action(detail=False)
+    def trending(self, request):
+        """ The stories getting the most votes lately, one page of them, no cursor """
+        stories = Story.objects.trending().with_text()
+        return Response(self.get_serializer(stories, many=True).data)
+
+    def queue(self, request, pk, model, **fields):
+        """ Votes and flags go through the vote buffer, they are written in batches.  202 since
+              the row is not in the database yet """
+        story = get_object_or_404(Story.objects.published().only('pk'), pk=pk)
+        queued = vote_buffer.add(model, request.user.id, story.pk, **fields)
+        return Response({'queued': queued}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def upvote(self, request, pk=None):
+        return self.queue(request, pk, UpVotes)
+
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def downvote(self, request, pk=None):
+        return self.queue(request, pk, DownVotes)
+
+    @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated])
+    def flag(self, request, pk=None):
+        try:
+            reason = int(request.data.get('reason'))
+        except (TypeError, ValueError):
+            reason = None
+        if reason not in dict(Flag.FLAG_CHOICES):
+            return Response({'reason': ['Choose one of %s' % sorted(dict(Flag.FLAG_CHOICES))]},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return self.queue(request, pk, Flag, reason=reason)
+
+
+class AuthorViewSet(ConditionalGetMixin, viewsets.ModelViewSet):
     """
     API endpoint that allows authors to be viewed or edited.
     """
     queryset = Author.objects.all()
     serializer_class = AuthorSerializer
+
+    def detail_stamp(self, pk):
+        try:
+            updated_at = Author.objects.filter(pk=pk).values_list('updated_at', flat=True).first()
+        except (TypeError, ValueError):
+            return None
+        return (updated_at,) if updated_at else None
+
+    def list_stamp(self, queryset):
+        stamp = generation_stamp('authors')
+        if stamp:
+            return stamp
+        stamp = queryset.aggregate(updated=Max('updated_at'), count=Count('pk'))
+        return (stamp['updated'], stamp['count'])
+
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.10 on 2026-10-17 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authors', '0002_auto_20190124_1553'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='bio_html_cached',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='author',
+            name='bio_html_version',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True),
+        ),
+    ]
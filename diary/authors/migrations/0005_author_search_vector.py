@@ -0,0 +1,54 @@
+# Generated by Django 2.2.10 on 2026-10-18 00:45
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+
+def create_index(apps, schema_editor):
+    """ GIN and tsvector are Postgres only, the other databases just don't get the index """
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE INDEX "author_search_idx" ON "authors_author" USING gin ("search_vector")')
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS "author_search_idx"')
+
+
+def forwards_func(apps, schema_editor):
+    """ Index the authors we already have """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Author = apps.get_model("authors", "Author")
+    Author.objects.using(schema_editor.connection.alias).update(search_vector=(
+        SearchVector('name', weight='A', config='english')
+        + SearchVector('bio_text', weight='B', config='english')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('authors', '0004_author_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='author',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='author',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='author_search_idx'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_index, drop_index),
+            ],
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,11 @@
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from django.utils.safestring import SafeString
 
 from martor.models import MartorField
-from stories.utils import markdownify
+from stories.utils import cached_markdownify, MARKDOWN_CONFIG_VERSION
 
 # Create your models here.
 
@@ -38,11 +40,47 @@ class Author(models.Model):
     #   avatar. Similar to `bio`, this field is not required. It may be blank.
     avatar = models.URLField(blank=True)
 
+    # The html for bio_text and the MARKDOWN_CONFIG_VERSION that rendered it (see Story.rendered_html)
+    bio_html_cached = models.TextField(null=True, blank=True, editable=False)
+    bio_html_version = models.CharField(max_length=40, null=True, blank=True, editable=False)
+
+    # Last time the author was saved, the version stamp for conditional GETs in the api
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # tsvector of the name and bio, kept up to date by stories.search (Postgres only)
+    search_vector = SearchVectorField(null=True, editable=False)
+
     objects = AuthorManager()
 
+    class Meta:
+        indexes = [
+            # search (stories.search), only created on Postgres (see migration 0005)
+            GinIndex(fields=['search_vector'], name='author_search_idx'),
+        ]
+
+    # (bio_text, html) from the database or the last bio_html() call
+    _rendered = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """ If the html stored with the row is current, bio_html() can use it without rendering """
+        instance = super(Author, cls).from_db(db, field_names, values)
+        if ({'bio_text', 'bio_html_cached', 'bio_html_version'}.issubset(field_names)
+                and instance.bio_html_cached is not None
+                and instance.bio_html_version == MARKDOWN_CONFIG_VERSION):
+            instance._rendered = (instance.bio_text, instance.bio_html_cached)
+        return instance
+
+    def save(self, *args, **kwargs):
+        self.bio_html_cached = self.bio_html()
+        self.bio_html_version = MARKDOWN_CONFIG_VERSION
+        super(Author, self).save(*args, **kwargs)
+
     def __str__(self):
         return self.name
 
     def bio_html(self):
         """ Return the markdownified biography of this author """
-        return SafeString(markdownify(self.bio_text))
+        if self._rendered is None or self._rendered[0] != self.bio_text:
+            self._rendered = (self.bio_text, cached_markdownify(self.bio_text))
+        return SafeString(self._rendered[1])
@@ -1,4 +1,5 @@
 from datetime import timedelta
+from unittest import mock
 
 from django.db.utils import IntegrityError
 from django.test import TestCase, Client
@@ -30,6 +31,15 @@ class TestAuthorModel(TestCase):
     def test_bio_html(self):
         self.assertEqual("<p><strong>My</strong> name is Eugene!</p>", self.author_with_avatar.bio_html())
 
+    def test_bio_html_is_stored(self):
+        self.assertEqual("<p><strong>My</strong> name is Eugene!</p>",
+                         self.author_with_avatar.bio_html_cached)
+
+        author = Author.objects.get(pk=self.author_with_avatar.id)
+        with mock.patch('authors.models.cached_markdownify') as render:
+            self.assertEqual("<p><strong>My</strong> name is Eugene!</p>", author.bio_html())
+            self.assertFalse(render.called)
+
     def test__str__(self):
         self.assertEqual("Bob", str(self.author))
 
@@ -7,6 +7,7 @@ from django.urls import reverse
 from authors.models import Author
 from authors.forms import AuthorForm
 from stories.models import Story
+from stories.page_cache import AnonymousPageCacheMixin
 
 # Create your views here.
 
@@ -49,9 +50,12 @@ class Edit(LoginRequiredMixin, CommonAuthorFormMixin, UpdateView):
     pass
 
 
-class Detail(DetailView):
+class Detail(AnonymousPageCacheMixin, DetailView):
     model = Author
 
+    def page_cache_tags(self):
+        return ['author:%d' % self.object.pk, 'author-stories:%d' % self.object.pk]
+
     def get_context_data(self, **kwargs):
         context = super(Detail, self).get_context_data(**kwargs)
         context['stories_by_author'] = Story.objects.by_author(author=self.object)
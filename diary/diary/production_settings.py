@@ -9,6 +9,32 @@ import logging
 from logging import config as logging_config
 
 
+# Compile each template once per worker (diary.warmup does it before the first request) and
+#   keep it, instead of finding and reading it from disk on every render.  APP_DIRS has to go
+#   once the loaders are listed, the app_directories loader takes its place
+TEMPLATES[0]['APP_DIRS'] = False
+TEMPLATES[0]['OPTIONS']['loaders'] = [
+    ('django.template.loaders.cached.Loader', [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]),
+]
+
+# Whole pages for anonymous readers (see stories.page_cache), in files so all the gunicorn
+#   workers see the same pages and purges.  More than one host needs memcached or redis here
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pages': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'site', 'page-cache'),
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+PAGE_CACHE = 'pages'
+
+
 logging_config.dictConfig({
         'version': 1,
         'disable_existing_loggers': False,
@@ -126,8 +126,8 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [
-            'templates',
-            os.path.join('diary', 'templates'),
+            os.path.join(BASE_DIR, 'templates'),
+            os.path.join(BASE_DIR, 'diary', 'templates'),
         ],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -280,11 +280,74 @@ MARTOR_MARKDOWN_EXTENSIONS = [
 # Markdown Extensions Configs  (Keyed by MARTOR_MARKDOWN_EXTENSION name (from above))
 MARTOR_MARKDOWN_EXTENSION_CONFIGS = {}
 
+# Rendered markdown cache.  Name an alias from CACHES to share the rendered html between
+#   processes (memcached, redis...), or leave it None to keep an LRU in each process
+MARKDOWN_CACHE = None
+MARKDOWN_CACHE_MAX_ENTRIES = 1000
+MARKDOWN_CACHE_TIMEOUT = None # Keys change with the text and the config, so never expire
+
+# Number of markdown engines each process keeps, one is needed per thread rendering at once
+MARKDOWN_ENGINE_POOL_SIZE = 4
+# Threads used to render the cache misses of a whole page of stories at once (see render_many)
+MARKDOWN_RENDER_WORKERS = 1
+
+# Where the images of the stories are kept: 'imgur', or 'local' for our own store (see
+#   stories.images) which is a directory under IMAGE_STORAGE_ROOT unless IMAGE_STORAGE names
+#   another Django storage class (built with IMAGE_STORAGE_OPTIONS).  Editor uploads and
+#   fix_image_links both go there.  The variants are easy_thumbnails options
+IMAGE_HOST = 'imgur'
+IMAGE_STORAGE = None
+IMAGE_STORAGE_OPTIONS = {}
+IMAGE_STORAGE_ROOT = os.path.join(BASE_DIR, 'site', 'images')
+IMAGE_VARIANTS = {
+    'small': {'size': (320, 0)},
+    'medium': {'size': (960, 0)},
+}
+IMAGE_MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+IMAGE_CACHE_SECONDS = 365 * 24 * 60 * 60
+
 # Markdown urls
-MARTOR_UPLOAD_URL = '/martor/uploader/' # default
+MARTOR_UPLOAD_URL = '/martor/uploader/' if IMAGE_HOST == 'imgur' else '/stories/images/upload/'
 #MARTOR_SEARCH_USERS_URL = '/martor/search-user/' # default
 #MARTOR_MARKDOWN_BASE_MENTION_URL = 'https://python.web.id/author/' # default (change this)
 
+# Votes and flags are written in batches (see stories.votes), when this many are waiting
+#   or the oldest has waited this many seconds
+VOTE_BUFFER_SIZE = 100
+VOTE_BUFFER_MAX_AGE = 5
+
+# Anonymous readers get whole pages from this cache (see stories.page_cache), entries are
+#   thrown away as soon as something they show is saved, the timeout is only a backstop.
+#   Name an alias from CACHES that every worker shares (memcached, redis, files...), the page
+#   cache stays off with a per process one (locmem) or None.  Set PAGE_CACHE_TIMEOUT to 0 to
+#   turn it off as well
+PAGE_CACHE = None
+PAGE_CACHE_TIMEOUT = 600
+
+# Levels of stories shown below a story on its inspiration tree page (see stories.inspiration)
+INSPIRATION_TREE_DEPTH = 5
+
+# Without Postgres, search uses an in-process index (see stories.search_index) kept in this
+#   file so a new worker maps it instead of building it again.  None keeps it in memory only
+SEARCH_INDEX_PATH = os.path.join(BASE_DIR, 'search.idx')
+# The best this many matches are ranked, the last page of more says it was cut short
+SEARCH_INDEX_MAX_RESULTS = 200
+
+# fix_image_links: stories worked on at once, requests to any one host at once and the
+#   (connect, read) timeouts of each request
+FIX_IMAGE_LINKS_WORKERS = 8
+FIX_IMAGE_LINKS_PER_HOST = 2
+FIX_IMAGE_LINKS_TIMEOUT = (5, 30)
+
+# Reading speed behind Story.read_minutes
+READING_WORDS_PER_MINUTE = 200
+
+# Trending (see stories.ranking), a vote counts half as much after TRENDING_HALF_LIFE hours,
+#   refresh_trending only looks at the votes of the last TRENDING_WINDOW days.  Run refresh_trending
+#   from cron once a day, if it doesn't run for a whole window the next vote rescores everything
+TRENDING_HALF_LIFE = 24
+TRENDING_WINDOW = 7
+
 REST_FRAMEWORK = {
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 20
@@ -8,3 +8,11 @@ def gen_html():
 MOMMY_CUSTOM_FIELDS_GEN = {
     'martor.models.MartorField': gen_html,
 }
+
+# Rolled back test data reuses primary keys, so don't let pages cached by one test leak into
+#   the next, the page cache tests turn it back on (with a shared cache of their own)
+PAGE_CACHE = None
+PAGE_CACHE_TIMEOUT = 0
+
+# Each test builds its own search index (see stories.search_index), in memory
+SEARCH_INDEX_PATH = None
@@ -0,0 +1,45 @@
+"""
+Work a new worker does before it takes traffic
+"""
+import logging
+import os
+
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, engines
+
+logger = logging.getLogger(__name__)
+
+
+def template_names(engine):
+    """ Every template in the engine's DIRS (base.html, the story and author templates and the
+          userena overrides), relative to the directory it was found in """
+    for directory in engine.dirs:
+        for root, dirs, files in os.walk(directory):
+            for filename in sorted(files):
+                if filename.endswith(('.html', '.txt')):
+                    yield os.path.relpath(os.path.join(root, filename), directory)
+
+
+def warm_templates():
+    """ Compile the project's templates so the cached loader has them before the first request.
+          Returns the number of templates compiled """
+    compiled = 0
+    for backend in engines.all():
+        engine = getattr(backend, 'engine', None)
+        if engine is None:
+            continue
+        for name in template_names(engine):
+            try:
+                backend.get_template(name)
+            except (TemplateDoesNotExist, TemplateSyntaxError) as e:
+                logger.warning("Could not precompile %s: %s", name, e)
+            else:
+                compiled += 1
+    return compiled
+
+
+def warm():
+    """ Called from the wsgi module once the application is loaded """
+    from stories.utils import engine_pool
+
+    engine_pool.warm()
+    logger.info("Precompiled %d templates", warm_templates())
@@ -14,3 +14,7 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'diary.settings')
 
 application = get_wsgi_application()
+
+# Build the markdown engines and compile the templates before the worker takes traffic
+from diary.warmup import warm
+warm()
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class EntriesConfig(AppConfig):
     name = 'stories'
+
+    def ready(self):
+        from stories import signals
+        signals.connect()
@@ -0,0 +1,42 @@
+"""
+Walking a whole table (commands and data migrations) without holding it in memory.  Rows come
+in primary key order a chunk at a time, each chunk is its own query on a pk range (keyset, so
+the millionth row costs what the first did, unlike an OFFSET) and only the fields asked for are
+loaded.  Works with the historical models of a migration as well.
+"""
+import time
+
+
+def chunks(queryset, fields=None, size=500):
+    """ Yield lists of up to size rows of the queryset in primary key order, with only fields
+          (and the pk) loaded when they are given """
+    queryset = queryset.order_by('pk')
+    if fields:
+        queryset = queryset.only('pk', *fields)
+
+    last_pk = None
+    while True:
+        chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk[:size])
+        if chunk:
+            yield chunk
+        if len(chunk) < size:
+            return
+        last_pk = chunk[-1].pk
+
+
+def update_in_chunks(queryset, fields, change, read=(), size=500, pause=0):
+    """ Call change(row) on every row of the queryset and write fields back with a bulk_update
+          per chunk.  change can return False to leave a row as it was.  The rows are loaded
+          with fields and read only, pause seconds between chunks goes easy on a busy database.
+          Returns the number of rows written.  Like any bulk_update this skips save() and the
+          signals """
+    updated = 0
+    for chunk in chunks(queryset, fields=tuple(read) + tuple(fields), size=size):
+        changed = [row for row in chunk if change(row) is not False]
+        if changed:
+            queryset.model._default_manager.using(queryset.db).bulk_update(changed, fields)
+            updated += len(changed)
+        if pause:
+            time.sleep(pause)
+    return updated
@@ -16,6 +16,17 @@ class PublishForm(forms.ModelForm):
     class Meta:
         model = Story
         fields = ['teaser', 'author', 'license', 'private']
+
+    def __init__(self, *args, user=None, **kwargs):
+        super(PublishForm, self).__init__(*args, **kwargs)
+        # Left empty the teaser is made from the story
+        self.fields['teaser'].required = False
+
+    def save(self, commit=True):
+        if 'teaser' in self.changed_data and self.cleaned_data['teaser']:
+            # The author wrote this one, keep it when the story changes
+            self.instance.teaser_digest = None
+        return super(PublishForm, self).save(commit)
         
     
 class RelatedByIdField(forms.ModelChoiceField):
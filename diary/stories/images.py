@@ -0,0 +1,113 @@
+"""
+Our own store of the images shown in the stories, the alternative to imgur.  Each image is
+named by the SHA-256 of its bytes, so one used by any number of stories (or uploaded again) is
+stored once, and the smaller variants of IMAGE_VARIANTS are made with easy_thumbnails as it is
+stored.  The names never change meaning, so the images are served to be cached for good.
+"""
+import hashlib
+import mimetypes
+import posixpath
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage, get_storage_class
+from django.urls import reverse
+from django.utils.functional import LazyObject
+from easy_thumbnails import engine
+from PIL import Image
+
+# The formats we keep, by the extension they are served with
+EXTENSIONS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'GIF': 'gif',
+    'WEBP': 'webp',
+}
+
+
+class ImageStorage(LazyObject):
+    """ IMAGE_STORAGE (the dotted path of any Django storage class, with IMAGE_STORAGE_OPTIONS),
+          a FileSystemStorage under IMAGE_STORAGE_ROOT if it isn't set """
+
+    def _setup(self):
+        storage_class = getattr(settings, 'IMAGE_STORAGE', None)
+        if storage_class:
+            self._wrapped = get_storage_class(storage_class)(**getattr(settings, 'IMAGE_STORAGE_OPTIONS', {}))
+        else:
+            self._wrapped = FileSystemStorage(location=settings.IMAGE_STORAGE_ROOT)
+
+
+image_storage = ImageStorage()
+
+
+def storage_name(digest, extension, variant=None):
+    """ 'ab/abcdef....jpg', the variants sit next to the original ('ab/abcdef....small.jpg') """
+    filename = '%s.%s.%s' % (digest, variant, extension) if variant else '%s.%s' % (digest, extension)
+    return posixpath.join(digest[:2], filename)
+
+
+def image_url(digest, extension, variant=None):
+    if variant:
+        return reverse('stories:image-variant', kwargs={'variant': variant, 'digest': digest, 'ext': extension})
+    return reverse('stories:image', kwargs={'digest': digest, 'ext': extension})
+
+
+def content_type(extension):
+    return mimetypes.guess_type('image.' + extension)[0] or 'application/octet-stream'
+
+
+def variants():
+    return getattr(settings, 'IMAGE_VARIANTS', {})
+
+
+def save_file(name, content):
+    """ Store content under name unless it is there already (it is the same bytes) """
+    if image_storage.exists(name):
+        return
+    saved = image_storage.save(name, ContentFile(content))
+    if saved != name: # Someone else stored it at the same moment and the storage renamed ours
+        image_storage.delete(saved)
+
+
+def make_variant(image, digest, extension, variant):
+    """ Scale the image down with easy_thumbnails as IMAGE_VARIANTS[variant] says """
+    thumbnail = engine.process_image(image, variants()[variant])
+    content = engine.save_pil_image(thumbnail, filename='image.' + extension)
+    save_file(storage_name(digest, extension, variant), content.getvalue())
+
+
+def store_image(content):
+    """ Keep an image (its bytes), returns its digest and extension or None if it isn't an image
+          we can read.  Storing one we have already costs an exists() and nothing else """
+    try:
+        image = Image.open(BytesIO(content))
+        extension = EXTENSIONS.get(image.format)
+    except IOError:
+        return None
+    if not extension:
+        return None
+
+    digest = hashlib.sha256(content).hexdigest()
+    name = storage_name(digest, extension)
+    if image_storage.exists(name):
+        return digest, extension
+
+    image = engine.generate_source_image(BytesIO(content), {}) # Turned the way the camera was held
+    for variant in variants():
+        make_variant(image, digest, extension, variant)
+    save_file(name, content) # Last, so a stored original has all its variants
+    return digest, extension
+
+
+def open_image(digest, extension, variant=None):
+    """ The stored file, a variant missing from the store (IMAGE_VARIANTS changed since the image
+          came in) is made from the original first.  None if we don't have the image """
+    name = storage_name(digest, extension, variant)
+    if not image_storage.exists(name):
+        original = storage_name(digest, extension)
+        if not variant or variant not in variants() or not image_storage.exists(original):
+            return None
+        with image_storage.open(original) as f:
+            make_variant(engine.generate_source_image(BytesIO(f.read()), {}), digest, extension, variant)
+    return image_storage.open(name)
@@ -0,0 +1,101 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Count
+
+from stories.models import Story, Inspiration
+
+# Fill the closure table from the inspired_by links in one statement, every story is its own
+#   depth 0 ancestor and each step down the tree adds a row for every ancestor above it.  The
+#   depth guard keeps bad data (a loop) from running forever
+REBUILD_SQL = """
+WITH RECURSIVE paths(ancestor_id, descendant_id, depth) AS (
+    SELECT id, id, 0 FROM stories_story
+  UNION ALL
+    SELECT paths.ancestor_id, story.id, paths.depth + 1
+      FROM stories_story story JOIN paths ON story.inspired_by_id = paths.descendant_id
+     WHERE paths.depth < 1000
+)
+INSERT INTO stories_inspiration (ancestor_id, descendant_id, depth)
+SELECT ancestor_id, descendant_id, depth FROM paths
+"""
+
+
+def rebuild():
+    """ Throw the closure table away and build it again from inspired_by """
+    with transaction.atomic():
+        Inspiration.objects.all().delete()
+        with connection.cursor() as cursor:
+            cursor.execute(REBUILD_SQL)
+    return Inspiration.objects.count()
+
+
+def move(story_id, parent_id):
+    """ Hang the story (and everything below it) under parent_id, None makes it a root """
+    with transaction.atomic():
+        subtree = list(Inspiration.objects.filter(ancestor_id=story_id)
+                       .values_list('descendant_id', 'depth'))
+        below = [descendant_id for descendant_id, depth in subtree]
+        if parent_id in below:
+            return # Inspired by its own descendant, leave the tree as it was
+
+        Inspiration.objects.filter(descendant_id__in=below).exclude(ancestor_id__in=below).delete()
+        if parent_id:
+            above = Inspiration.objects.filter(descendant_id=parent_id).values_list('ancestor_id', 'depth')
+            Inspiration.objects.bulk_create([
+                Inspiration(ancestor_id=ancestor_id, descendant_id=descendant_id,
+                            depth=ancestor_depth + descendant_depth + 1)
+                for ancestor_id, ancestor_depth in above
+                for descendant_id, descendant_depth in subtree
+            ])
+
+
+def story_saved(sender, instance, created, raw=False, **kwargs):
+    """ Keep the closure table in step with inspired_by, only the first save and a change of
+          inspired_by touch it """
+    if raw:
+        return
+
+    if created:
+        Inspiration.objects.create(ancestor_id=instance.pk, descendant_id=instance.pk, depth=0)
+        if instance.inspired_by_id:
+            move(instance.pk, instance.inspired_by_id)
+        return
+
+    parent_id = (Inspiration.objects.filter(descendant_id=instance.pk, depth=1)
+                 .values_list('ancestor_id', flat=True).first())
+    if parent_id != instance.inspired_by_id:
+        move(instance.pk, instance.inspired_by_id)
+
+
+def subtree_sizes(story_ids):
+    """ {story id: number of published stories below it in the tree} """
+    sizes = (Inspiration.objects.filter(ancestor_id__in=story_ids, depth__gt=0,
+                                        descendant__hidden_at=None,
+                                        descendant__published_at__isnull=False)
+             .values('ancestor_id').annotate(size=Count('descendant_id')).order_by())
+    found = {row['ancestor_id']: row['size'] for row in sizes}
+    return {story_id: found.get(story_id, 0) for story_id in story_ids}
+
+
+def tree(story, depth=None):
+    """ The inspiration tree around a story in three queries whatever its size: returns the
+          ancestors (root first) and the story with .children filled in depth levels down.
+          Every node gets a .subtree_size """
+    if depth is None:
+        depth = getattr(settings, 'INSPIRATION_TREE_DEPTH', 5)
+
+    ancestors = list(Story.objects.inspiration_ancestors(story))
+    descendants = list(Story.objects.inspiration_descendants(story, depth))
+
+    children = defaultdict(list)
+    for descendant in descendants: # Nearest first, so parents come before their children
+        children[descendant.inspired_by_id].append(descendant)
+
+    nodes = [story] + descendants
+    sizes = subtree_sizes([node.pk for node in nodes])
+    for node in nodes:
+        node.children = children.get(node.pk, [])
+        node.subtree_size = sizes[node.pk]
+    return ancestors, story
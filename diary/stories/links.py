@@ -0,0 +1,75 @@
+import re
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+from stories.models import StoryImage
+
+# A markdown link [text](url "title"), or an image when it starts with !.  The url stops at the
+#   first space, anything after it is the title
+LINK = re.compile(r'(?P<image>!?)\[(?P<text>[^\]]*)\]\((?P<url>[^\s)]+)(?P<title>[^)]*)\)')
+
+# Hosts whose images we already host (fix_image_links copies everything else there)
+REHOSTED = ('imgur.com',)
+
+Link = namedtuple('Link', ['is_image', 'text', 'url', 'start', 'end']) # start:end is the url
+
+
+def links(text):
+    """ Every link and image of the markdown in order, in one scan of the text """
+    for match in LINK.finditer(text or ''):
+        yield Link(bool(match.group('image')), match.group('text'), match.group('url'),
+                   match.start('url'), match.end('url'))
+
+
+def image_urls(text):
+    """ The url of each image in the text (plain links are left out) """
+    for link in links(text):
+        if link.is_image:
+            yield link.url
+
+
+def is_rehosted(url):
+    """ On imgur, or on this site (our own store, see stories.images) """
+    host = urlsplit(url).netloc.lower()
+    return not host or any(host == rehosted or host.endswith('.' + rehosted) for rehosted in REHOSTED)
+
+
+def external_image_urls(text):
+    """ The distinct images of the text that still live somewhere else, in order """
+    seen = []
+    for url in image_urls(text):
+        if url not in seen and not is_rehosted(url):
+            seen.append(url)
+    return seen
+
+
+def replace_urls(text, replacements, images_only=True):
+    """ Swap the urls found in replacements {old: new} in one pass over the text, only in the
+          images unless images_only is False.  Text outside the links is never touched """
+    pieces = []
+    offset = 0
+    for link in links(text):
+        if link.url in replacements and (link.is_image or not images_only):
+            pieces.append(text[offset:link.start])
+            pieces.append(replacements[link.url])
+            offset = link.end
+    if not pieces:
+        return text
+    pieces.append(text[offset:])
+    return ''.join(pieces)
+
+
+def story_saved(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    """ Keep the story's StoryImage rows in step with its text """
+    if raw or 'text' in instance.get_deferred_fields() or (update_fields and 'text' not in update_fields):
+        return
+
+    urls = external_image_urls(instance.text)
+    if created and not urls:
+        return
+
+    known = set(StoryImage.objects.filter(story=instance).values_list('url', flat=True))
+    if known != set(urls):
+        StoryImage.objects.filter(story=instance).exclude(url__in=urls).delete()
+        StoryImage.objects.bulk_create([StoryImage(story=instance, url=url)
+                                        for url in urls if url not in known])
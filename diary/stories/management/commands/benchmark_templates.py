@@ -0,0 +1,55 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.template.backends.django import DjangoTemplates
+
+from diary.warmup import template_names
+
+LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
+
+class Command(BaseCommand):
+    help = ('Times loading every project template with the plain loaders (found and compiled '
+            'on every use) and with the cached loader production uses (compiled once)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=100,
+                            help='Times each template is loaded per loader setup')
+
+    def build_engine(self, loaders):
+        """ The project's template engine (tag libraries and all) with these loaders """
+        config = dict(settings.TEMPLATES[0], NAME='benchmark', APP_DIRS=False)
+        config.pop('BACKEND')
+        config['OPTIONS'] = dict(config.get('OPTIONS', {}), loaders=loaders, debug=False)
+        return DjangoTemplates(config).engine
+
+    def time_loads(self, engine, name, iterations):
+        """ Milliseconds per get_template(), after one load that fills the cache if there is one """
+        engine.get_template(name)
+        started = time.perf_counter()
+        for _ in range(iterations):
+            engine.get_template(name)
+        return (time.perf_counter() - started) * 1000 / iterations
+
+    def handle(self, *args, **kwargs):
+        iterations = kwargs.get('iterations', 100)
+        plain = self.build_engine(LOADERS)
+        cached = self.build_engine([('django.template.loaders.cached.Loader', LOADERS)])
+
+        self.stdout.write("%-60s %10s %10s" % ("Template", "Uncached", "Cached"))
+        totals = [0.0, 0.0]
+        for name in template_names(plain):
+            try:
+                before = self.time_loads(plain, name, iterations)
+                after = self.time_loads(cached, name, iterations)
+            except Exception as e:
+                self.stderr.write("Skipped %s: %s" % (name, e))
+                continue
+            totals[0] += before
+            totals[1] += after
+            self.stdout.write("%-60s %8.3fms %8.3fms" % (name, before, after))
+        self.stdout.write("%-60s %8.3fms %8.3fms" % ("Total", totals[0], totals[1]))
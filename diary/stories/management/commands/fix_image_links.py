@@ -1,54 +1,149 @@
-import re
 import json
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from io import BytesIO
-import requests
 from os import path
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 
-from stories.models import Story
+from stories.chunked import chunks
+from stories.images import image_url, store_image
+from stories.links import external_image_urls, image_urls, replace_urls
+from stories.models import Story, StoryImage
 from martor.api import imgur_uploader
 
 #import stories.wingdbstub
 
+IMGUR_UPLOAD_URL = 'https://api.imgur.com/3/upload.json'
+
+
 def get_filename(url):
     """ Remove the params (if there are any) and then remove the path to the file from the URL """
     parts = url.split('?')[0].split('/')
     return parts[-1]
 
 
-def image_urls(text):
-    """ Generator to pull each image from the text and yield it one at a time. Uses
-          a regex to pull the image url out of the markdown """
-    image_matcher = re.compile(r"\[[^\]]*\]\((?P<url>[^\)]+)\)")
-    
-    offset = 0
-    match = image_matcher.search(text, offset)
-    while match:
-        url = match.groupdict()['url']
-        yield url
+def pooled_session(size):
+    """ A session keeping up to size connections open to each host, shared by the workers """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def text_digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class Checkpoint(object):
+    """ What earlier runs got done, so a run that died can pick up where it stopped.  The file
+          gets one JSON object per line, written as soon as the work is done:
+            {"url": ..., "link": ...}       an image already copied to imgur
+            {"story": id, "digest": ...}    a story checked, as its text was then
+          Without a path nothing is remembered """
+
+    def __init__(self, path=None):
+        self.links = {}
+        self.stories = {}
+        self._lock = threading.Lock()
+        self._file = None
+        if not path:
+            return
+
+        try:
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError: # Half written when the last run was killed
+                        continue
+                    if 'url' in entry:
+                        self.links[entry['url']] = entry['link']
+                    elif 'story' in entry:
+                        self.stories[entry['story']] = entry['digest']
+        except FileNotFoundError:
+            pass
+        self._file = open(path, 'a')
+
+    def is_done(self, story):
+        return self.stories.get(story.id) == text_digest(story.text)
+
+    def write(self, entry):
+        if self._file:
+            with self._lock:
+                self._file.write(json.dumps(entry) + '\n')
+                self._file.flush()
+
+    def record_link(self, url, link):
+        self.write({'url': url, 'link': link})
+
+    def record_story(self, story):
+        self.write({'story': story.id, 'digest': text_digest(story.text)})
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
 
-        offset = match.end()
-        match = image_matcher.search(text, offset)
-        
 
 class Command(BaseCommand):
-    help = 'Reads the stories and brings all the images from wherever they are into our system (imgur)'
+    help = ('Reads the stories and brings all the images from wherever they are into our system (imgur). '
+            'Stories are worked on by a pool of threads, with a limit on the requests made to any one '
+            'host at once.  Give it a --checkpoint file to be able to stop it and carry on later')
+
+    def __init__(self, *args, **kwargs):
+        super(Command, self).__init__(*args, **kwargs)
+        self.timeout = getattr(settings, 'FIX_IMAGE_LINKS_TIMEOUT', (5, 30))
+        self.per_host = getattr(settings, 'FIX_IMAGE_LINKS_PER_HOST', 2)
+        self.session = pooled_session(getattr(settings, 'FIX_IMAGE_LINKS_WORKERS', 8))
+        self.checkpoint = Checkpoint()
+        self.target = getattr(settings, 'IMAGE_HOST', 'imgur')
+        self.links = {}     # Original URL -> imgur URL, for images used by more than one story
+        self._pending = {}  # Original URL -> Event set once the worker copying it is done
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            default=getattr(settings, 'FIX_IMAGE_LINKS_WORKERS', 8),
+                            help="Stories worked on at once")
+        parser.add_argument('--per-host', type=int, dest='per_host',
+                            default=getattr(settings, 'FIX_IMAGE_LINKS_PER_HOST', 2),
+                            help="Requests made to any one host at once")
+        parser.add_argument('--target', choices=['imgur', 'local'],
+                            default=getattr(settings, 'IMAGE_HOST', 'imgur'),
+                            help="Where the images go, imgur or our own store (stories.images)")
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help="Stories read from the database at a time")
+        parser.add_argument('--checkpoint', default=None,
+                            help="File recording the progress, a run given the same file skips "
+                                 "what is in it")
+
+    def host_slot(self, url):
+        """ The semaphore limiting the requests made to the url's host at once """
+        host = urlsplit(url).netloc.lower()
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
 
     def replace_image(self, url):
-        """ Replace an image url with one from imgur by uploading the image to imgur """
-        response = requests.get(url)
+        """ Replace an image url with one from imgur (or our own store, see --target) by
+              uploading the image there """
+        with self.host_slot(url):
+            response = self.session.get(url, timeout=self.timeout)
         if response.status_code == 200:
-            if response.headers['content-type'].startswith('image'):
-                img = BytesIO(response.content)
-                img.name = get_filename(url) # martor is expecting to get the filename from here
-    
-                response = json.loads(imgur_uploader(img))
-                if int(response["status"]) == 200:
-                    return response['link']
-                else:
-                    self.stderr.write(json.dumps(response))
+            if response.headers.get('content-type', '').startswith('image'):
+                return self.upload(url, response.content)
             else:
                 self.stdout.write("%s is not an image" % url)
         else:
@@ -56,34 +151,118 @@ class Command(BaseCommand):
 
         return None
 
+    def upload(self, url, content):
+        """ Put the image where --target says, returns its new url or None.  Our own store only
+              keeps one copy of a picture found at several addresses """
+        if self.target == 'local':
+            stored = store_image(content)
+            if stored:
+                return image_url(*stored)
+            self.stderr.write("Could not read the image at '%s'" % url)
+            return None
 
-    def handle(self, *args, **kwargs):
-        
-        links_modified = 0
-        stories_modified = 0
-        stories_checked = 0
-        for story in Story.objects.published():
-            
-            stories_checked += 1
-            replacements = {}  # Holds the old URL and the replacement (imgur URL)
+        img = BytesIO(content)
+        img.name = get_filename(url) # martor is expecting to get the filename from here
+
+        with self.host_slot(IMGUR_UPLOAD_URL):
+            response = json.loads(imgur_uploader(img))
+        if int(response["status"]) == 200:
+            return response['link']
+        else:
+            self.stderr.write(json.dumps(response))
+        return None
+
+    def link_for(self, url):
+        """ The imgur copy of an image, each image is only copied once however many stories
+              (or workers) want it """
+        with self._lock:
+            if url in self.links:
+                return self.links[url]
+            pending = self._pending.get(url)
+            if pending is None:
+                self._pending[url] = threading.Event()
+
+        if pending is not None: # Another worker is on it
+            pending.wait()
+            return self.links.get(url)
 
+        try:
+            link = self.replace_image(url)
+            if link:
+                self.links[url] = link
+                self.checkpoint.record_link(url, link)
+            return link
+        finally:
+            with self._lock:
+                self._pending.pop(url).set()
+
+    def story_replacements(self, story_id, text):
+        """ The old URL -> replacement (imgur URL) of every image in a story that could be copied,
+              and whether that was all of them.  Run by the workers """
+        replacements = OrderedDict()
+        urls = external_image_urls(text)
+        for url in urls:
             try:
-                for url in image_urls(story.text):
-                    if ('imgur.com' not in url and url not in replacements):
-                        replacement = self.replace_image(url)
-                        if replacement:
-                            replacements[url] = replacement         
-    
-                if replacements:
-                    for original, replacement in replacements.items():
-                        story.text = story.text.replace(original, replacement)
-                    story.save()
-                    links_modified += len(replacements)
-                    stories_modified += 1
-
-            except requests.ConnectionError as xcpt:
-                self.stderr.write("Failed to process an image in Story(%d): %s" % (story.id, xcpt))
-                
+                replacement = self.link_for(url)
+            except Exception as xcpt: # The network, the image, the store... only this image failed
+                self.stderr.write("Failed to process an image in Story(%d): %s" % (story_id, xcpt))
+                continue
+            if replacement:
+                replacements[url] = replacement
+        return replacements, len(replacements) == len(urls)
+
+    def handle(self, *args, **kwargs):
+        workers = kwargs.get('workers') or getattr(settings, 'FIX_IMAGE_LINKS_WORKERS', 8)
+        self.per_host = kwargs.get('per_host') or self.per_host
+        self.target = kwargs.get('target') or self.target
+        self.checkpoint = Checkpoint(kwargs.get('checkpoint'))
+        self.links.update(self.checkpoint.links)
+        self.session.close()
+        self.session = pooled_session(workers)
+
+        self.links_modified = 0
+        self.stories_modified = 0
+        stories_checked = Story.objects.published().count()
+        stories_skipped = 0
+        # Only the stories with an image hosted elsewhere need reading (see stories.links)
+        stories = (Story.objects.published().with_text()
+                   .filter(pk__in=StoryImage.objects.values('story_id')))
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # The database is only used from this thread, the workers just make the requests
+                running = {}
+                for chunk in chunks(stories, size=kwargs.get('batch_size') or 200):
+                    for story in chunk:
+                        if self.checkpoint.is_done(story):
+                            stories_skipped += 1
+                            continue
+
+                        running[pool.submit(self.story_replacements, story.id, story.text)] = story
+                        if len(running) >= 2 * workers: # Don't queue up the whole table
+                            done, pending = wait(running, return_when=FIRST_COMPLETED)
+                            for future in done:
+                                self.finish(running.pop(future), future)
+
+                for future in list(running):
+                    self.finish(running.pop(future), future)
+        finally:
+            self.checkpoint.close()
+            self.session.close()
+
         self.stdout.write("Checked %d stories" % stories_checked)
-        self.stdout.write("Modified %d stories" % stories_modified)
-        self.stdout.write("Modified %d links" % links_modified)
\ No newline at end of file
+        if stories_skipped:
+            self.stdout.write("Skipped %d stories already checked" % stories_skipped)
+        self.stdout.write("Modified %d stories" % self.stories_modified)
+        self.stdout.write("Modified %d links" % self.links_modified)
+
+    def finish(self, story, future):
+        """ Save the story with the replacements its worker found.  It is only checked off when
+              every image was replaced, so the next run tries the ones that failed again """
+        replacements, complete = future.result()
+        if replacements:
+            story.text = replace_urls(story.text, replacements)
+            story.save()
+            self.links_modified += len(replacements)
+            self.stories_modified += 1
+        if complete:
+            self.checkpoint.record_story(story)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, IntegerField, OuterRef, Subquery, F
+from django.db.models.functions import Coalesce
+
+from stories.models import Story
+from stories.signals import COUNTERS
+
+
+class Command(BaseCommand):
+    help = ('Recounts the UpVotes, DownVotes and Flag rows for every story and fixes the '
+            'counters on Story that have drifted')
+
+    def actual_count(self, model):
+        """ A correlated subquery counting this kind of row for the outer story """
+        counts = (model.objects.filter(entry=OuterRef('pk')).order_by()
+                  .values('entry').annotate(total=Count('pk')).values('total'))
+        return Coalesce(Subquery(counts, output_field=IntegerField()), 0)
+
+    def handle(self, *args, **kwargs):
+        for model, field in COUNTERS.items():
+            actual = self.actual_count(model)
+            drifted = (Story.objects.annotate(actual=actual)
+                       .exclude(**{field: F('actual')}).values_list('pk', flat=True))
+            fixed = Story.objects.filter(pk__in=drifted).update(**{field: actual})
+            self.stdout.write("Fixed %s on %d stories" % (field, fixed))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from stories import ranking
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the trending scores from the recent votes against a new anchor, run it '
+            'from cron (daily is plenty) so the scores stay small and old stories drop out')
+
+    def handle(self, *args, **kwargs):
+        scored = ranking.refresh()
+        self.stdout.write("Scored %d stories" % scored)
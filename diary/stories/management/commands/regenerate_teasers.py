@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from stories import page_cache, search, search_index
+from stories.chunked import update_in_chunks
+from stories.models import Story
+
+
+class Command(BaseCommand):
+    help = ('Makes the teasers of the stories again from their text (rendered, without the markup '
+            'and cut between two words).  Teasers written by the authors are left alone')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--only-stale', action='store_true', dest='only_stale',
+                            help='Only the teasers made from an older version of the text')
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Stories read and written per batch')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches to go easy on the database')
+
+    def handle(self, *args, **options):
+        only_stale = options.get('only_stale', False)
+        now = timezone.now()
+        tags = set()
+        ids = []
+
+        def regenerate(story):
+            if not story.update_teaser(force=not only_stale):
+                return False
+            story.updated_at = now # The cached story cards go with it
+            tags.update(page_cache.story_tags(story))
+            ids.append(story.pk)
+
+        generated = Story.objects.filter(Q(teaser_digest__isnull=False) | Q(teaser=None) | Q(teaser=''))
+        updated = update_in_chunks(generated, ['teaser', 'teaser_digest', 'updated_at'], regenerate,
+                                   read=['text', 'author', 'inspired_by', 'preceded_by'],
+                                   size=options.get('batch_size', 200), pause=options.get('pause', 0))
+        page_cache.purge(*tags)
+        # The teaser is searched, and bulk_update went around the signals that keep the index
+        if ids and search.is_supported():
+            search.index_stories(Story.objects.filter(pk__in=ids))
+        elif ids:
+            # Build it (and its file) here, once, instead of in every worker on its next search
+            search_index.get_index().refresh()
+        self.stdout.write("Regenerated %d teasers" % updated)
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from stories import search, search_index
+
+
+class Command(BaseCommand):
+    help = ('Builds the full text search vectors of every story and author again, after changing '
+            'the language to text search configuration mapping for example.  Without Postgres '
+            'it builds the search index file (SEARCH_INDEX_PATH) instead')
+
+    def handle(self, *args, **kwargs):
+        if not search.is_supported():
+            index = search_index.get_index()
+            indexed = index.build()
+            index.save()
+            self.stdout.write("Indexed %d stories" % indexed)
+            return
+        self.stdout.write("Indexed %d stories" % search.reindex())
@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from authors.models import Author
+from stories.chunked import chunks
+from stories.models import Story
+from stories.utils import render_many, MARKDOWN_CONFIG_VERSION
+
+
+class Command(BaseCommand):
+    help = ('Renders the markdown again for the stories and authors whose stored html was '
+            'produced by an older markdown setup (extensions or martor/pymdownx upgrades)')
+
+    # model, markdown field, html field, version field, fields counted from the html
+    TARGETS = (
+        (Story, 'text', 'rendered_html', 'html_version', ('word_count', 'read_minutes')),
+        (Author, 'bio_text', 'bio_html_cached', 'bio_html_version', ()),
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200,
+                            help='Rows rendered and written per batch')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='Seconds to sleep between batches to go easy on the database')
+
+    def rerender(self, model, source, html, version, lengths, batch_size, pause):
+        """ Walk the stale rows in primary key order, a batch at a time, so each batch is a
+              short write and nothing holds the whole table """
+        stale = model.objects.exclude(**{version: MARKDOWN_CONFIG_VERSION})
+        updated = 0
+        for batch in chunks(stale, fields=(source,), size=batch_size):
+            rendered = render_many(batch, field=source)
+            for obj in batch:
+                setattr(obj, html, rendered[obj.pk])
+                setattr(obj, version, MARKDOWN_CONFIG_VERSION)
+                if lengths:
+                    # A new extension can change what counts as words (a table, a footnote)
+                    obj.update_length(rendered[obj.pk])
+            model.objects.bulk_update(batch, [html, version] + list(lengths))
+
+            updated += len(batch)
+            if pause:
+                time.sleep(pause)
+        return updated
+
+    def handle(self, *args, **options):
+        batch_size = options.get('batch_size', 200)
+        pause = options.get('pause', 0)
+
+        for model, source, html, version, lengths in self.TARGETS:
+            updated = self.rerender(model, source, html, version, lengths, batch_size, pause)
+            self.stdout.write("Rendered %d %s" % (updated, model._meta.verbose_name_plural))
@@ -1,15 +1,39 @@
-from io import StringIO
+import hashlib
+import json
+import logging
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from os import path
+from urllib.parse import parse_qs
 from itertools import zip_longest
+from unittest import mock, skipIf
 
 from requests import ConnectionError
 
+from django.db import connection
 from django.utils import timezone
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.utils.functional import empty
 import responses
 from model_mommy import mommy
+from PIL import Image
 
-from stories.models import Story
+from authors.models import Author
+from diary.warmup import warm_templates
+from stories import search, search_index
+from stories.images import image_storage
+from stories.models import Story, UpVotes, DownVotes, Flag, TrendingScore
+from stories.utils import MARKDOWN_CONFIG_VERSION
 from .commands.fix_image_links import get_filename, image_urls, Command as FixImageLinksCommand
+from .commands.rerender_markdown import Command as RerenderMarkdownCommand
+from .commands.reconcile_counts import Command as ReconcileCountsCommand
+from .commands.refresh_trending import Command as RefreshTrendingCommand
+from .commands.benchmark_templates import Command as BenchmarkTemplatesCommand
+from .commands.reindex_search import Command as ReindexSearchCommand
+from .commands.regenerate_teasers import Command as RegenerateTeasersCommand
 
 
 class TestUtilFunctions(TestCase):
@@ -268,4 +292,302 @@ Then along came the Wolf and said, "Little Pig, little Pig, let me come in."
         story = Story.objects.get(pk=story.id)
         
         expected = text
-        self.assertEqual(expected, story.text)                    
\ No newline at end of file
+        self.assertEqual(expected, story.text)
+
+
+class ImageServer(object):
+    """ A local stand in for the hosts the images come from, it counts the requests and the most
+          it had to answer at once """
+
+    def __init__(self, delay=0.05, body=b'This is the image'):
+        self.body = body
+        self.requests = 0
+        self.busy = 0
+        self.most_busy = 0
+        lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    server.requests += 1
+                    server.busy += 1
+                    server.most_busy = max(server.most_busy, server.busy)
+                time.sleep(delay)
+                with lock:
+                    server.busy -= 1
+                self.send_response(200)
+                if not self.path.endswith('.bin'): # Some hosts don't say
+                    self.send_header('Content-Type', 'text/html' if self.path.endswith('.html') else 'image/png')
+                self.end_headers()
+                self.wfile.write(server.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_port
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def imgur_upload(request):
+    """ responses callback standing in for imgur, the link is made from the file name """
+    name = parse_qs(request.body)['name'][0]
+    data = {"status": 200, "data": {"link": "https://i.imgur.com/%s" % name, "name": name}}
+    return (200, {}, json.dumps(data))
+
+
+class TestFixImageLinksConcurrently(TestCase):
+
+    def setUp(self):
+        self.server = ImageServer()
+        self.addCleanup(self.server.close)
+        self.stdout = StringIO()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.checkpoint = path.join(directory.name, 'checkpoint')
+
+    def run_command(self, **options):
+        self.stdout = StringIO()
+        with responses.RequestsMock(assert_all_requests_are_fired=False) as mocked:
+            mocked.add_passthru(self.server.url)
+            mocked.add_callback(responses.POST, 'https://api.imgur.com/3/upload.json',
+                                callback=imgur_upload)
+            FixImageLinksCommand(stdout=self.stdout, stderr=StringIO(), no_color=True).handle(**options)
+            return len(mocked.calls)
+
+    def story(self, *names):
+        text = ' '.join('![image](%s/%s)' % (self.server.url, name) for name in names)
+        return mommy.make(Story, text=text, published_at=timezone.now())
+
+    def test_limits_requests_per_host(self):
+        stories = [self.story('%d.png' % number) for number in range(6)]
+
+        self.run_command(workers=6, per_host=2)
+        self.stdout.seek(0)
+        self.assertEqual('Checked 6 stories\nModified 6 stories\nModified 6 links\n', self.stdout.read())
+        self.assertEqual(6, self.server.requests)
+        self.assertEqual(2, self.server.most_busy)
+        self.assertEqual('![image](https://i.imgur.com/0.png)', Story.objects.get(pk=stories[0].pk).text)
+
+    def test_copies_each_image_once(self):
+        first, second = self.story('shared.png', 'first.png'), self.story('shared.png')
+
+        self.run_command(workers=2)
+        self.assertEqual(2, self.server.requests)
+        self.assertEqual('![image](https://i.imgur.com/shared.png)', Story.objects.get(pk=second.pk).text)
+
+    def test_carries_on_from_the_checkpoint(self):
+        self.story('first.png', 'page.html')
+        self.assertEqual(1, self.run_command(checkpoint=self.checkpoint))
+
+        # The image is already on imgur, the story isn't done (its page isn't an image) so the
+        #   page is tried again
+        later = self.story('first.png')
+        self.assertEqual(0, self.run_command(checkpoint=self.checkpoint))
+        self.stdout.seek(0)
+        self.assertEqual('%s/page.html is not an image\n'
+                         'Checked 2 stories\nModified 1 stories\nModified 1 links\n' % self.server.url,
+                         self.stdout.read())
+        self.assertEqual(3, self.server.requests)
+        self.assertEqual('![image](https://i.imgur.com/first.png)', Story.objects.get(pk=later.pk).text)
+
+    def test_carries_on_after_any_error(self):
+        def upload(command, url, content):
+            if url.endswith('broken.png'):
+                raise OSError("No space left on device")
+            return 'https://i.imgur.com/%s' % get_filename(url)
+
+        broken, other = self.story('broken.png', 'fine.png'), self.story('other.png')
+        with mock.patch.object(FixImageLinksCommand, 'upload', upload):
+            self.run_command(workers=2, checkpoint=self.checkpoint)
+        self.assertEqual('![image](%s/broken.png) ![image](https://i.imgur.com/fine.png)' % self.server.url,
+                         Story.objects.get(pk=broken.pk).text)
+        self.assertEqual('![image](https://i.imgur.com/other.png)', Story.objects.get(pk=other.pk).text)
+        with open(self.checkpoint) as f:
+            self.assertNotIn('"story": %d,' % broken.pk, f.read())
+
+    def test_no_content_type(self):
+        story = self.story('first.png', 'mystery.bin')
+        self.assertEqual(1, self.run_command())
+        self.assertEqual('![image](https://i.imgur.com/first.png) ![image](%s/mystery.bin)' % self.server.url,
+                         Story.objects.get(pk=story.pk).text)
+
+    def test_local_store(self):
+        content = BytesIO()
+        Image.new('RGB', (40, 20), 'blue').save(content, 'PNG')
+        self.server.body = content.getvalue()
+        digest = hashlib.sha256(self.server.body).hexdigest()
+        stories = self.story('first.png'), self.story('again.png')
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(IMAGE_STORAGE_ROOT=directory):
+            image_storage._wrapped = empty
+            try:
+                self.assertEqual(0, self.run_command(target='local'))
+            finally:
+                image_storage._wrapped = empty
+        # The same picture at two addresses is one image in the store
+        for story in stories:
+            self.assertEqual('![image](/stories/images/%s.png)' % digest, Story.objects.get(pk=story.pk).text)
+
+
+class TestRerenderMarkdownCommand(TestCase):
+
+    def setUp(self):
+        self.stdout = StringIO()
+        self.cmd = RerenderMarkdownCommand(stdout=self.stdout, stderr=StringIO(), no_color=True)
+
+    def test_only_stale_rows_are_rendered(self):
+        current = mommy.make(Story, text="**Current**")
+        stale = [mommy.make(Story, text="**Stale %d**" % n) for n in range(5)]
+        Story.objects.filter(id__in=[s.id for s in stale]).update(rendered_html='old',
+                                                                  html_version='old')
+        Story.objects.filter(id=stale[0].id).update(rendered_html=None, html_version=None)
+        Story.objects.filter(id=stale[1].id).update(word_count=0, read_minutes=0)
+        author = mommy.make(Author, bio_text="_Bio_")
+        Author.objects.filter(id=author.id).update(bio_html_cached=None, bio_html_version=None)
+
+        self.cmd.handle(batch_size=2)
+
+        self.stdout.seek(0)
+        self.assertEqual("Rendered 5 stories\nRendered 1 authors\n", self.stdout.read())
+        for n, story in enumerate(stale):
+            story.refresh_from_db()
+            self.assertEqual("<p><strong>Stale %d</strong></p>" % n, story.rendered_html)
+            self.assertEqual(MARKDOWN_CONFIG_VERSION, story.html_version)
+            self.assertEqual((2, 1), (story.word_count, story.read_minutes))
+
+        current.refresh_from_db()
+        self.assertEqual("<p><strong>Current</strong></p>", current.rendered_html)
+        author.refresh_from_db()
+        self.assertEqual("<p><em>Bio</em></p>", author.bio_html_cached)
+
+
+class TestReconcileCountsCommand(TestCase):
+
+    def test_fixes_drifted_counts(self):
+        story = mommy.make(Story)
+        other = mommy.make(Story)
+        mommy.make(UpVotes, entry=story, _quantity=3)
+        mommy.make(DownVotes, entry=other)
+        mommy.make(Flag, entry=other, reason=Flag.SPAM)
+
+        # Drift: bulk_create skips the signals, and someone scribbled on a counter
+        UpVotes.objects.bulk_create([UpVotes(entry=story)])
+        Story.objects.filter(pk=other.id).update(flag_count=7)
+
+        stdout = StringIO()
+        ReconcileCountsCommand(stdout=stdout, stderr=StringIO(), no_color=True).handle()
+
+        stdout.seek(0)
+        self.assertEqual("Fixed upvote_count on 1 stories\n"
+                         "Fixed downvote_count on 0 stories\n"
+                         "Fixed flag_count on 1 stories\n", stdout.read())
+        story.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((4, 0, 0), (story.upvote_count, story.downvote_count, story.flag_count))
+        self.assertEqual((0, 1, 1), (other.upvote_count, other.downvote_count, other.flag_count))
+
+
+class TestRefreshTrendingCommand(TestCase):
+
+    def test_drops_stories_without_recent_votes(self):
+        recent, stale = mommy.make(Story, published_at=timezone.now(), _quantity=2)
+        mommy.make(UpVotes, entry=recent)
+        vote = mommy.make(UpVotes, entry=stale)
+        UpVotes.objects.filter(pk=vote.pk).update(voted_at=timezone.now() - timezone.timedelta(days=30))
+
+        stdout = StringIO()
+        RefreshTrendingCommand(stdout=stdout, stderr=StringIO(), no_color=True).handle()
+
+        stdout.seek(0)
+        self.assertEqual("Scored 1 stories\n", stdout.read())
+        self.assertEqual([recent.id], list(TrendingScore.objects.values_list('story_id', flat=True)))
+
+
+class TestReindexSearchCommand(TestCase):
+
+    @skipIf(connection.vendor == 'postgresql', "Postgres keeps its own index")
+    def test_builds_the_index_without_postgres(self):
+        mommy.make(Story, published_at=timezone.now(), title="Wolves", _quantity=2)
+        mommy.make(Story, published_at=None, title="Wolves")
+        search_index._index = None
+
+        stdout = StringIO()
+        ReindexSearchCommand(stdout=stdout, stderr=StringIO(), no_color=True).handle()
+
+        stdout.seek(0)
+        self.assertEqual("Indexed 2 stories\n", stdout.read())
+        self.assertEqual(2, len(search_index.get_index().scores('wolves')))
+
+
+class TestRegenerateTeasersCommand(TestCase):
+
+    def setUp(self):
+        self.current = mommy.make(Story, text="**Current**")
+        self.stale = mommy.make(Story, text="**Stale**")
+        self.written = mommy.make(Story, text="**Written**", teaser="By the author")
+        # Changed behind save()'s back
+        Story.objects.filter(pk=self.stale.pk).update(text="**Changed**", teaser="Stale")
+
+    def regenerate(self, **options):
+        stdout = StringIO()
+        RegenerateTeasersCommand(stdout=stdout, stderr=StringIO(), no_color=True).handle(**options)
+        stdout.seek(0)
+        return stdout.read()
+
+    def test_only_stale(self):
+        self.assertEqual("Regenerated 1 teasers\n", self.regenerate(only_stale=True))
+        self.assertEqual("Changed", Story.objects.get(pk=self.stale.pk).teaser)
+        self.assertEqual("Regenerated 0 teasers\n", self.regenerate(only_stale=True))
+
+    def test_everything_but_the_authors_teasers(self):
+        self.assertEqual("Regenerated 2 teasers\n", self.regenerate())
+        self.assertEqual(["Current", "Changed", "By the author"],
+                         [Story.objects.get(pk=story.pk).teaser
+                          for story in (self.current, self.stale, self.written)])
+
+    def test_searched_with_the_new_teaser(self):
+        stale = Story.objects.filter(pk=self.stale.pk)
+        stale.update(text="**Stale**", published_at=timezone.now())
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.addCleanup(setattr, search_index, '_index', None)
+        with override_settings(SEARCH_INDEX_PATH=path.join(directory.name, 'search.idx')):
+            search_index._index = None
+            self.assertEqual([self.stale.pk], [story.pk for story in search.search_stories('stale')])
+            stale.update(text="**Changed**")
+            self.assertEqual([], list(search.search_stories('changed')))
+
+            self.regenerate(only_stale=True)
+            if not search.is_supported():
+                # Caught up by the command, not left to the next search of every worker
+                self.assertEqual(search_index.database_stamp(), search_index.get_index().stamp)
+            self.assertEqual([self.stale.pk], [story.pk for story in search.search_stories('changed')])
+
+
+class TestBenchmarkTemplatesCommand(TestCase):
+
+    def test_every_project_template_compiles(self):
+        with self.assertLogs('diary.warmup', 'WARNING') as logs:
+            compiled = warm_templates()
+            logging.getLogger('diary.warmup').warning("done")
+        self.assertEqual(["WARNING:diary.warmup:done"], logs.output) # Nothing failed to compile
+        self.assertGreater(compiled, 10)
+
+    def test_benchmark(self):
+        stdout = StringIO()
+        stderr = StringIO()
+        BenchmarkTemplatesCommand(stdout=stdout, stderr=stderr, no_color=True).handle(iterations=1)
+
+        stdout.seek(0)
+        lines = stdout.read().splitlines()
+        self.assertTrue(lines[0].startswith("Template"))
+        self.assertTrue(any(line.startswith("base.html ") for line in lines))
+        self.assertTrue(lines[-1].startswith("Total"))
+        self.assertEqual("", stderr.getvalue())
+
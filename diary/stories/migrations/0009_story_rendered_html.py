@@ -0,0 +1,23 @@
+# Generated by Django 2.2.10 on 2026-10-17 23:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0008_auto_20190222_1920'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='rendered_html',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='html_version',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True),
+        ),
+    ]
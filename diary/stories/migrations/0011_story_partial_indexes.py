@@ -0,0 +1,29 @@
+# Generated by Django 2.2.10 on 2026-10-17 23:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0009_story_rendered_html'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(condition=models.Q(('hidden_at', None), ('published_at__isnull', False)), fields=['-published_at', '-id'], name='story_published_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(condition=models.Q(('hidden_at', None), ('published_at__isnull', False)), fields=['author', '-published_at', '-id'], name='story_author_published_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(condition=models.Q(('hidden_at', None), ('published_at__isnull', False)), fields=['inspired_by', '-published_at', '-id'], name='story_inspired_published_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='story',
+            index=models.Index(condition=models.Q(('hidden_at', None), ('published_at__isnull', False)), fields=['preceded_by', 'author', '-published_at', '-id'], name='story_preceded_author_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 2.2.10 on 2026-10-17 23:20
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def forwards_func(apps, schema_editor):
+    """ Count the votes and flags we already have """
+    Story = apps.get_model("stories", "Story")
+    db_alias = schema_editor.connection.alias
+    for model_name, field in (('UpVotes', 'upvote_count'),
+                              ('DownVotes', 'downvote_count'),
+                              ('Flag', 'flag_count')):
+        model = apps.get_model("stories", model_name)
+        counts = (model.objects.using(db_alias).filter(entry=OuterRef('pk')).order_by()
+                  .values('entry').annotate(total=Count('pk')).values('total'))
+        Story.objects.using(db_alias).update(
+            **{field: Coalesce(Subquery(counts, output_field=IntegerField()), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0011_story_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='downvote_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='flag_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='upvote_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
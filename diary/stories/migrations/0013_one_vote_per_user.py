@@ -0,0 +1,56 @@
+# Generated by Django 2.2.10 on 2026-10-17 23:30
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, Min, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+# Model name, Story counter
+VOTE_MODELS = (('UpVotes', 'upvote_count'),
+               ('DownVotes', 'downvote_count'),
+               ('Flag', 'flag_count'))
+
+
+def forwards_func(apps, schema_editor):
+    """ Keep the first of any repeated votes (or flags) so the unique constraints can be added,
+          then recount the stories since the counters included the repeats """
+    Story = apps.get_model("stories", "Story")
+    db_alias = schema_editor.connection.alias
+    for model_name, field in VOTE_MODELS:
+        model = apps.get_model("stories", model_name)
+        repeats = (model.objects.using(db_alias).filter(user__isnull=False)
+                   .values('user', 'entry').annotate(first=Min('pk'), total=Count('pk'))
+                   .filter(total__gt=1))
+        for repeat in repeats:
+            (model.objects.using(db_alias)
+             .filter(user=repeat['user'], entry=repeat['entry'], pk__gt=repeat['first'])
+             .delete())
+
+        counts = (model.objects.using(db_alias).filter(entry=OuterRef('pk')).order_by()
+                  .values('entry').annotate(total=Count('pk')).values('total'))
+        Story.objects.using(db_alias).update(
+            **{field: Coalesce(Subquery(counts, output_field=IntegerField()), 0)})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('stories', '0012_story_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='downvotes',
+            constraint=models.UniqueConstraint(fields=('user', 'entry'), name='downvote_once_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='flag',
+            constraint=models.UniqueConstraint(fields=('user', 'entry'), name='flag_once_per_user'),
+        ),
+        migrations.AddConstraint(
+            model_name='upvotes',
+            constraint=models.UniqueConstraint(fields=('user', 'entry'), name='upvote_once_per_user'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.10 on 2026-10-17 23:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    """ The scores start out empty, run refresh_trending to score the votes we already have """
+
+    dependencies = [
+        ('stories', '0013_one_vote_per_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TrendingScore',
+            fields=[
+                ('story', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='trending', serialize=False, to='stories.Story')),
+                ('score', models.FloatField(default=0)),
+                ('anchored_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='trendingscore',
+            index=models.Index(fields=['-score'], name='trending_score_idx'),
+        ),
+    ]
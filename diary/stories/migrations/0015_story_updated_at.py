@@ -0,0 +1,20 @@
+# Generated by Django 2.2.10 on 2026-10-17 23:55
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0014_trendingscore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
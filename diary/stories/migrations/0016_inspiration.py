@@ -0,0 +1,51 @@
+# Generated by Django 2.2.10 on 2026-10-18 00:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# A frozen copy of stories.inspiration.REBUILD_SQL
+BACKFILL_SQL = """
+WITH RECURSIVE paths(ancestor_id, descendant_id, depth) AS (
+    SELECT id, id, 0 FROM stories_story
+  UNION ALL
+    SELECT paths.ancestor_id, story.id, paths.depth + 1
+      FROM stories_story story JOIN paths ON story.inspired_by_id = paths.descendant_id
+     WHERE paths.depth < 1000
+)
+INSERT INTO stories_inspiration (ancestor_id, descendant_id, depth)
+SELECT ancestor_id, descendant_id, depth FROM paths
+"""
+
+
+def forwards_func(apps, schema_editor):
+    """ Build the closure table for the stories we already have """
+    schema_editor.execute(BACKFILL_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0015_story_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Inspiration',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inspiration_descendants', to='stories.Story')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inspiration_ancestors', to='stories.Story')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='inspiration',
+            index=models.Index(fields=['descendant', 'depth'], name='inspiration_descendant_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='inspiration',
+            constraint=models.UniqueConstraint(fields=('ancestor', 'descendant'), name='inspiration_path_once'),
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
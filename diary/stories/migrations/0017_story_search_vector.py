@@ -0,0 +1,68 @@
+# Generated by Django 2.2.10 on 2026-10-18 00:45
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+
+
+# A frozen copy of stories.search.SEARCH_CONFIGS
+SEARCH_CONFIGS = {
+    'da': 'danish', 'de': 'german', 'en': 'english', 'es': 'spanish', 'fi': 'finnish',
+    'fr': 'french', 'hu': 'hungarian', 'it': 'italian', 'nb': 'norwegian', 'nl': 'dutch',
+    'nn': 'norwegian', 'pt': 'portuguese', 'ro': 'romanian', 'ru': 'russian', 'sv': 'swedish',
+    'tr': 'turkish',
+}
+
+
+def create_index(apps, schema_editor):
+    """ GIN and tsvector are Postgres only, the other databases just don't get the index """
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('CREATE INDEX "story_search_idx" ON "stories_story" USING gin ("search_vector")')
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS "story_search_idx"')
+
+
+def forwards_func(apps, schema_editor):
+    """ Index the stories we already have, one UPDATE per language """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    Story = apps.get_model("stories", "Story")
+    stories = Story.objects.using(schema_editor.connection.alias)
+    for language in stories.order_by().values_list('language', flat=True).distinct():
+        config = SEARCH_CONFIGS.get((language or '').split('-')[0].lower(), 'simple')
+        stories.filter(language=language).update(search_vector=(
+            SearchVector('title', weight='A', config=config)
+            + SearchVector('tagline', weight='B', config=config)
+            + SearchVector('teaser', weight='B', config=config)
+            + SearchVector('text', weight='C', config=config)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0016_inspiration'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='story',
+                    index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='story_search_idx'),
+                ),
+            ],
+            database_operations=[
+                migrations.RunPython(create_index, drop_index),
+            ],
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.10 on 2026-10-18 03:10
+
+import re
+from urllib.parse import urlsplit
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# A frozen copy of stories.links.LINK
+LINK = re.compile(r'(?P<image>!?)\[(?P<text>[^\]]*)\]\((?P<url>[^\s)]+)(?P<title>[^)]*)\)')
+
+
+def external_image_urls(text):
+    urls = []
+    for match in LINK.finditer(text or ''):
+        url = match.group('url')
+        host = urlsplit(url).netloc.lower()
+        if (match.group('image') and url not in urls
+                and host != 'imgur.com' and not host.endswith('.imgur.com')):
+            urls.append(url)
+    return urls
+
+
+def forwards_func(apps, schema_editor):
+    """ Index the images of the stories we already have """
+    Story = apps.get_model("stories", "Story")
+    StoryImage = apps.get_model("stories", "StoryImage")
+    db_alias = schema_editor.connection.alias
+    images = []
+    for story in Story.objects.using(db_alias).only('id', 'text').iterator():
+        images.extend(StoryImage(story_id=story.id, url=url) for url in external_image_urls(story.text))
+    StoryImage.objects.using(db_alias).bulk_create(images, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0017_story_search_vector'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoryImage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.TextField()),
+                ('story', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='external_images', to='stories.Story')),
+            ],
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 2.2.10 on 2026-10-18 04:00
+
+from django.db import migrations, models
+from django.template.defaultfilters import truncatechars
+
+
+def update_in_chunks(queryset, fields, change, read=(), size=500):
+    """ A frozen copy of stories.chunked.update_in_chunks: change(row) every row, a chunk at a
+          time in pk order, and write fields back with a bulk_update per chunk """
+    queryset = queryset.order_by('pk').only('pk', *read, *fields)
+    last_pk = None
+    while True:
+        chunk = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:size])
+        changed = [row for row in chunk if change(row) is not False]
+        if changed:
+            queryset.model._default_manager.using(queryset.db).bulk_update(changed, fields)
+        if len(chunk) < size:
+            return
+        last_pk = chunk[-1].pk
+
+
+def forwards_func(apps, schema_editor):
+    """ The teasers 0007_create_teaser cut out of the markdown were made by us, not the author,
+          mark them as stale ('' matches no text) so regenerate_teasers replaces them.  The
+          rest were written by their authors and stay """
+    Story = apps.get_model("stories", "Story")
+    db_alias = schema_editor.connection.alias
+    max_length = Story._meta.get_field('teaser').max_length
+
+    def mark_generated(story):
+        if story.teaser and story.teaser != truncatechars(story.text, max_length):
+            return False
+        story.teaser_digest = ''
+
+    update_in_chunks(Story.objects.using(db_alias).all(), ['teaser_digest'], mark_generated,
+                     read=['text', 'teaser'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0018_storyimage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='teaser_digest',
+            field=models.CharField(blank=True, editable=False, max_length=40, null=True),
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 2.2.10 on 2026-10-18 04:40
+
+import math
+from html import unescape
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils.html import strip_tags
+
+
+def update_in_chunks(queryset, fields, change, read=(), size=500):
+    """ A frozen copy of stories.chunked.update_in_chunks: change(row) every row, a chunk at a
+          time in pk order, and write fields back with a bulk_update per chunk """
+    queryset = queryset.order_by('pk').only('pk', *read, *fields)
+    last_pk = None
+    while True:
+        chunk = list((queryset if last_pk is None else queryset.filter(pk__gt=last_pk))[:size])
+        changed = [row for row in chunk if change(row) is not False]
+        if changed:
+            queryset.model._default_manager.using(queryset.db).bulk_update(changed, fields)
+        if len(chunk) < size:
+            return
+        last_pk = chunk[-1].pk
+
+
+def forwards_func(apps, schema_editor):
+    """ Count the words of the stories we already have, in the html stored with them (the
+          markdown source when there isn't any) """
+    Story = apps.get_model("stories", "Story")
+    db_alias = schema_editor.connection.alias
+    per_minute = getattr(settings, 'READING_WORDS_PER_MINUTE', 200)
+
+    def count_words(story):
+        text = unescape(strip_tags(story.rendered_html)) if story.rendered_html else story.text
+        story.word_count = len((text or '').split())
+        story.read_minutes = math.ceil(story.word_count / per_minute)
+
+    update_in_chunks(Story.objects.using(db_alias).all(), ['word_count', 'read_minutes'], count_words,
+                     read=['text', 'rendered_html'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('stories', '0019_story_teaser_digest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='story',
+            name='read_minutes',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='story',
+            name='word_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
@@ -1,29 +1,93 @@
+import math
+
 from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
-from django.utils.translation import gettext as _
+from django.db.models import Q
+from django.utils.translation import gettext as _, ngettext
 from django.utils.safestring import SafeString
 
 from martor.models import MartorField
 
-from stories.utils import markdownify
+from stories.utils import (cached_markdownify, make_teaser, render_many, text_digest, word_count,
+                           MARKDOWN_CONFIG_VERSION)
 
 # Create your models here.
 
 class StoryQuerySet(models.QuerySet):
-    pass
+
+    def with_text(self):
+        """ Bring back the markdown bodies recent() leaves in the database, the search vector
+              stays there """
+        return self.defer(None).defer('search_vector')
+
+    def by_length(self, minimum=None, maximum=None):
+        """ The stories taking from minimum to maximum minutes to read, either can be None """
+        stories = self
+        if minimum is not None:
+            stories = stories.filter(read_minutes__gte=minimum)
+        if maximum is not None:
+            stories = stories.filter(read_minutes__lte=maximum)
+        return stories
+
+
+# Visible to readers: published and not hidden.  Every StoryManager query starts with this,
+#   so the indexes on Story only cover these rows (partial indexes)
+PUBLISHED = Q(hidden_at=None, published_at__isnull=False)
+
+# Story fields only ever changed by F() updates (see stories.signals)
+COUNTER_FIELDS = ('upvote_count', 'downvote_count', 'flag_count')
+
+# Story fields the database works out after a save, save() leaves them alone
+DERIVED_FIELDS = COUNTER_FIELDS + ('search_vector',)
+
+# The markdown bodies and the search index, the list pages never show them
+LIST_DEFERRED_FIELDS = ('text', 'about', 'rendered_html', 'search_vector')
+
+# The chapters of a series (see StoryManager.series).  Walk up the preceded_by links by the same
+#   author to the first chapter, then back down collecting every published chapter after it.
+#   The depth guard keeps bad data (a loop) from running forever
+SERIES_SQL = """
+WITH RECURSIVE earlier(id, preceded_by_id, author_id, depth) AS (
+    SELECT id, preceded_by_id, author_id, 0 FROM {table} WHERE id = %s
+  UNION ALL
+    SELECT story.id, story.preceded_by_id, story.author_id, earlier.depth + 1
+      FROM {table} story JOIN earlier ON story.id = earlier.preceded_by_id
+     WHERE story.author_id = earlier.author_id AND earlier.depth < %s
+),
+chapters(id, author_id, depth) AS (
+    SELECT id, author_id, 0 FROM earlier WHERE depth = (SELECT MAX(depth) FROM earlier)
+  UNION ALL
+    SELECT story.id, story.author_id, chapters.depth + 1
+      FROM {table} story JOIN chapters ON story.preceded_by_id = chapters.id
+     WHERE story.author_id = chapters.author_id AND story.published_at IS NOT NULL
+       AND story.hidden_at IS NULL AND chapters.depth < %s
+)
+SELECT id FROM chapters
+"""
+SERIES_MAX_LENGTH = 1000
 
 
 class StoryManager(models.Manager):
     def get_queryset(self):
         return StoryQuerySet(self.model, using=self._db)
 
-    def recent(self):
-        """ Order the list of visible Entries by their published date (descending) """
-        return self.published().order_by('-published_at')
+    def recent(self, limit=None):
+        """ Order the list of visible Entries by their published date (descending).  This is
+              shaped for the list pages, the author comes along in the same query and the markdown
+              bodies are left in the database (.with_text() brings them back).  If a limit is
+              given it is applied in the query """
+        stories = (self.published().select_related('author')
+                   .defer(*LIST_DEFERRED_FIELDS).order_by('-published_at', '-id'))
+        if limit:
+            stories = stories[:limit]
+        return stories
 
     def published(self, **kwargs):
-        """ Return a QS of all published articles that have not been hidden """
-        return self.filter(hidden_at=None, **kwargs).exclude(published_at__isnull=True)
+        """ Return a QS of all published articles that have not been hidden.  Keep this
+              condition identical to PUBLISHED so the database can use the partial indexes """
+        return self.filter(PUBLISHED, **kwargs)
 
     def by_author(self, author):
         """ Return the recent list of stories by this author """
@@ -33,11 +97,87 @@ class StoryManager(models.Manager):
         """ Return a queryset of the list of stories inspired by this story """
         return self.recent().filter(inspired_by=inspiration).exclude(author=inspiration.author)
 
+    def inspiration_descendants(self, story, depth=None):
+        """ Every published story inspired by this one, directly or further down the tree (to
+              depth levels), nearest first.  Each one is annotated with its depth """
+        # One filter() call, so the conditions (and the depth) are about the same closure row
+        path = {'inspiration_ancestors__ancestor': story, 'inspiration_ancestors__depth__gt': 0}
+        if depth is not None:
+            path['inspiration_ancestors__depth__lte'] = depth
+        return (self.recent().filter(**path)
+                .annotate(depth=models.F('inspiration_ancestors__depth'))
+                .order_by('depth', 'published_at', 'id'))
+
+    def inspiration_ancestors(self, story):
+        """ The stories that led to this one, from the root of the tree down to the story that
+              inspired it """
+        return (self.published().select_related('author')
+                .filter(inspiration_descendants__descendant=story,
+                        inspiration_descendants__depth__gt=0)
+                .annotate(depth=models.F('inspiration_descendants__depth')).order_by('-depth'))
+
     def next_chapter(self, story):
         """ A story by the same author that comes after this story is tne
              next_chapter of this story """
         return self.recent().filter(preceded_by=story, author=story.author)
     
+    def series(self, story):
+        """ Every published chapter of the series this story is part of, first to last, in one
+              query.  Where a chapter has more than one next chapter the newest one is followed,
+              like next_chapter.  Each chapter's next_chapter is filled in along the way """
+        story_id = getattr(story, 'pk', story)
+        table = self.model._meta.db_table
+        # extra() because a RawSQL in pk__in gets wrapped in a second set of parentheses,
+        #   which makes it a scalar subquery
+        chapters = list(self.published().select_related('author').extra(
+            where=['%s.id IN (%s)' % (table, SERIES_SQL.format(table=table))],
+            params=[story_id, SERIES_MAX_LENGTH, SERIES_MAX_LENGTH]))
+
+        by_id = {chapter.pk: chapter for chapter in chapters}
+        following = {}
+        for chapter in chapters:
+            if chapter.preceded_by_id in by_id:
+                current = following.get(chapter.preceded_by_id)
+                if current is None or (chapter.published_at, chapter.pk) > (current.published_at, current.pk):
+                    following[chapter.preceded_by_id] = chapter
+
+        # The first chapter is the one whose predecessor isn't in the series
+        first = sorted((chapter for chapter in chapters if chapter.preceded_by_id not in by_id),
+                       key=lambda chapter: (chapter.published_at, chapter.pk))
+        series = []
+        chapter = first[0] if first else None
+        while chapter is not None and len(series) < len(chapters):
+            series.append(chapter)
+            chapter._next_chapter = following.get(chapter.pk)
+            chapter = chapter._next_chapter
+        return series
+
+    def for_reading(self):
+        """ A queryset for showing a single story, the stories it links back to (the chapter it
+              continues and the story that inspired it) come along in the same query """
+        return self.select_related('author', 'preceded_by', 'inspired_by')
+
+    def load_neighbourhood(self, story):
+        """ Find the next chapter of this story and the stories it inspired with one query.
+              The next chapter is memoized on the story (see Story.next_chapter) and the list
+              of inspired stories is returned """
+        related = list(self.recent().filter(Q(preceded_by=story) | Q(inspired_by=story)))
+
+        story._next_chapter = None
+        for candidate in related: # Newest first, like next_chapter(...).first()
+            if candidate.preceded_by_id == story.id and candidate.author_id == story.author_id:
+                story._next_chapter = candidate
+                break
+
+        return [candidate for candidate in related
+                if candidate.inspired_by_id == story.id and candidate.author_id != story.author_id]
+
+    def trending(self, limit=20):
+        """ The published stories with the best time decayed vote score (see stories.ranking),
+              read straight off the score index """
+        return (self.published(trending__score__gt=0).select_related('author', 'trending')
+                .defer(*LIST_DEFERRED_FIELDS).order_by('-trending__score')[:limit])
+
     def drafts(self, user):
         """ Return a queryset of drafts written by this user so they can finish them and get them published. """
         return self.filter(published_at__isnull=True, author__user=user)
@@ -53,6 +193,9 @@ class Story(models.Model):
 
     # The preview used in the list view.  Autogenerated with possible override by the author
     teaser = models.TextField(blank=False, null=True, max_length=140)
+    # Digest of the text an autogenerated teaser was made from, a new text gets a new teaser.
+    #   None when the author wrote the teaser, that one is kept
+    teaser_digest = models.CharField(max_length=40, null=True, blank=True, editable=False)
 
     # The story behind the story.  (No, this should probably NOT be a separate story.)
     about = MartorField(blank=True)
@@ -78,6 +221,30 @@ class Story(models.Model):
                                     on_delete=models.PROTECT, related_name='previous_chapter')
 
 
+    # The html for text (see html()) and the MARKDOWN_CONFIG_VERSION that rendered it.  Filled in
+    #   on save, when the markdown setup changes the rerender_markdown command catches them up
+    rendered_html = models.TextField(null=True, blank=True, editable=False)
+    html_version = models.CharField(max_length=40, null=True, blank=True, editable=False)
+
+    # Words in the rendered text and the minutes they take to read (READING_WORDS_PER_MINUTE),
+    #   worked out on save so the lists can show and filter on them for free
+    word_count = models.PositiveIntegerField(default=0, editable=False)
+    read_minutes = models.PositiveIntegerField(default=0, editable=False)
+
+    # Running totals of the UpVotes, DownVotes and Flag rows for this story, kept up to date by
+    #   stories.signals and repaired by the reconcile_counts command.  save() never writes
+    #   these, only the F() updates do
+    upvote_count = models.PositiveIntegerField(default=0, editable=False)
+    downvote_count = models.PositiveIntegerField(default=0, editable=False)
+    flag_count = models.PositiveIntegerField(default=0, editable=False)
+
+    # Last time the story was saved, the version stamp for conditional GETs in the api
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # Weighted tsvector of the title, tagline, teaser and text in the story's language,
+    #   kept up to date by stories.search (Postgres only)
+    search_vector = SearchVectorField(null=True, editable=False)
+
     # Language the story is written in (so we can tell the browser in the HTTP headers and trigger
     #   translation prompting)
     language = models.CharField(_('language'),
@@ -88,10 +255,69 @@ class Story(models.Model):
     
     class Meta:
         verbose_name_plural = "stories"
-        
+        indexes = [
+            # recent() and the keyset pagination of it (see stories.pagination)
+            models.Index(fields=['-published_at', '-id'], condition=PUBLISHED,
+                         name='story_published_idx'),
+            # by_author()
+            models.Index(fields=['author', '-published_at', '-id'], condition=PUBLISHED,
+                         name='story_author_published_idx'),
+            # inspired()
+            models.Index(fields=['inspired_by', '-published_at', '-id'], condition=PUBLISHED,
+                         name='story_inspired_published_idx'),
+            # next_chapter()
+            models.Index(fields=['preceded_by', 'author', '-published_at', '-id'],
+                         condition=PUBLISHED, name='story_preceded_author_idx'),
+            # search (stories.search), only created on Postgres (see migration 0017)
+            GinIndex(fields=['search_vector'], name='story_search_idx'),
+        ]
+
 
     objects = StoryManager()
 
+    # (text, html) from the last html() call, or filled in bulk by render_all()
+    _rendered = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """ If the html stored with the row is current, html() can use it without rendering """
+        instance = super(Story, cls).from_db(db, field_names, values)
+        if ({'text', 'rendered_html', 'html_version'}.issubset(field_names)
+                and instance.rendered_html is not None
+                and instance.html_version == MARKDOWN_CONFIG_VERSION):
+            instance._rendered = (instance.text, instance.rendered_html)
+        if {'inspired_by_id', 'preceded_by_id'}.issubset(field_names):
+            # The stories this one linked to as loaded, so a save can tell whose pages to purge
+            instance._saved_parents = (instance.inspired_by_id, instance.preceded_by_id)
+        return instance
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        self.rendered_html = self.html()
+        self.html_version = MARKDOWN_CONFIG_VERSION
+        self.update_teaser()
+        self.update_length()
+
+        if not self._state.adding and not force_insert and update_fields is None:
+            # Our copy of the counters (and the search vector) is probably stale, don't write it
+            #   over the real ones
+            update_fields = [field.name for field in self._meta.concrete_fields
+                             if not field.primary_key and field.name not in DERIVED_FIELDS]
+
+        super(Story, self).save(force_insert=force_insert, force_update=force_update,
+                                using=using, update_fields=update_fields)
+        self._saved_parents = (self.inspired_by_id, self.preceded_by_id)
+
+    def update_teaser(self, force=False):
+        """ Make the teaser from the text if there isn't one, or the one we made is for an older
+              text (or force says so).  A teaser the author wrote is left alone.  Returns whether
+              the teaser changed """
+        digest = text_digest(self.text)
+        if self.teaser and (self.teaser_digest is None or (self.teaser_digest == digest and not force)):
+            return False
+        self.teaser = make_teaser(self.html(), self._meta.get_field('teaser').max_length)
+        self.teaser_digest = digest
+        return True
+
     def __str__(self):
         return self.full_title()
     
@@ -99,23 +325,56 @@ class Story(models.Model):
         """ """
         return '%s: %s' % (self.title, self.tagline)
 
+    def card_version(self):
+        """ Changes with anything shown on the story's card (see stories/partials/story_card.html),
+              the story itself or its author's name """
+        return '%s-%s' % (self.updated_at.timestamp(), self.author.updated_at.timestamp())
+
+    def update_length(self, html=None):
+        """ From html when it's already rendered (see rerender_markdown) """
+        self.word_count = word_count(html if html is not None else self.html())
+        self.read_minutes = math.ceil(self.word_count / getattr(settings, 'READING_WORDS_PER_MINUTE', 200))
+
     def read_time(self):
-        return _("Short read")
+        if self.read_minutes <= 1:
+            return _("Short read")
+        return ngettext("%d minute read", "%d minutes read", self.read_minutes) % self.read_minutes
 
     def html(self):
         """ Return the html version of the markdown.  Wraps it as a SafeString so it will
-              display without being escaped.  This should probably be done and cached somewhere
-              and let this method do a lookup for the cached version.  An alternative would be to
-              double the storage in the DB but that could mean having to update the whole  DB if we
-              fix something about martor.  Storing this in a memcached instance would probably
-              be better """
-        # TODO: Store the results in memcached for speed
-        return SafeString(markdownify(self.text))
+              display without being escaped.  The html saved with the story is used when it is
+              current, otherwise it comes from the markdown cache (see stories.utils) keyed on
+              the text and the markdown configuration, so we only pay for the markdown parse
+              when the story or the extensions change """
+        if self._rendered is None or self._rendered[0] != self.text:
+            self._rendered = (self.text, cached_markdownify(self.text))
+        return SafeString(self._rendered[1])
+
+    @classmethod
+    def render_all(cls, stories):
+        """ Render the html for a list of stories in one batch (see render_many) so the list
+              views and serializers don't render them one at a time.  Returns the stories as a
+              list with html() ready to go """
+        stories = list(stories)
+        unrendered = [story for story in stories
+                      if story._rendered is None or story._rendered[0] != story.text]
+        rendered = render_many(unrendered)
+        for story in unrendered:
+            story._rendered = (story.text, rendered[story.pk])
+        return stories
 
     def next_chapter(self):
         """ A story by the same author that comes after this story is tne
-             next_chapter of this story """
-        return Story.objects.next_chapter(story=self).first()
+             next_chapter of this story.  Looked up once per instance (the templates ask
+             for it more than once) or filled in by StoryManager.load_neighbourhood """
+        if '_next_chapter' not in self.__dict__:
+            self._next_chapter = Story.objects.next_chapter(story=self).first()
+        return self._next_chapter
+
+    def refresh_from_db(self, using=None, fields=None):
+        if fields is None: # Not just loading a deferred field
+            self.__dict__.pop('_next_chapter', None)
+        super(Story, self).refresh_from_db(using=using, fields=fields)
 
 
 
@@ -135,6 +394,11 @@ class Flag(models.Model):
     flagged_at = models.DateTimeField(auto_now_add=True, null=False)
     reason = models.IntegerField(choices=FLAG_CHOICES, default=0)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'entry'], name='flag_once_per_user'),
+        ]
+
 
 class UpVotes(models.Model):
     """ When an entry is UpVoted, it gets one of these records"""
@@ -142,9 +406,63 @@ class UpVotes(models.Model):
     entry = models.ForeignKey(Story, null=False, db_index=True, on_delete=models.PROTECT)
     voted_at = models.DateTimeField(auto_now_add=True, null=False)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'entry'], name='upvote_once_per_user'),
+        ]
+
 
 class DownVotes(models.Model):
     """ When an entry is DownVoted, it gets one of these records"""
     user = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, on_delete=models.PROTECT)
     entry = models.ForeignKey(Story, null=False, db_index=True, on_delete=models.PROTECT)
     voted_at = models.DateTimeField(auto_now_add=True, null=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'entry'], name='downvote_once_per_user'),
+        ]
+
+
+class TrendingScore(models.Model):
+    """ The materialized trending score of a story (see stories.ranking).  Every vote adds
+          +/- 2 ** ((voted_at - anchored_at) / half life), so newer votes count for more and the
+          order of the scores is the order of the decayed scores without ever rescoring the rows
+          that didn't get a vote.  refresh_trending moves the anchor up and drops stale rows. """
+    story = models.OneToOneField(Story, primary_key=True, related_name='trending',
+                                 on_delete=models.CASCADE)
+    score = models.FloatField(default=0)
+    anchored_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-score'], name='trending_score_idx'),
+        ]
+
+
+class Inspiration(models.Model):
+    """ Closure table of the inspired_by tree (see stories.inspiration): a row for every story
+          and each story above it, depth steps apart, plus a depth 0 row for the story itself.
+          All the descendants or ancestors of a story are then one indexed lookup """
+    ancestor = models.ForeignKey(Story, related_name='inspiration_descendants',
+                                 on_delete=models.CASCADE)
+    descendant = models.ForeignKey(Story, related_name='inspiration_ancestors',
+                                   on_delete=models.CASCADE)
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='inspiration_path_once'),
+        ]
+        indexes = [
+            models.Index(fields=['descendant', 'depth'], name='inspiration_descendant_idx'),
+        ]
+
+
+
+class StoryImage(models.Model):
+    """ An image a story shows from somewhere other than imgur (see stories.links), the rows are
+          replaced whenever the text is saved so a rehosting job only has to read the stories
+          that have one """
+    story = models.ForeignKey(Story, related_name='external_images', on_delete=models.CASCADE)
+    url = models.TextField()
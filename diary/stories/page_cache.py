@@ -0,0 +1,152 @@
+import hashlib
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+# Pages are tagged with what they show, a save bumps the generation of the tags it touches
+#   (a generation is the time of the purge and a random part):
+#   story:<pk>          the story's own page
+#   author:<pk>         anything showing the author's name
+#   author-stories:<pk> the lists of the author's stories
+#   recent              the recent list
+#   stories, authors    any story, any author (the API lists, see api.conditional)
+
+
+def page_cache():
+    return caches[settings.PAGE_CACHE]
+
+
+def is_shared():
+    """ PAGE_CACHE names a cache every worker sees.  A purge only reaches the cache of the
+          process making the save, so with a per process one (locmem, what 'default' is when
+          CACHES isn't set) the other workers would go on serving the old pages """
+    alias = getattr(settings, 'PAGE_CACHE', None)
+    return bool(alias) and not isinstance(caches[alias], (LocMemCache, DummyCache))
+
+
+def generation_key(tag):
+    return 'page-gen:%s' % tag
+
+
+def page_key(request):
+    digest = hashlib.sha1(request.get_full_path().encode('utf-8')).hexdigest()
+    return 'page:%s' % digest
+
+
+def new_generation(when):
+    return '%.6f:%s' % (when, uuid.uuid4().hex)
+
+
+def purged_at(generation):
+    when, _, rest = generation.partition(':')
+    return float(when) if rest else 0.0 # One stored before generations had a time
+
+
+def purge(*tags):
+    """ Orphan every cached page carrying one of these tags """
+    tags = [tag for tag in tags if tag]
+    if not tags or not is_shared():
+        return
+    generation = new_generation(time.time())
+    page_cache().set_many({generation_key(tag): generation for tag in tags}, None)
+
+
+def generations(tags):
+    """ The current generation of each tag, starting the ones the cache doesn't have (as never
+          purged) """
+    cache = page_cache()
+    keys = [generation_key(tag) for tag in tags]
+    current = cache.get_many(keys)
+    for key in keys:
+        if key not in current:
+            cache.add(key, new_generation(0), None)
+            current[key] = cache.get(key)
+    return current
+
+
+def story_tags(story):
+    """ The tags whose pages show this story, or a link to it.  That includes the stories it
+          followed or was inspired by before this save, their pages still list it """
+    tags = ['story:%d' % story.pk, 'author-stories:%d' % story.author_id, 'recent', 'stories']
+    parents = {story.inspired_by_id, story.preceded_by_id}
+    parents.update(getattr(story, '_saved_parents', ()))
+    for pk in sorted(pk for pk in parents if pk):
+        tags.append('story:%d' % pk)
+    return tags
+
+
+def story_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        purge(*story_tags(instance))
+
+
+def author_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        purge('author:%d' % instance.pk, 'recent', 'authors')
+
+
+def is_cacheable(request):
+    return (request.method in ('GET', 'HEAD')
+            and not request.user.is_authenticated
+            and getattr(settings, 'PAGE_CACHE_TIMEOUT', 600)
+            and is_shared())
+
+
+class AnonymousPageCacheMixin(object):
+    """ Serve anonymous readers from a cache of the whole rendered page.  Each view says which
+          tags its page shows (page_cache_tags), the page is stored with the generation of each
+          of those tags and is only served while they are all unchanged, so a save anywhere
+          else leaves it alone.  A page whose tags were purged while it was being made is sent
+          but not stored, it may show a story as it was before the save.  Logged in users
+          always get a fresh page (with their edit buttons).  Both kinds of response answer If-None-Match / If-Modified-Since """
+
+    def page_cache_tags(self):
+        raise NotImplementedError("%s must say what its pages show" % self.__class__.__name__)
+
+    def dispatch(self, request, *args, **kwargs):
+        if not is_cacheable(request):
+            return super(AnonymousPageCacheMixin, self).dispatch(request, *args, **kwargs)
+
+        cache = page_cache()
+        key = page_key(request)
+        entry = cache.get(key)
+        if entry and generations(entry['tags']) == entry['generations']:
+            response = HttpResponse(entry['content'], content_type=entry['content_type'])
+        else:
+            # Most pages only know their tags once they have loaded what they show, so instead of
+            #   reading the generations up front a generation newer than this means a save
+            #   landed while the page was being made
+            started = time.time()
+            response = super(AnonymousPageCacheMixin, self).dispatch(request, *args, **kwargs)
+            if response.status_code != 200 or response.cookies or request.META.get('CSRF_COOKIE_USED'):
+                return response
+            if hasattr(response, 'render'):
+                response.render()
+
+            tags = self.page_cache_tags()
+            current = generations(tags)
+            if any(purged_at(generation) >= started for generation in current.values()):
+                return response
+
+            entry = {
+                'tags': tags,
+                'generations': current,
+                'content': response.content,
+                'content_type': response['Content-Type'],
+                'etag': quote_etag(hashlib.md5(response.content).hexdigest()),
+                'stored_at': int(time.time()),
+            }
+            cache.set(key, entry, getattr(settings, 'PAGE_CACHE_TIMEOUT', 600))
+
+        response['ETag'] = entry['etag']
+        response['Last-Modified'] = http_date(entry['stored_at'])
+        patch_vary_headers(response, ('Cookie',))
+        return get_conditional_response(request, etag=entry['etag'],
+                                        last_modified=entry['stored_at'], response=response)
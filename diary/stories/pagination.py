@@ -0,0 +1,100 @@
+import base64
+from urllib.parse import urlencode
+
+from django.db.models import Q
+from django.http import Http404
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext as _
+
+
+def encode_cursor(story):
+    """ The cursor is the (published_at, id) of the last story on a page, made url safe """
+    position = '%s|%d' % (story.published_at.isoformat(), story.pk)
+    return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Reverse encode_cursor, raises ValueError for anything we didn't produce """
+    try:
+        published_at, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+        published_at = parse_datetime(published_at)
+        pk = int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("Invalid cursor %r" % cursor)
+    if published_at is None:
+        raise ValueError("Invalid cursor %r" % cursor)
+    return published_at, pk
+
+
+class KeysetPage(object):
+    """ One page of stories ordered by (-published_at, -id).  Instead of a page number (OFFSET)
+          the next page starts after the last story on this one, so every page costs the same
+          index range scan as the first """
+    ordering = ('-published_at', '-id')
+
+    def __init__(self, queryset, cursor=None, page_size=20):
+        if cursor:
+            queryset = self.after(queryset, cursor)
+
+        # One extra row tells us if there is another page without a COUNT(*)
+        rows = list(queryset.order_by(*self.ordering)[:page_size + 1])
+        self.object_list = rows[:page_size]
+        self.has_next = len(rows) > page_size
+        self.next_cursor = self.encode_cursor(self.object_list[-1]) if self.has_next else None
+
+    def after(self, queryset, cursor):
+        published_at, pk = decode_cursor(cursor)
+        return queryset.filter(Q(published_at__lt=published_at)
+                               | Q(published_at=published_at, pk__lt=pk))
+
+    def encode_cursor(self, story):
+        return encode_cursor(story)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class RankedPage(KeysetPage):
+    """ A page of search results, ordered by (-rank, -id) where rank is annotated on the
+          queryset (see stories.search).  truncated says the last page isn't the last match,
+          the index without Postgres only ranks the best SEARCH_INDEX_MAX_RESULTS """
+    ordering = ('-rank', '-id')
+
+    def __init__(self, queryset, cursor=None, page_size=20):
+        super(RankedPage, self).__init__(queryset, cursor, page_size)
+        self.truncated = (not self.has_next and bool(self.object_list)
+                          and getattr(self.object_list[0], 'truncated', False))
+
+    def after(self, queryset, cursor):
+        try:
+            rank, pk = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('ascii').split('|')
+            rank, pk = float(rank), int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise ValueError("Invalid cursor %r" % cursor)
+        return queryset.filter(Q(rank__lt=rank) | Q(rank=rank, pk__lt=pk))
+
+    def encode_cursor(self, story):
+        # repr() round trips the float exactly, so the rank = comparison holds
+        position = '%r|%d' % (story.rank, story.pk)
+        return base64.urlsafe_b64encode(position.encode('ascii')).decode('ascii')
+
+
+class KeysetPaginationMixin(object):
+    """ Swap the page number pagination of a ListView for keyset pagination over published
+          stories.  The template gets page_obj.has_next and page_obj.next_query """
+    paginate_by = 20
+    cursor_param = 'after'
+    page_class = KeysetPage
+
+    def paginate_queryset(self, queryset, page_size):
+        try:
+            page = self.page_class(queryset, self.request.GET.get(self.cursor_param), page_size)
+        except ValueError:
+            raise Http404(_("Invalid page."))
+
+        if page.has_next:
+            page.next_query = '?' + urlencode({self.cursor_param: page.next_cursor})
+        return (None, page, page.object_list, page.has_next)
@@ -0,0 +1,85 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, Max
+from django.utils import timezone
+
+from stories.models import Story, TrendingScore, UpVotes, DownVotes
+
+# How a vote moves the score
+VOTE_SIGNS = {
+    UpVotes: 1,
+    DownVotes: -1,
+}
+
+
+def half_life():
+    """ Seconds for a vote to count half as much """
+    return getattr(settings, 'TRENDING_HALF_LIFE', 24) * 3600.0
+
+
+def window():
+    """ Only the votes this recent count towards trending """
+    return timezone.timedelta(days=getattr(settings, 'TRENDING_WINDOW', 7))
+
+
+def vote_weight(voted_at, anchor):
+    """ Weight of a vote relative to the anchor, doubles every half life after it """
+    return 2 ** ((voted_at - anchor).total_seconds() / half_life())
+
+
+def current_anchor():
+    """ All the scores are relative to the same anchor, the one of the last refresh """
+    return TrendingScore.objects.aggregate(anchor=Max('anchored_at'))['anchor'] or timezone.now()
+
+
+def record_votes(model, votes, removed=False):
+    """ Add (or take away) these votes to the trending scores of their stories """
+    sign = VOTE_SIGNS.get(model)
+    if not sign or not votes:
+        return
+
+    anchor = current_anchor()
+    now = timezone.now()
+    if now - anchor > window():
+        # The weights double every half life past the anchor and would end up overflowing a
+        #   float, so when refresh_trending hasn't run for a whole window score everything
+        #   again against now (the votes are already in, or already gone, by the time we are called)
+        refresh(now)
+        return
+
+    deltas = defaultdict(float)
+    for vote in votes:
+        deltas[vote.entry_id] += sign * vote_weight(vote.voted_at, anchor)
+
+    for story_id, delta in deltas.items():
+        delta = -delta if removed else delta
+        if not TrendingScore.objects.filter(story_id=story_id).update(score=F('score') + delta):
+            try:
+                with transaction.atomic():
+                    TrendingScore.objects.create(story_id=story_id, score=delta, anchored_at=anchor)
+            except IntegrityError: # Someone else created it first
+                TrendingScore.objects.filter(story_id=story_id).update(score=F('score') + delta)
+
+
+def refresh(now=None):
+    """ Recompute every score from the votes in the trending window against a new anchor.
+          Votes older than the window are worth next to nothing so they are left out, as are
+          the stories that no longer have any votes in it.  Returns the number of scores """
+    now = now or timezone.now()
+    since = now - window()
+
+    scores = defaultdict(float)
+    for model, sign in VOTE_SIGNS.items():
+        votes = model.objects.filter(voted_at__gte=since).values_list('entry_id', 'voted_at')
+        for story_id, voted_at in votes.iterator():
+            scores[story_id] += sign * vote_weight(voted_at, now)
+
+    with transaction.atomic():
+        TrendingScore.objects.all().delete()
+        TrendingScore.objects.bulk_create([
+            TrendingScore(story_id=story_id, score=score, anchored_at=now)
+            for story_id, score in scores.items()
+        ])
+    return len(scores)
@@ -0,0 +1,126 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Case, F, FloatField, Q, Value, When
+
+from authors.models import Author
+from stories import search_index
+from stories.models import Story
+
+# Story.language -> the Postgres text search configuration that stems it, anything not listed
+#   is indexed word for word ('simple')
+SEARCH_CONFIGS = {
+    'da': 'danish',
+    'de': 'german',
+    'en': 'english',
+    'es': 'spanish',
+    'fi': 'finnish',
+    'fr': 'french',
+    'hu': 'hungarian',
+    'it': 'italian',
+    'nb': 'norwegian',
+    'nl': 'dutch',
+    'nn': 'norwegian',
+    'pt': 'portuguese',
+    'ro': 'romanian',
+    'ru': 'russian',
+    'sv': 'swedish',
+    'tr': 'turkish',
+}
+
+
+def search_config(language):
+    """ 'pt-br' -> 'portuguese' """
+    return SEARCH_CONFIGS.get((language or '').split('-')[0].lower(), 'simple')
+
+
+def language_configs():
+    """ The text search configuration -> the Story.language codes indexed with it """
+    configs = defaultdict(list)
+    for code, name in settings.LANGUAGES:
+        configs[search_config(code)].append(code)
+    return configs
+
+
+def is_supported():
+    """ The tsvector columns are only filled in on Postgres """
+    return connection.vendor == 'postgresql'
+
+
+def story_vector(config):
+    return (SearchVector('title', weight='A', config=config)
+            + SearchVector('tagline', weight='B', config=config)
+            + SearchVector('teaser', weight='B', config=config)
+            + SearchVector('text', weight='C', config=config))
+
+
+def author_vector(config):
+    return SearchVector('name', weight='A', config=config) + SearchVector('bio_text', weight='B', config=config)
+
+
+def story_saved(sender, instance, raw=False, **kwargs):
+    """ Index the story in its own language, an UPDATE so the vector is built by the database """
+    if not raw and is_supported():
+        Story.objects.filter(pk=instance.pk).update(
+            search_vector=story_vector(search_config(instance.language)))
+
+
+def author_saved(sender, instance, raw=False, **kwargs):
+    if not raw and is_supported():
+        Author.objects.filter(pk=instance.pk).update(
+            search_vector=author_vector(search_config(settings.LANGUAGE_CODE)))
+
+
+def index_stories(stories):
+    """ Build the vectors of a queryset of stories again, one UPDATE per language, for changes
+          that went around save() and story_saved (a bulk_update).  Returns the number of
+          stories indexed """
+    indexed = 0
+    languages = stories.order_by().values_list('language', flat=True).distinct()
+    for language in languages:
+        indexed += stories.filter(language=language).update(
+            search_vector=story_vector(search_config(language)))
+    return indexed
+
+
+def reindex():
+    """ Build every vector again (after changing SEARCH_CONFIGS for example).  Returns the
+          number of stories indexed """
+    indexed = index_stories(Story.objects.all())
+    Author.objects.update(search_vector=author_vector(search_config(settings.LANGUAGE_CODE)))
+    return indexed
+
+
+def search_stories(q):
+    """ Published stories matching the query, annotated with their rank.  Page it with
+          stories.pagination.RankedPage, best first.  Without Postgres the in-process index
+          (stories.search_index) does the searching """
+    if not q:
+        return Story.objects.none().annotate(rank=Value(0.0, output_field=FloatField()))
+    if not is_supported():
+        return search_index.get_index().search(q)
+
+    # Each story was stemmed in its own language, so the query is parsed once per configuration
+    #   and only matched against the stories indexed with that one
+    matches = Q()
+    ranks = []
+    for config, languages in sorted(language_configs().items()):
+        query = SearchQuery(q, config=config)
+        matches |= Q(language__in=languages, search_vector=query)
+        ranks.append(When(language__in=languages, then=SearchRank(F('search_vector'), query)))
+    return (Story.objects.recent().filter(matches)
+            .annotate(rank=Case(*ranks, default=Value(0.0), output_field=FloatField())))
+
+
+def search_authors(q, limit=5, language=None):
+    """ The authors whose name or bio match the query, best first """
+    if not q:
+        return []
+    if not is_supported(): # Not many authors, a name match will do
+        return list(Author.objects.filter(name__icontains=q).order_by('name')[:limit])
+
+    query = SearchQuery(q, config=search_config(language or settings.LANGUAGE_CODE))
+    return list(Author.objects.filter(search_vector=query)
+                .annotate(rank=SearchRank(F('search_vector'), query)).order_by('-rank', 'id')[:limit])
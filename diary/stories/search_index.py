@@ -0,0 +1,368 @@
+"""
+An in-process inverted index over the published stories, for running search without Postgres
+(local development, SQLite test runs).  stories.search uses it when the database can't do
+full text search, the results come back the same way (a queryset annotated with a rank).
+The index remembers the Max(updated_at) and Count of the stories it was made from, so a
+process that finds the database has moved on since (a save or delete elsewhere) maps the file
+again or builds a new one before searching.
+"""
+import json
+import math
+import mmap
+import os
+import re
+from array import array
+from collections import Counter
+from threading import RLock
+
+from django.conf import settings
+from django.db.models import BooleanField, Case, Count, FloatField, Max, Value, When
+from django.utils.dateparse import parse_datetime
+
+from stories.models import Story
+
+MAGIC = b'DOLIDX1\n'
+
+# Markdown that isn't words: link and image targets, html tags, code fences
+MARKUP = re.compile(r'\]\([^)]*\)|<[^>]*>|```[^\n]*')
+WORD = re.compile(r'\w+')
+
+# How many times a word in each field counts, like the A/B/C weights of the Postgres vector
+FIELD_WEIGHTS = (
+    ('title', 3),
+    ('tagline', 2),
+    ('teaser', 2),
+    ('text', 1),
+)
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+DEAD = -1
+
+
+def tokenize(text):
+    """ Lower case words of the markdown source, without the link targets and tags """
+    return [word for word in WORD.findall(MARKUP.sub(' ', (text or '').lower())) if len(word) > 1]
+
+
+def story_terms(story):
+    """ Counter of the weighted words in a story """
+    terms = Counter()
+    for field, weight in FIELD_WEIGHTS:
+        for word in tokenize(getattr(story, field)):
+            terms[word] += weight
+    return terms
+
+
+def is_searchable(story):
+    return story.published_at is not None and story.hidden_at is None
+
+
+def database_stamp():
+    """ (last updated_at, number of stories), any save or delete of a story changes it """
+    stamp = Story.objects.aggregate(updated=Max('updated_at'), count=Count('pk'))
+    return (stamp['updated'], stamp['count'])
+
+
+class InvertedIndex(object):
+    """ Posting lists are two arrays per term, document numbers and term frequencies, so a term
+          costs 8 bytes per story it appears in.  Documents are numbered as they are added and
+          a story that changes gets a new number, the old one is marked dead and skipped until
+          save() compacts the index.
+
+          save() writes everything to one file, load() maps that file and reads the posting lists
+          straight out of it, a term is only copied into memory when a story using it changes.
+          stamp is the database_stamp() the index matches, refresh() catches up when it doesn't """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = RLock()
+        self._mmap = None
+        self._loaded_mtime = None
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._doc_ids = array('q')      # document number -> story id (DEAD once replaced)
+            self._doc_lengths = array('I')  # document number -> weighted word count
+            self._live = {}                 # story id -> document number
+            self._total_length = 0
+            self._postings = {}             # term -> (document numbers, frequencies)
+            self.stamp = None
+            self.changed = False            # Saves of ours the file doesn't have yet
+            if self._mmap is not None:
+                try:
+                    self._mmap.close()
+                except BufferError: # A search still holds a posting list, let gc close it
+                    pass
+                self._mmap = None
+
+    def __len__(self):
+        return len(self._live)
+
+    def _writable(self, term):
+        """ The posting arrays of a term, copied out of the mapped file the first time """
+        docs, freqs = self._postings.get(term, (None, None))
+        if not isinstance(docs, array):
+            docs = array('I', docs or ())
+            freqs = array('I', freqs or ())
+            self._postings[term] = (docs, freqs)
+        return docs, freqs
+
+    def remove(self, story_id):
+        with self._lock:
+            number = self._live.pop(story_id, None)
+            if number is not None:
+                self._doc_ids[number] = DEAD
+                self._total_length -= self._doc_lengths[number]
+
+    def add(self, story):
+        """ Index (or index again) a story, stories readers can't see are taken out """
+        with self._lock:
+            self.remove(story.pk)
+            if not is_searchable(story):
+                return
+
+            terms = story_terms(story)
+            number = len(self._doc_ids)
+            self._doc_ids.append(story.pk)
+            length = sum(terms.values())
+            self._doc_lengths.append(length)
+            self._live[story.pk] = number
+            self._total_length += length
+            for term, frequency in terms.items():
+                docs, freqs = self._writable(term)
+                docs.append(number)
+                freqs.append(frequency)
+
+    def build(self, stories=None):
+        """ Index every published story from scratch """
+        # Stamped before reading, a save landing meanwhile makes the next search build it again
+        stamp = database_stamp() if stories is None else None
+        if stories is None:
+            stories = (Story.objects.published().only('pk', 'published_at', 'hidden_at',
+                                                       *[field for field, weight in FIELD_WEIGHTS])
+                       .order_by('pk').iterator())
+        with self._lock:
+            self.clear()
+            for story in stories:
+                self.add(story)
+            self.stamp = stamp
+        return len(self)
+
+    def check_current(self):
+        """ Before a save or delete of ours: if the database already moved on (another worker
+              saved a story) moving the stamp along with our change could cover that up, so
+              let the next search catch up instead """
+        with self._lock:
+            if self.stamp is not None and database_stamp() != self.stamp:
+                self.stamp = None
+
+    def saved(self, story, created=False, updated_at=None):
+        """ A story this process saved: index it and move the stamp the way the save moved the
+              database's.  The file is written by the next refresh() """
+        with self._lock:
+            self.add(story)
+            self.moved(updated_at, 1 if created else 0)
+            self.changed = True
+
+    def deleted(self, story_id):
+        with self._lock:
+            self.remove(story_id)
+            self.moved(None, -1)
+            self.changed = True
+
+    def moved(self, updated_at, count):
+        """ Only when the index matched the database before (see check_current), otherwise the
+              next search has to catch up anyway """
+        if self.stamp is not None:
+            last, total = self.stamp
+            if updated_at is not None and (last is None or updated_at > last):
+                last = updated_at
+            self.stamp = (last, total + count)
+
+    def scores(self, q):
+        """ {story id: BM25 score} of the stories containing every word of the query """
+        words = set(tokenize(q))
+        if not words:
+            return {}
+
+        with self._lock:
+            live = len(self._live)
+            if not live:
+                return {}
+            average = self._total_length / live
+
+            scores = None
+            for word in words:
+                docs, freqs = self._postings.get(word, ((), ()))
+                matches = {}
+                for number, frequency in zip(docs, freqs):
+                    if self._doc_ids[number] != DEAD:
+                        matches[number] = frequency
+                if not matches:
+                    return {}
+
+                idf = math.log(1 + (live - len(matches) + 0.5) / (len(matches) + 0.5))
+                word_scores = {}
+                for number, frequency in matches.items():
+                    norm = K1 * (1 - B + B * self._doc_lengths[number] / average)
+                    word_scores[number] = idf * frequency * (K1 + 1) / (frequency + norm)
+
+                if scores is None:
+                    scores = word_scores
+                else: # Every word has to match
+                    scores = {number: score + word_scores[number]
+                              for number, score in scores.items() if number in word_scores}
+                if not scores:
+                    return {}
+
+            return {self._doc_ids[number]: score for number, score in scores.items()}
+
+    def search(self, q, limit=None):
+        """ Published stories matching the query annotated with their rank, like
+              stories.search.search_stories on Postgres.  Only the best limit of them, when
+              there were more every row is annotated with truncated (see RankedPage) """
+        self.refresh()
+        limit = limit or getattr(settings, 'SEARCH_INDEX_MAX_RESULTS', 200)
+        scores = self.scores(q)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        if not best:
+            return Story.objects.none().annotate(rank=Value(0.0, output_field=FloatField()))
+
+        rank = Case(*[When(pk=story_id, then=Value(score)) for story_id, score in best],
+                    output_field=FloatField())
+        return (Story.objects.recent().filter(pk__in=[story_id for story_id, score in best])
+                .annotate(rank=rank, truncated=Value(len(scores) > limit, output_field=BooleanField())))
+
+    def save(self, path=None):
+        """ Write the live documents to the index file (renumbered, so the dead ones are gone)
+              and map it again """
+        path = path or self.path
+        if not path:
+            return
+
+        with self._lock:
+            renumber = {}
+            doc_ids = array('q')
+            doc_lengths = array('I')
+            for number, story_id in enumerate(self._doc_ids):
+                if story_id != DEAD:
+                    renumber[number] = len(doc_ids)
+                    doc_ids.append(story_id)
+                    doc_lengths.append(self._doc_lengths[number])
+
+            blocks = [doc_ids.tobytes(), doc_lengths.tobytes()]
+            terms = []
+            for term in sorted(self._postings):
+                docs, freqs = self._postings[term]
+                kept = [(renumber[number], frequency) for number, frequency in zip(docs, freqs)
+                        if number in renumber]
+                if kept:
+                    terms.append([term, len(kept)])
+                    blocks.append(array('I', [number for number, frequency in kept]).tobytes())
+                    blocks.append(array('I', [frequency for number, frequency in kept]).tobytes())
+
+            stamp = None
+            if self.stamp is not None:
+                stamp = [self.stamp[0] and self.stamp[0].isoformat(), self.stamp[1]]
+            header = json.dumps({'docs': len(doc_ids), 'stamp': stamp, 'terms': terms}).encode('utf-8')
+            header += b' ' * (-len(header) % 8) # Keep the arrays 8 byte aligned
+            temp = '%s.%d.tmp' % (path, os.getpid())
+            with open(temp, 'wb') as f:
+                f.write(MAGIC)
+                f.write(len(header).to_bytes(8, 'little'))
+                f.write(header)
+                for block in blocks:
+                    f.write(block)
+            os.replace(temp, path)
+            self.load(path)
+
+    def load(self, path=None):
+        """ Map an index file, False if there isn't one """
+        path = path or self.path
+        if not path or not os.path.exists(path):
+            return False
+
+        with self._lock:
+            self.clear()
+            with open(path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._loaded_mtime = os.path.getmtime(path)
+
+            view = memoryview(self._mmap)
+            if bytes(view[:len(MAGIC)]) != MAGIC:
+                raise ValueError("%s is not a search index" % path)
+            offset = len(MAGIC)
+            header_length = int.from_bytes(view[offset:offset + 8], 'little')
+            offset += 8
+            header = json.loads(bytes(view[offset:offset + header_length]).decode('utf-8'))
+            offset += header_length
+            if header.get('stamp'):
+                updated, count = header['stamp']
+                self.stamp = (updated and parse_datetime(updated), count)
+
+            count = header['docs']
+            self._doc_ids = array('q', view[offset:offset + 8 * count].cast('q'))
+            offset += 8 * count
+            self._doc_lengths = array('I', view[offset:offset + 4 * count].cast('I'))
+            offset += 4 * count
+            self._live = {story_id: number for number, story_id in enumerate(self._doc_ids)}
+            self._total_length = sum(self._doc_lengths)
+
+            for term, postings in header['terms']:
+                docs = view[offset:offset + 4 * postings].cast('I')
+                offset += 4 * postings
+                freqs = view[offset:offset + 4 * postings].cast('I')
+                offset += 4 * postings
+                self._postings[term] = (docs, freqs)
+        return True
+
+    def refresh(self):
+        """ Catch up with the database if a story changed since the index was made: map the
+              file saved by another process if that one is current, build it again if not.
+              Our own saves are written to the file here, once for however many there were """
+        stamp = database_stamp()
+        with self._lock:
+            if stamp == self.stamp:
+                if self.changed:
+                    self.save()
+                return
+            if self.path and os.path.exists(self.path) and os.path.getmtime(self.path) != self._loaded_mtime:
+                self.load()
+                if stamp == self.stamp:
+                    return
+            self.build()
+            self.save()
+
+
+_index = None
+
+
+def get_index():
+    """ The process' index, mapped from SEARCH_INDEX_PATH (or built from the database and saved
+          for the next worker) by the first search """
+    global _index
+    if _index is None:
+        _index = InvertedIndex(getattr(settings, 'SEARCH_INDEX_PATH', None))
+    return _index
+
+
+def story_changing(sender, instance, raw=False, **kwargs):
+    if not raw and _index is not None:
+        _index.check_current()
+
+
+def story_saved(sender, instance, created=False, raw=False, update_fields=None, **kwargs):
+    # Until this process searches there is nothing to keep up to date, the stamp tells the
+    #   first search that the file is behind
+    if not raw and _index is not None:
+        touched = update_fields is None or 'updated_at' in update_fields
+        _index.saved(instance, created, instance.updated_at if touched else None)
+
+
+def story_deleted(sender, instance, **kwargs):
+    if _index is not None:
+        _index.deleted(instance.pk)
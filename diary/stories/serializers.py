@@ -2,6 +2,16 @@ from rest_framework import serializers
 
 from stories.models import Story
 
+
+class StoryListSerializer(serializers.ListSerializer):
+    """ Renders the markdown for the whole page of stories in one go (one cache round trip)
+          instead of one story at a time as each one is serialized """
+
+    def to_representation(self, data):
+        stories = Story.render_all(data.all() if hasattr(data, 'all') else data)
+        return super(StoryListSerializer, self).to_representation(stories)
+
+
 class StorySerializer(serializers.HyperlinkedModelSerializer):
 
     url = serializers.HyperlinkedIdentityField(view_name="story-detail")
@@ -10,10 +20,29 @@ class StorySerializer(serializers.HyperlinkedModelSerializer):
 
     class Meta:
         model = Story
+        list_serializer_class = StoryListSerializer
         fields = ('url', 'title', 'tagline', 'author', 'html', 'inspired_by', 
-                  'published_at', 'preceded_by', 'next_chapter', 'can_edit')
+                  'published_at', 'preceded_by', 'next_chapter', 'can_edit', 'word_count',
+                  'read_minutes')
 
     def get_can_edit(self, obj):
         """ Can the person that requested this object edit it?
               (Are they the owner?) """
-        return self.context['request'].user == obj.author.user
\ No newline at end of file
+        return self.context['request'].user == obj.author.user
+
+
+class InspirationNodeSerializer(serializers.HyperlinkedModelSerializer):
+    """ A story in an inspiration tree (see stories.inspiration.tree), light on purpose: no
+          markdown, and the children nest all the way down """
+
+    url = serializers.HyperlinkedIdentityField(view_name="story-detail")
+    subtree_size = serializers.IntegerField(read_only=True)
+    children = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Story
+        fields = ('url', 'title', 'tagline', 'author', 'published_at', 'subtree_size', 'children')
+
+    def get_children(self, obj):
+        return InspirationNodeSerializer(getattr(obj, 'children', []), many=True,
+                                         context=self.context).data
@@ -0,0 +1,68 @@
+import atexit
+
+from django.core.signals import request_finished
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
+
+from authors.models import Author
+from stories import inspiration, links, page_cache, ranking, search, search_index
+from stories.models import Story, UpVotes, DownVotes, Flag
+
+# Which Story counter each kind of row is counted in
+COUNTERS = {
+    UpVotes: 'upvote_count',
+    DownVotes: 'downvote_count',
+    Flag: 'flag_count',
+}
+
+
+def adjust_counter(model, story_id, amount):
+    """ Add amount to the story's counter for this kind of row, in the database (F()) so
+          concurrent votes can't lose each other's updates """
+    field = COUNTERS[model]
+    Story.objects.filter(pk=story_id).update(**{field: F(field) + amount})
+
+
+def count_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        adjust_counter(sender, instance.entry_id, 1)
+        ranking.record_votes(sender, [instance])
+
+
+def count_deleted(sender, instance, **kwargs):
+    adjust_counter(sender, instance.entry_id, -1)
+    ranking.record_votes(sender, [instance], removed=True)
+
+
+def connect():
+    for model in COUNTERS:
+        post_save.connect(count_created, sender=model, dispatch_uid='count_created_%s' % model.__name__)
+        post_delete.connect(count_deleted, sender=model, dispatch_uid='count_deleted_%s' % model.__name__)
+
+    # The inspiration closure table follows inspired_by
+    post_save.connect(inspiration.story_saved, sender=Story, dispatch_uid='inspiration_story_saved')
+
+    # The images still hosted elsewhere are indexed for fix_image_links
+    post_save.connect(links.story_saved, sender=Story, dispatch_uid='links_story_saved')
+
+    # Full text search vectors are built by the database after each save
+    post_save.connect(search.story_saved, sender=Story, dispatch_uid='search_story_saved')
+    post_save.connect(search.author_saved, sender=Author, dispatch_uid='search_author_saved')
+    # and without Postgres by the in-process index
+    pre_save.connect(search_index.story_changing, sender=Story, dispatch_uid='search_index_story_saving')
+    pre_delete.connect(search_index.story_changing, sender=Story, dispatch_uid='search_index_story_deleting')
+    post_save.connect(search_index.story_saved, sender=Story, dispatch_uid='search_index_story_saved')
+    post_delete.connect(search_index.story_deleted, sender=Story, dispatch_uid='search_index_story_deleted')
+
+    # Anonymous pages showing what was saved are thrown away
+    post_save.connect(page_cache.story_saved, sender=Story, dispatch_uid='purge_story_pages')
+    post_delete.connect(page_cache.story_saved, sender=Story, dispatch_uid='purge_deleted_story_pages')
+    post_save.connect(page_cache.author_saved, sender=Author, dispatch_uid='purge_author_pages')
+    post_delete.connect(page_cache.author_saved, sender=Author, dispatch_uid='purge_deleted_author_pages')
+
+    # Buffered votes are written once the buffer is old enough, we check after each request
+    #   and write whatever is left when the process exits
+    from stories.votes import vote_buffer
+    request_finished.connect(vote_buffer.flush_if_due, dispatch_uid='flush_votes')
+    atexit.register(vote_buffer.flush)
+
@@ -1,19 +1,36 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
 import urllib
+from array import array
 from datetime import timedelta
+from unittest import mock, skipUnless
 
 from django.conf import settings
-from django.utils import timezone
+from django.core.cache import cache
+from django.db import connection
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.utils import timezone, translation
+from django.utils.functional import empty
 from django.urls import reverse
 from rest_framework.serializers import DateTimeField as DrfDtf
 
-from django.test import TestCase, Client
+from django.test import TestCase, Client, RequestFactory, override_settings
 from rest_framework.test import APIRequestFactory, force_authenticate
 
 from model_mommy import mommy
+from PIL import Image
 
-from stories.models import Story
-from stories.forms import StoryForm
+from stories.pagination import RankedPage
+from stories.models import Story, UpVotes, DownVotes, Flag, TrendingScore, Inspiration, StoryImage
+from stories.forms import PublishForm, StoryForm
 from stories.serializers import StorySerializer
+from stories.views import Read, Recent
+from stories import chunked, images, inspiration, links, page_cache, ranking, search, search_index, utils
+from stories.votes import VoteBuffer, insert_new
 
 # Create your tests here.
 
@@ -54,11 +71,37 @@ class TestStoryModel(TestCase):
 
     def test_read_time(self):
         self.assertEqual("Short read", self.published0.read_time())
+        self.assertEqual((2, 1), (self.published0.word_count, self.published0.read_minutes))
+
+        long_story = mommy.make(Story, text="**Word** " * 401, published_at=timezone.now())
+        self.assertEqual((401, 3), (long_story.word_count, long_story.read_minutes))
+        self.assertEqual("3 minutes read", long_story.read_time())
+        self.assertEqual([long_story], list(Story.objects.recent().by_length(minimum=2)))
+        self.assertNotIn(long_story, Story.objects.recent().by_length(maximum=2))
 
     def test_html(self):
         self.assertEqual("<p><strong>Published 0</strong></p>", self.published0.html())
         self.assertEqual("<p>Published 1</p>", self.published1.html())
 
+    def test_rendered_html_is_stored(self):
+        self.assertEqual("<p><strong>Published 0</strong></p>", self.published0.rendered_html)
+        self.assertEqual(utils.MARKDOWN_CONFIG_VERSION, self.published0.html_version)
+
+        story = Story.objects.get(pk=self.published0.id)
+        with mock.patch('stories.models.cached_markdownify') as render:
+            self.assertEqual("<p><strong>Published 0</strong></p>", story.html())
+            self.assertFalse(render.called)
+
+        # The stored html is only good for the text it was rendered from
+        story.text = "Changed"
+        self.assertEqual("<p>Changed</p>", story.html())
+
+    def test_stale_rendered_html_is_not_used(self):
+        Story.objects.filter(pk=self.published0.id).update(rendered_html="<p>old</p>",
+                                                           html_version="old")
+        story = Story.objects.get(pk=self.published0.id)
+        self.assertEqual("<p><strong>Published 0</strong></p>", story.html())
+
     def test__str__(self):
         """ Make sure the title is usable in ModelChoiceFields """
         self.assertEqual("%s: %s" % (self.published1.title, self.published1.tagline), 
@@ -80,6 +123,732 @@ class TestStoryModel(TestCase):
 
 
 
+class TestStorySeries(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.first = mommy.make(Story, published_at=now - timedelta(days=3), title="One")
+        author = self.first.author
+        self.second = mommy.make(Story, published_at=now - timedelta(days=2), author=author,
+                                 preceded_by=self.first, title="Two")
+        self.third = mommy.make(Story, published_at=now - timedelta(days=1), author=author,
+                                preceded_by=self.second, title="Three")
+        # Not part of the series: a draft, someone else's continuation
+        mommy.make(Story, published_at=None, author=author, preceded_by=self.third)
+        mommy.make(Story, published_at=now, preceded_by=self.third)
+
+    def test_series_from_any_chapter(self):
+        for chapter in (self.first, self.second, self.third):
+            with self.assertNumQueries(1):
+                series = Story.objects.series(chapter)
+                self.assertEqual([self.first, self.second, self.third], series)
+                # next_chapter came along with the series
+                self.assertEqual([self.second, self.third, None],
+                                 [story.next_chapter() for story in series])
+
+    def test_standalone_story(self):
+        story = mommy.make(Story, published_at=timezone.now())
+        self.assertEqual([story], Story.objects.series(story.id))
+        self.assertEqual([], Story.objects.series(mommy.make(Story, published_at=None)))
+
+    def test_series_view(self):
+        response = Client().get(reverse('stories:series', kwargs={'pk': self.second.id}))
+        self.assertEqual([self.first, self.second, self.third], response.context['object_list'])
+        self.assertContains(response, "Three")
+
+        response = Client().get(reverse('stories:read', kwargs={'pk': self.second.id}))
+        self.assertContains(response, reverse('stories:series', kwargs={'pk': self.second.id}))
+
+    def test_series_api(self):
+        response = Client().get(reverse('story-series', args=(self.third.id,)))
+        self.assertEqual(["One", "Two", "Three"], [story['title'] for story in response.json()])
+
+
+class TestInspirationTree(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        #   root -> child -> grandchild
+        #        -> sibling
+        self.root = mommy.make(Story, published_at=now, title="Root")
+        self.child = mommy.make(Story, published_at=now, inspired_by=self.root, title="Child")
+        self.sibling = mommy.make(Story, published_at=now, inspired_by=self.root, title="Sibling")
+        self.grandchild = mommy.make(Story, published_at=now, inspired_by=self.child, title="Grandchild")
+        self.draft = mommy.make(Story, published_at=None, inspired_by=self.child)
+
+    def closure(self):
+        return set(Inspiration.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+
+    def test_descendants_and_ancestors(self):
+        self.assertEqual([(self.child, 1), (self.sibling, 1), (self.grandchild, 2)],
+                         [(story, story.depth) for story in Story.objects.inspiration_descendants(self.root)])
+        self.assertEqual([self.child, self.sibling],
+                         list(Story.objects.inspiration_descendants(self.root, depth=1)))
+        self.assertEqual([], list(Story.objects.inspiration_descendants(self.root, depth=0)))
+        self.assertEqual([self.root, self.child],
+                         list(Story.objects.inspiration_ancestors(self.grandchild)))
+
+    def test_moving_a_subtree(self):
+        self.child.inspired_by = self.sibling
+        self.child.save()
+        self.assertEqual([self.root, self.sibling, self.child],
+                         list(Story.objects.inspiration_ancestors(self.grandchild)))
+
+        # Whatever we did incrementally, the recursive rebuild agrees
+        incremental = self.closure()
+        inspiration.rebuild()
+        self.assertEqual(incremental, self.closure())
+
+    def test_tree_is_three_queries(self):
+        with self.assertNumQueries(3):
+            ancestors, root = inspiration.tree(self.root)
+            self.assertEqual([], ancestors)
+            self.assertEqual(3, root.subtree_size)
+            self.assertEqual([self.child, self.sibling], root.children)
+            self.assertEqual([self.grandchild], root.children[0].children)
+            self.assertEqual(1, root.children[0].subtree_size) # The draft doesn't count
+
+    def test_tree_view_and_api(self):
+        response = Client().get(reverse('stories:inspiration-tree', kwargs={'pk': self.child.id}))
+        self.assertContains(response, "Grandchild")
+        self.assertContains(response, "Root")
+
+        data = Client().get(reverse('story-inspiration', args=(self.root.id,))).json()
+        self.assertEqual(["Child", "Sibling"], [node['title'] for node in data['tree']['children']])
+        self.assertEqual("Grandchild", data['tree']['children'][0]['children'][0]['title'])
+
+        response = Client().get(reverse('story-inspiration', args=(self.root.id,)), {'depth': 0})
+        self.assertEqual(400, response.status_code)
+
+
+class TestSearch(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.in_title = mommy.make(Story, published_at=now, title="Running with wolves",
+                                   text="A story", language='en')
+        self.in_text = mommy.make(Story, published_at=now, title="Something else",
+                                  text="The wolves ran all night", language='en')
+        self.draft = mommy.make(Story, published_at=None, title="Wolves", language='en')
+        self.german = mommy.make(Story, published_at=now, title="Die Wölfe", language='de')
+        search_index._index = None
+
+    def test_search_config(self):
+        self.assertEqual('english', search.search_config('en-us'))
+        self.assertEqual('portuguese', search.search_config('pt-br'))
+        self.assertEqual('simple', search.search_config('tlh'))
+        self.assertEqual('simple', search.search_config(None))
+        self.assertIn('pt-br', search.language_configs()['portuguese'])
+
+    def test_empty_query(self):
+        self.assertEqual([], list(search.search_stories('')))
+        response = Client().get(reverse('stories:search'))
+        self.assertContains(response, "No stories found")
+
+    @skipUnless(connection.vendor == 'postgresql', "Full text search needs Postgres")
+    def test_ranked_and_stemmed(self):
+        # 'wolf' matches 'wolves' through the english stemmer, the title weighs more than the text
+        self.assertEqual([self.in_title, self.in_text],
+                         list(search.search_stories('wolf').order_by('-rank', '-id')))
+
+    @skipUnless(connection.vendor == 'postgresql', "Full text search needs Postgres")
+    def test_each_story_is_matched_in_its_own_language(self):
+        # 'loups' only stems to 'loup' with the french configuration the story was indexed with
+        french = mommy.make(Story, published_at=timezone.now(), title="Les loups", language='fr')
+        with translation.override('en'):
+            self.assertEqual([french], list(search.search_stories('loup')))
+
+    def test_pages_and_api(self):
+        response = Client().get(reverse('stories:search'), {'q': 'wolves'})
+        self.assertEqual([self.in_title, self.in_text], list(response.context['object_list']))
+
+        data = Client().get(reverse('story-list'), {'q': 'wolves'}).json()
+        self.assertEqual(["Running with wolves", "Something else"],
+                         [story['title'] for story in data['results']])
+
+    @skipUnless(connection.vendor == 'postgresql', "Full text search needs Postgres")
+    def test_uses_the_gin_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            query, params = search.search_stories('wolves').query.sql_with_params()
+            cursor.execute('EXPLAIN ' + query, params)
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+        self.assertIn('story_search_idx', plan)
+
+
+class TestSearchIndex(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.in_title = mommy.make(Story, published_at=now, title="Running with wolves",
+                                   text="A story about a [run](http://wolves.example.com)")
+        self.in_text = mommy.make(Story, published_at=now, title="Something else",
+                                  text="The wolves ran all night and the moon was out")
+        self.draft = mommy.make(Story, published_at=None, title="Wolves")
+        self.index = search_index.InvertedIndex()
+        self.index.build()
+        search_index._index = None
+
+    def ranked(self, q):
+        return list(self.index.search(q).order_by('-rank', '-id'))
+
+    def test_ranked(self):
+        # The title weighs more than the text, drafts and link targets aren't indexed
+        self.assertEqual(2, len(self.index))
+        self.assertEqual([self.in_title, self.in_text], self.ranked('wolves'))
+        self.assertEqual([self.in_title], self.ranked('story'))
+        self.assertEqual([], self.ranked('example'))
+
+    def test_every_word_has_to_match(self):
+        self.assertEqual([self.in_text], self.ranked('wolves MOON'))
+        self.assertEqual([], self.ranked('wolves sun'))
+
+    def test_kept_up_to_date(self):
+        search_index.get_index()
+        self.draft.published_at = timezone.now()
+        self.draft.save()
+        self.in_title.hidden_at = timezone.now()
+        self.in_title.save()
+        self.in_text.delete()
+        self.assertEqual([self.draft], list(search.search_stories('wolves')))
+
+    def test_saved_and_mapped(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'search.idx')
+            self.index.remove(self.in_title.pk)
+            self.index.save(path)
+
+            loaded = search_index.InvertedIndex(path)
+            self.assertTrue(loaded.load())
+            self.assertIsInstance(loaded._postings['wolves'][0], memoryview)
+            self.assertEqual([self.in_text], list(loaded.search('wolves')))
+
+            # Changing a story copies the terms it uses out of the file
+            loaded.add(self.in_title)
+            self.assertIsInstance(loaded._postings['wolves'][0], array)
+            self.assertEqual({self.in_title.pk, self.in_text.pk}, set(loaded.scores('wolves')))
+            loaded.save()
+            reloaded = search_index.InvertedIndex(path)
+            reloaded.load()
+            self.assertEqual([self.in_title, self.in_text], list(reloaded.search('wolves').order_by('-rank')))
+
+    def test_a_new_process_catches_up_with_the_file(self):
+        self.addCleanup(setattr, search_index, '_index', None) # Don't leave it on the deleted file
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(SEARCH_INDEX_PATH=os.path.join(directory, 'search.idx')):
+            self.assertEqual(2, len(search_index.get_index().search('wolves')))
+
+            # A process that hasn't searched saves a story, ours writes its saves to the file
+            #   when it next searches
+            search_index._index = None
+            zebra = mommy.make(Story, published_at=timezone.now(), title="Zebra")
+            self.assertEqual([zebra], list(search.search_stories('zebra')))
+            self.in_text.delete()
+            search_index.get_index().refresh()
+
+            search_index._index = None
+            index = search_index.get_index()
+            with self.assertNumQueries(1): # The file is current, only the stamp to check
+                index.refresh()
+            self.assertEqual([self.in_title.pk], list(index.scores('wolves')))
+
+    def test_a_save_doesnt_cover_up_one_made_elsewhere(self):
+        self.addCleanup(setattr, search_index, '_index', None)
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(SEARCH_INDEX_PATH=os.path.join(directory, 'search.idx')):
+            index = search_index.get_index()
+            index.refresh()
+            written = os.path.getmtime(index.path)
+
+            # Another worker renames a story (no signals here), then we save a different one
+            Story.objects.filter(pk=self.in_text.pk).update(title="Zebra", updated_at=timezone.now())
+            self.in_title.title = "Running with the wolves"
+            self.in_title.save()
+            self.assertIsNone(index.stamp)
+            self.assertEqual(written, os.path.getmtime(index.path)) # Not written on every save
+
+            self.assertEqual([self.in_text], list(search.search_stories('zebra')))
+            self.assertEqual(search_index.database_stamp(), index.stamp)
+
+    def test_reports_the_matches_it_left_out(self):
+        with override_settings(SEARCH_INDEX_MAX_RESULTS=1):
+            page = RankedPage(search.search_stories('wolves'))
+            self.assertTrue(Client().get(reverse('story-list'), {'q': 'wolves'}).json()['truncated'])
+        self.assertEqual([self.in_title], page.object_list)
+        self.assertTrue(page.truncated)
+        self.assertFalse(RankedPage(search.search_stories('moon')).truncated)
+
+
+class TestLinks(TestCase):
+    text = ("![A wolf](http://example.com/wolf.jpg \"The wolf\") and [the page](http://example.com/wolf.jpg) "
+            "about [wolves](http://example.com/wolves.html) ![Again](https://i.imgur.com/pig.jpg)")
+
+    def test_images_and_links(self):
+        self.assertEqual(['http://example.com/wolf.jpg', 'https://i.imgur.com/pig.jpg'],
+                         list(links.image_urls(self.text)))
+        self.assertEqual([True, False, False, True], [link.is_image for link in links.links(self.text)])
+        self.assertEqual(['http://example.com/wolf.jpg'], links.external_image_urls(self.text))
+
+    def test_replace_in_one_pass(self):
+        # The new url contains the old one, it must not be replaced again
+        replacements = {'http://example.com/wolf.jpg': 'http://example.com/wolf.jpg.png'}
+        self.assertEqual(
+            "![A wolf](http://example.com/wolf.jpg.png \"The wolf\") and [the page](http://example.com/wolf.jpg) "
+            "about [wolves](http://example.com/wolves.html) ![Again](https://i.imgur.com/pig.jpg)",
+            links.replace_urls(self.text, replacements))
+
+    def test_index_follows_the_text(self):
+        story = mommy.make(Story, text=self.text)
+        self.assertEqual(['http://example.com/wolf.jpg'],
+                         list(StoryImage.objects.filter(story=story).values_list('url', flat=True)))
+
+        story.text = "Nothing to see ![here](http://example.com/here.jpg)"
+        story.save()
+        self.assertEqual(['http://example.com/here.jpg'],
+                         list(story.external_images.values_list('url', flat=True)))
+
+        story.text = "Nothing at all"
+        story.save()
+        self.assertFalse(story.external_images.exists())
+
+
+def png(width=1200, height=600, color='red'):
+    content = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(content, 'PNG')
+    return content.getvalue()
+
+
+class TestImageStore(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        override = override_settings(IMAGE_STORAGE_ROOT=self.root)
+        override.enable()
+        self.addCleanup(override.disable)
+        images.image_storage._wrapped = empty
+        self.addCleanup(setattr, images.image_storage, '_wrapped', empty)
+
+    def stored_files(self):
+        return sorted(name for path, directories, names in os.walk(self.root) for name in names)
+
+    def test_stored_once_with_variants(self):
+        content = png()
+        digest = hashlib.sha256(content).hexdigest()
+        self.assertEqual((digest, 'png'), images.store_image(content))
+        self.assertEqual((digest, 'png'), images.store_image(content))
+        self.assertEqual([digest + '.medium.png', digest + '.png', digest + '.small.png'], self.stored_files())
+
+        with images.open_image(digest, 'png', 'small') as f:
+            self.assertEqual((320, 160), Image.open(f).size)
+        self.assertIsNone(images.store_image(b'This is NOT an image'))
+
+    def test_served_for_good(self):
+        digest, ext = images.store_image(png())
+        url = images.image_url(digest, ext)
+        response = Client().get(url)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('image/png', response['Content-Type'])
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(png(), b''.join(response.streaming_content))
+
+        response = Client().get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(200, Client().get(images.image_url(digest, ext, 'medium')).status_code)
+        self.assertEqual(404, Client().get(images.image_url('0' * 64, ext)).status_code)
+        self.assertEqual(404, Client().get(images.image_url(digest, ext, 'huge')).status_code)
+
+    def test_editor_upload(self):
+        upload = {'markdown-image-upload': SimpleUploadedFile('wolf.png', png(), 'image/png')}
+        self.assertEqual(302, Client().post(reverse('stories:image-upload'), upload).status_code)
+
+        client = Client()
+        client.force_login(mommy.make(Story).author.user)
+        upload['markdown-image-upload'].seek(0)
+        data = client.post(reverse('stories:image-upload'), upload).json()
+        self.assertEqual({'status': 200, 'name': 'wolf.png',
+                          'link': images.image_url(hashlib.sha256(png()).hexdigest(), 'png')}, data)
+
+
+class TestChunked(TestCase):
+
+    def setUp(self):
+        self.stories = [mommy.make(Story, teaser="Teaser %d" % n) for n in range(5)]
+
+    def test_chunks_in_pk_order(self):
+        with self.assertNumQueries(3):
+            found = list(chunked.chunks(Story.objects.all(), fields=('teaser',), size=2))
+        self.assertEqual([2, 2, 1], [len(chunk) for chunk in found])
+        self.assertEqual([story.pk for story in self.stories], [story.pk for chunk in found for story in chunk])
+        self.assertIn('text', found[0][0].get_deferred_fields())
+        self.assertNotIn('teaser', found[0][0].get_deferred_fields())
+
+    def test_update_in_chunks(self):
+        def shout(story):
+            if story.pk == self.stories[0].pk:
+                return False
+            story.teaser = story.teaser.upper()
+
+        # A read and a write per chunk
+        with self.assertNumQueries(3 + 3):
+            self.assertEqual(4, chunked.update_in_chunks(Story.objects.all(), ['teaser'], shout, size=2))
+        self.assertEqual(["Teaser 0", "TEASER 1", "TEASER 2", "TEASER 3", "TEASER 4"],
+                         list(Story.objects.order_by('pk').values_list('teaser', flat=True)))
+
+
+class TestTeasers(TestCase):
+
+    def test_truncate_words(self):
+        self.assertEqual("Short enough", utils.truncate_words("Short enough", 12))
+        self.assertEqual("The wolf\u2026", utils.truncate_words("The wolf huffed", 12))
+        self.assertEqual("The wolf\u2026", utils.truncate_words("The wolf, huffed", 11))
+        self.assertEqual("Wolfwolfwo\u2026", utils.truncate_words("Wolfwolfwolfwolf", 11))
+
+    def test_made_from_the_text(self):
+        story = mommy.make(Story, text="# The wolf\n\nHe **huffed** &amp; [puffed](http://example.com)" + " and puffed" * 20)
+        self.assertTrue(story.teaser.startswith("The wolf He huffed & puffed and puffed"))
+        self.assertLessEqual(len(story.teaser), 140)
+        self.assertTrue(story.teaser.endswith("puffed\u2026"))
+
+        story.text = "The pig"
+        story.save()
+        self.assertEqual("The pig", Story.objects.get(pk=story.pk).teaser)
+
+    def test_written_by_the_author(self):
+        story = mommy.make(Story, text="The pig", published_at=None)
+        form = PublishForm({'teaser': "Read about the pig", 'author': story.author.pk,
+                            'license': mommy.make('licenses.License').pk}, instance=story, user=story.author.user)
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+
+        story.refresh_from_db()
+        story.text = "The pig and the wolf"
+        story.save()
+        self.assertEqual("Read about the pig", Story.objects.get(pk=story.pk).teaser)
+
+
+class TestStoryIndexes(TestCase):
+    """ The StoryManager queries should be answered from the partial indexes on Story """
+
+    def setUp(self):
+        self.story = mommy.make(Story, published_at=timezone.now())
+        mommy.make(Story, published_at=timezone.now(), inspired_by=self.story,
+                   preceded_by=self.story, _quantity=5)
+        # A long serial by the same author
+        chapter = self.story
+        for _ in range(20):
+            chapter = mommy.make(Story, published_at=timezone.now(), author=self.story.author,
+                                 preceded_by=chapter)
+        mommy.make(Story, published_at=None, _quantity=5)
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def assertUsesIndex(self, index, queryset):
+        if connection.vendor == 'postgresql':
+            # The test tables are tiny, make the planner show us what it would do with a real one
+            with connection.cursor() as cursor:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+        plan = queryset.explain()
+        self.assertIn(index, plan)
+
+    def test_recent(self):
+        self.assertUsesIndex('story_published_idx', Story.objects.recent())
+
+    def test_by_author(self):
+        self.assertUsesIndex('story_author_published_idx',
+                             Story.objects.by_author(author=self.story.author))
+
+    def test_inspired(self):
+        self.assertUsesIndex('story_inspired_published_idx',
+                             Story.objects.inspired(inspiration=self.story))
+
+    def test_next_chapter(self):
+        self.assertUsesIndex('story_preceded_author_idx',
+                             Story.objects.next_chapter(story=self.story))
+
+
+class TestStoryCounters(TestCase):
+
+    def setUp(self):
+        self.story = mommy.make(Story, published_at=timezone.now())
+
+    def assertCounts(self, upvotes, downvotes, flags):
+        story = Story.objects.get(pk=self.story.id)
+        self.assertEqual((upvotes, downvotes, flags),
+                         (story.upvote_count, story.downvote_count, story.flag_count))
+
+    def test_counts_follow_rows(self):
+        upvotes = mommy.make(UpVotes, entry=self.story, _quantity=3)
+        mommy.make(DownVotes, entry=self.story, _quantity=2)
+        flag = mommy.make(Flag, entry=self.story, reason=Flag.SPAM)
+        mommy.make(UpVotes) # Some other story
+        self.assertCounts(3, 2, 1)
+
+        upvotes[0].delete()
+        flag.delete()
+        self.assertCounts(2, 2, 0)
+
+    def test_save_does_not_overwrite_counts(self):
+        stale = Story.objects.get(pk=self.story.id)
+        mommy.make(UpVotes, entry=self.story, _quantity=2)
+
+        stale.title = "Edited"
+        stale.save()
+        self.assertCounts(2, 0, 0)
+        self.assertEqual("Edited", Story.objects.get(pk=self.story.id).title)
+
+    def test_new_story_with_its_own_pk(self):
+        # Fixtures and restores create stories with the pk already set
+        story = Story(pk=self.story.id + 100, author=self.story.author, title="Restored", text="Text")
+        story.save()
+        self.assertEqual("Restored", Story.objects.get(pk=self.story.id + 100).title)
+
+
+class TestVoteBuffer(TestCase):
+
+    def setUp(self):
+        self.story = mommy.make(Story, published_at=timezone.now())
+        self.users = mommy.make(settings.AUTH_USER_MODEL, _quantity=3)
+
+    def test_coalesces_and_flushes_at_size(self):
+        buffer = VoteBuffer(max_size=3, max_age=60)
+        self.assertTrue(buffer.add(UpVotes, self.users[0].id, self.story.id))
+        self.assertFalse(buffer.add(UpVotes, self.users[0].id, self.story.id)) # Double click
+        self.assertTrue(buffer.add(DownVotes, self.users[0].id, self.story.id))
+        self.assertEqual(0, UpVotes.objects.count())
+
+        # Per kind of row: look for existing, insert (in a savepoint), count, trending anchor and
+        #   score, plus creating the story's score row the first time (in a savepoint)
+        with self.assertNumQueries(17):
+            self.assertTrue(buffer.add(UpVotes, self.users[1].id, self.story.id))
+
+        self.assertEqual(0, len(buffer))
+        self.assertEqual(2, UpVotes.objects.filter(entry=self.story).count())
+        self.assertEqual(1, DownVotes.objects.filter(entry=self.story).count())
+        self.story.refresh_from_db()
+        self.assertEqual((2, 1), (self.story.upvote_count, self.story.downvote_count))
+
+    def test_flushes_when_old(self):
+        buffer = VoteBuffer(max_size=100, max_age=0)
+        buffer.add(Flag, self.users[0].id, self.story.id, reason=Flag.SPAM)
+        self.assertEqual(Flag.SPAM, Flag.objects.get(entry=self.story).reason)
+
+    def test_skips_votes_already_in_the_database(self):
+        mommy.make(UpVotes, user=self.users[0], entry=self.story)
+        buffer = VoteBuffer()
+        for user in self.users:
+            buffer.add(UpVotes, user.id, self.story.id)
+
+        self.assertEqual(2, buffer.flush())
+        self.assertEqual(3, UpVotes.objects.filter(entry=self.story).count())
+        self.story.refresh_from_db()
+        self.assertEqual(3, self.story.upvote_count)
+
+    def test_leaves_out_votes_written_by_someone_else_meanwhile(self):
+        rows = [UpVotes(user_id=user.id, entry_id=self.story.id) for user in self.users]
+        mommy.make(UpVotes, user=self.users[1], entry=self.story) # After the flush looked
+
+        written = insert_new(UpVotes, rows)
+        self.assertEqual([self.users[0].id, self.users[2].id], [row.user_id for row in written])
+        self.assertEqual(3, UpVotes.objects.filter(entry=self.story).count())
+
+
+class TestTrending(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.old, self.new, self.disliked = mommy.make(Story, published_at=now, _quantity=3)
+
+    def vote(self, model, story, hours_ago):
+        vote = mommy.make(model, entry=story)
+        # voted_at is auto_now_add, backdate it and score it the way the signal did
+        ranking.record_votes(model, [vote], removed=True)
+        model.objects.filter(pk=vote.pk).update(voted_at=timezone.now() - timedelta(hours=hours_ago))
+        vote.refresh_from_db()
+        ranking.record_votes(model, [vote])
+        return vote
+
+    def test_newer_votes_count_for_more(self):
+        for _ in range(3):
+            self.vote(UpVotes, self.old, 72)
+        for _ in range(2):
+            self.vote(UpVotes, self.new, 1)
+        self.vote(UpVotes, self.disliked, 1)
+        self.vote(DownVotes, self.disliked, 1)
+
+        self.assertEqual([self.new, self.old], list(Story.objects.trending()))
+
+    def test_refresh_matches_the_incremental_scores(self):
+        self.vote(UpVotes, self.old, 30)
+        self.vote(UpVotes, self.new, 2)
+        now = timezone.now()
+        before = {score.story_id: score.score / ranking.vote_weight(now, score.anchored_at)
+                  for score in TrendingScore.objects.all()}
+
+        self.assertEqual(2, ranking.refresh(now))
+        after = {score.story_id: score.score / ranking.vote_weight(now, score.anchored_at)
+                 for score in TrendingScore.objects.all()}
+        self.assertEqual(before.keys(), after.keys())
+        for story_id, score in before.items():
+            self.assertAlmostEqual(score, after[story_id], places=3)
+
+    def test_rescores_everything_once_the_anchor_is_a_window_old(self):
+        self.vote(UpVotes, self.old, 2)
+        TrendingScore.objects.update(anchored_at=timezone.now() - timedelta(days=3000))
+
+        mommy.make(UpVotes, entry=self.new) # 2 ** 3000 days would overflow
+        scores = {score.story_id: score for score in TrendingScore.objects.all()}
+        self.assertGreater(scores[self.old.id].anchored_at, timezone.now() - timedelta(minutes=1))
+        self.assertAlmostEqual(1, scores[self.new.id].score, places=2)
+        self.assertEqual([self.new, self.old], list(Story.objects.trending()))
+
+    def test_deleted_votes_are_taken_back(self):
+        vote = mommy.make(UpVotes, entry=self.new)
+        self.assertEqual([self.new], list(Story.objects.trending()))
+        vote.delete()
+        self.assertEqual([], list(Story.objects.trending()))
+
+    def test_trending_is_one_query(self):
+        mommy.make(UpVotes, entry=self.new)
+        with self.assertNumQueries(1):
+            [story.author for story in Story.objects.trending()]
+
+
+class TestMarkdownCache(TestCase):
+
+    def setUp(self):
+        utils.local_cache.clear()
+
+    def test_lru_evicts_least_recently_used(self):
+        cache = utils.LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(1, cache.get('a')) # 'a' is now the most recently used
+        cache.set('c', 3)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual({'a': 1, 'c': 3}, cache.get_many(['a', 'b', 'c']))
+
+    def test_html_renders_once(self):
+        with mock.patch('stories.utils.markdownify', wraps=utils.markdownify) as render:
+            self.assertEqual("<p><strong>Cached</strong></p>", Story(text="**Cached**").html())
+            self.assertEqual("<p><strong>Cached</strong></p>", Story(text="**Cached**").html())
+            self.assertEqual(1, render.call_count)
+
+    def test_key_includes_text_and_config(self):
+        key = utils.markdown_cache_key("Some text")
+        self.assertIn(utils.MARKDOWN_CONFIG_VERSION, key)
+        self.assertNotEqual(key, utils.markdown_cache_key("Other text"))
+
+        with mock.patch('stories.utils.MARKDOWN_CONFIG_VERSION', 'changed'):
+            self.assertNotEqual(key, utils.markdown_cache_key("Some text"))
+
+    @override_settings(MARKDOWN_CACHE='default')
+    def test_uses_django_cache_alias(self):
+        from django.core.cache import caches
+
+        story = mommy.make(Story, text="_In the django cache_")
+        story.html()
+        self.assertEqual("<p><em>In the django cache</em></p>",
+                         caches['default'].get(utils.markdown_cache_key(story.text)))
+        self.assertEqual(0, len(utils.local_cache))
+
+
+class TestRenderMany(TestCase):
+
+    def setUp(self):
+        self.stories = [mommy.make(Story, text="**Story %d**" % n) for n in range(4)]
+        utils.local_cache.clear()
+
+    def test_renders_only_the_misses(self):
+        utils.cached_markdownify(self.stories[0].text) # Now in the cache
+
+        with mock.patch('stories.utils.markdownify', wraps=utils.markdownify) as render:
+            rendered = utils.render_many(self.stories)
+            self.assertEqual(3, render.call_count)
+
+        self.assertEqual({s.id: "<p><strong>Story %d</strong></p>" % n
+                          for n, s in enumerate(self.stories)}, rendered)
+
+        with mock.patch('stories.utils.markdownify', wraps=utils.markdownify) as render:
+            self.assertEqual(rendered, utils.render_many(self.stories))
+            self.assertEqual(0, render.call_count)
+
+    def test_one_cache_lookup(self):
+        with mock.patch.object(utils.local_cache, 'get_many',
+                               wraps=utils.local_cache.get_many) as get_many:
+            utils.render_many(self.stories)
+            self.assertEqual(1, get_many.call_count)
+
+    def test_workers(self):
+        rendered = utils.render_many(self.stories, workers=3)
+        self.assertEqual(["<p><strong>Story %d</strong></p>" % n for n in range(4)],
+                         [rendered[s.id] for s in self.stories])
+
+    def test_render_all_primes_html(self):
+        stories = Story.render_all(Story.objects.filter(id__in=[s.id for s in self.stories]))
+
+        with mock.patch('stories.models.cached_markdownify') as render:
+            self.assertEqual("<p><strong>Story 0</strong></p>", stories[0].html())
+            self.assertFalse(render.called)
+
+        # Changing the text makes html() render it again
+        stories[0].text = "Edited"
+        self.assertEqual("<p>Edited</p>", stories[0].html())
+
+
+class TestMarkdownEnginePool(TestCase):
+
+    def test_threads_render_in_parallel(self):
+        pool = utils.MarkdownEnginePool(size=3)
+        results = {}
+
+        def render(n):
+            for _ in range(20):
+                results[n] = pool.render("**Story %d**" % n)
+
+        threads = [threading.Thread(target=render, args=(n,)) for n in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual({n: "<p><strong>Story %d</strong></p>" % n for n in range(6)}, results)
+        stats = pool.stats()
+        self.assertEqual(120, stats['checkouts'])
+        self.assertLessEqual(stats['builds'], 3)
+        self.assertEqual(stats['built'], stats['idle'])
+
+    def test_waits_when_exhausted(self):
+        pool = utils.MarkdownEnginePool(size=1)
+        engine = pool.checkout()
+        results = []
+
+        thread = threading.Thread(target=lambda: results.append(pool.render("_waited_")))
+        thread.start()
+        while not pool.stats()['waits']:
+            time.sleep(0.001)
+        self.assertEqual([], results) # Still waiting on the only engine
+
+        pool.checkin(engine)
+        thread.join()
+        self.assertEqual(["<p><em>waited</em></p>"], results)
+        self.assertEqual(1, pool.stats()['builds'])
+
+    def test_warm(self):
+        pool = utils.MarkdownEnginePool(size=2)
+        self.assertEqual(2, pool.warm())
+
+        stats = pool.stats()
+        self.assertEqual(2, stats['builds'])
+        self.assertEqual(2, stats['idle'])
+        self.assertGreater(stats['build_time'], 0)
+
+        pool.render("No more builds")
+        self.assertEqual(2, pool.stats()['builds'])
+
+
 class TestStoryForm(TestCase):
 
     def assertFieldsConfigured(self, form):
@@ -204,6 +973,132 @@ class TestStoryForm(TestCase):
 
 
 
+class TestFragmentCache(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.story = mommy.make(Story, published_at=timezone.now(), title="Original")
+
+    def recent(self):
+        return Client().get(reverse('stories:recent'))
+
+    def test_cards_are_reused_until_the_story_is_saved(self):
+        self.assertContains(self.recent(), "Original")
+
+        # Behind the model's back, so updated_at doesn't move and the card is reused
+        Story.objects.filter(pk=self.story.id).update(title="Sneaky")
+        self.assertContains(self.recent(), "Original")
+
+        self.story.title = "Edited"
+        self.story.save()
+        self.assertContains(self.recent(), "Edited")
+
+    def test_author_rename_changes_the_card(self):
+        self.recent()
+        author = self.story.author
+        author.name = "Renamed"
+        author.save()
+        self.assertContains(self.recent(), "Renamed")
+
+    def test_links_are_reused(self):
+        sequel = mommy.make(Story, published_at=timezone.now(), preceded_by=self.story,
+                            author=self.story.author)
+        url = reverse('stories:read', kwargs={'pk': sequel.id})
+        self.assertContains(Client().get(url), "Original")
+
+        Story.objects.filter(pk=self.story.id).update(title="Sneaky")
+        self.assertContains(Client().get(url), "Original")
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=600)
+class TestPageCache(TestCase):
+
+    def setUp(self):
+        # Files, like production, a cache in each process would be left out of the purges
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        shared = override_settings(PAGE_CACHE='pages', CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'pages': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                      'LOCATION': directory.name},
+        })
+        shared.enable()
+        self.addCleanup(shared.disable)
+        self.story = mommy.make(Story, published_at=timezone.now(), title="First")
+        self.sequel = mommy.make(Story, published_at=timezone.now(), author=self.story.author,
+                                 preceded_by=self.story, title="Second")
+        self.other = mommy.make(Story, published_at=timezone.now(), title="Unrelated")
+
+    def read(self, story):
+        return Client().get(reverse('stories:read', kwargs={'pk': story.id}))
+
+    def test_anonymous_pages_are_cached(self):
+        first = self.read(self.story)
+        with self.assertNumQueries(0):
+            again = self.read(self.story)
+        self.assertEqual(first.content, again.content)
+        self.assertEqual(first['ETag'], again['ETag'])
+
+        response = Client().get(reverse('stories:read', kwargs={'pk': self.story.id}),
+                                HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(304, response.status_code)
+
+    def test_saves_purge_the_pages_showing_them(self):
+        self.read(self.story)
+        self.read(self.other)
+
+        self.sequel.title = "Second, edited"
+        self.sequel.save()
+
+        # The story it follows links to it, the unrelated story is still cached
+        with self.assertNumQueries(0):
+            self.read(self.other)
+        self.assertContains(self.read(self.story), "Second, edited")
+
+    def test_moving_a_sequel_purges_the_story_it_left(self):
+        self.assertContains(self.read(self.story), "Second")
+        sequel = Story.objects.get(pk=self.sequel.id)
+        sequel.preceded_by = self.other
+        sequel.save()
+        self.assertNotContains(self.read(self.story), "Second")
+
+    def test_pages_purged_while_rendering_are_not_stored(self):
+        get_object = Read.get_object
+
+        def saved_meanwhile(view, *args, **kwargs):
+            story = get_object(view, *args, **kwargs)
+            Story.objects.get(pk=self.story.id).save()
+            return story
+
+        with mock.patch.object(Read, 'get_object', saved_meanwhile):
+            self.read(self.story)
+        request = RequestFactory().get(reverse('stories:read', kwargs={'pk': self.story.id}))
+        self.assertIsNone(page_cache.page_cache().get(page_cache.page_key(request)))
+
+    def test_not_cached_in_a_cache_of_each_process(self):
+        with override_settings(PAGE_CACHE='default'):
+            self.assertFalse(page_cache.is_shared())
+            self.read(self.story)
+            request = RequestFactory().get(reverse('stories:read', kwargs={'pk': self.story.id}))
+            self.assertIsNone(page_cache.page_cache().get(page_cache.page_key(request)))
+
+    def test_author_rename_purges_their_stories(self):
+        self.read(self.story)
+        author = self.story.author
+        author.name = "Renamed"
+        author.save()
+        self.assertContains(self.read(self.story), "Renamed")
+
+    def test_owners_are_not_served_the_cache(self):
+        self.read(self.story)
+        client = Client()
+        client.force_login(self.story.author.user)
+        response = client.get(reverse('stories:read', kwargs={'pk': self.story.id}))
+        self.assertContains(response, reverse('stories:edit', kwargs={'pk': self.story.id}))
+        self.assertNotContains(self.read(self.story),
+                               reverse('stories:edit', kwargs={'pk': self.story.id}))
+
+
 class TestStoryViews(TestCase):
 
     def setUp(self):
@@ -230,6 +1125,58 @@ class TestStoryViews(TestCase):
         expected = [self.story2, self.story1]
         self.assertListEqual(expected, list(stories))
 
+    def test_recent_query_count_is_constant(self):
+        """ The landing page is one query no matter how many stories (or authors) there are """
+        client = Client()
+        for count in (3, 30):
+            mommy.make(Story, _quantity=count, published_at=timezone.now())
+            with self.assertNumQueries(1):
+                response = client.get(reverse('stories:recent'))
+            self.assertEqual(Recent.paginate_by if count > 3 else 5,
+                             len(response.context[-1]['object_list']))
+
+    def test_recent_keyset_pages(self):
+        """ Walk every page following the next links, stories published at the same moment
+              are split across pages by id without being skipped or repeated """
+        same_moment = timezone.now() - timedelta(days=1)
+        stories = mommy.make(Story, published_at=same_moment, _quantity=Recent.paginate_by + 5)
+        expected = ([self.story2, self.story1]
+                    + sorted(stories, key=lambda story: story.id, reverse=True))
+
+        client = Client()
+        seen = []
+        url = reverse('stories:recent')
+        while url:
+            with self.assertNumQueries(1):
+                response = client.get(url)
+            page = response.context[-1]['page_obj']
+            seen.extend(response.context[-1]['object_list'])
+            url = (reverse('stories:recent') + page.next_query) if page.has_next else None
+
+        self.assertEqual(expected, seen)
+
+    def test_recent_by_length(self):
+        long_stories = mommy.make(Story, text="Word " * 4000, published_at=timezone.now(),
+                                  _quantity=Recent.paginate_by + 1)
+        client = Client()
+        response = client.get(reverse('stories:recent'), data={'max_minutes': 5})
+        self.assertEqual([self.story2, self.story1], list(response.context[-1]['object_list']))
+
+        response = client.get(reverse('stories:recent'), data={'min_minutes': 15})
+        page = response.context[-1]['page_obj']
+        self.assertIn('min_minutes=15', page.next_query)
+        response = client.get(reverse('stories:recent') + page.next_query)
+        self.assertEqual([min(long_stories, key=lambda story: story.id)],
+                         list(response.context[-1]['object_list']))
+
+        data = client.get(reverse('story-list'), {'min_minutes': 15}).json()
+        self.assertEqual(Recent.paginate_by, len(data['results']))
+        self.assertEqual(20, data['results'][0]['read_minutes'])
+
+    def test_recent_bad_cursor(self):
+        response = Client().get(reverse('stories:recent'), data={'after': 'garbage'})
+        self.assertEqual(404, response.status_code)
+
     def test_list_by_author(self):
         client = Client()
         response = client.get(reverse('stories:list-by-author', args=(self.author.id,)))
@@ -476,6 +1423,37 @@ class TestStoryViews(TestCase):
         self.assertContains(response, read_story1_url, count=1)
 
 
+    def test_read_query_count_is_constant(self):
+        """ Reading a story with chapters on both sides and lots of inspired stories takes the
+              same small number of queries as reading a lonely story """
+        chapter2 = mommy.make(Story, author=self.author, preceded_by=self.story1,
+                              inspired_by=self.story2, published_at=timezone.now())
+        chapter3 = mommy.make(Story, author=self.author, preceded_by=chapter2,
+                              published_at=timezone.now())
+        inspired = mommy.make(Story, inspired_by=chapter2, published_at=timezone.now(),
+                              _quantity=15)
+
+        client = Client()
+        with self.assertNumQueries(2):
+            response = client.get(reverse("stories:read", args=(chapter2.id,)))
+
+        self.assertEqual(chapter3, response.context['object'].next_chapter())
+        self.assertEqual(set(inspired), set(response.context['inspired']))
+        self.assertContains(response, reverse("stories:read", args=(chapter3.id,)), count=1)
+        self.assertContains(response, reverse("stories:read", args=(self.story1.id,)), count=1)
+        for story in inspired:
+            self.assertContains(response, reverse("stories:read", args=(story.id,)))
+
+        # The owner sees their buttons, and the query count stays fixed (plus the
+        #   session, user and profile lookups)
+        client.login(username=self.author.user.username, password='PASSWORD')
+        client.get(reverse("stories:read", args=(chapter3.id,))) # userena creates the profile
+        with self.assertNumQueries(5):
+            response = client.get(reverse("stories:read", args=(chapter3.id,)))
+        self.assertContains(response, reverse("stories:edit", args=(chapter3.id,)))
+        self.assertContains(response, "Add another chapter?")
+
+
 class TestStorySerializer(TestCase):
     def test_list_serialization(self):
         """ data creation got a little crazy on this one to catch a bug.  next_chapter was not correct because
@@ -504,7 +1482,9 @@ class TestStorySerializer(TestCase):
                 "published_at": DrfDtf().to_representation(story1.published_at),
                 "preceded_by": None,
                 "next_chapter": "http://testserver/api/stories/%d/" % story2.id,
-                "can_edit": True
+                "can_edit": True,
+                "word_count": 5,
+                "read_minutes": 1
             },
             {
                 "url": "http://testserver/api/stories/%d/" % story2.id,
@@ -516,7 +1496,9 @@ class TestStorySerializer(TestCase):
                 "published_at": DrfDtf().to_representation(story2.published_at),
                 "preceded_by": "http://testserver/api/stories/%d/" % story1.id,
                 "next_chapter": None,
-                "can_edit": True
+                "can_edit": True,
+                "word_count": 5,
+                "read_minutes": 1
             },
             {
                 "url": "http://testserver/api/stories/%d/" % story3.id,
@@ -528,7 +1510,9 @@ class TestStorySerializer(TestCase):
                 "published_at": None,
                 "preceded_by": None,
                 "next_chapter": None,
-                "can_edit": False
+                "can_edit": False,
+                "word_count": 5,
+                "read_minutes": 1
             }
         ]
         self.assertDictEqual(expected[0], ser.data[0])
@@ -536,4 +1520,20 @@ class TestStorySerializer(TestCase):
         self.assertDictEqual(expected[2], ser.data[2])
         self.assertEqual(expected, ser.data)
 
+    def test_list_serialization_renders_as_a_batch(self):
+        stories = [mommy.make(Story, published_at=timezone.now()) for _ in range(3)]
+
+        factory = APIRequestFactory()
+        request = factory.get('api/stories/', format='json')
+        request.user = stories[0].author.user
+
+        with mock.patch('stories.models.render_many', wraps=utils.render_many) as render_many, \
+             mock.patch('stories.models.cached_markdownify') as one_at_a_time:
+            data = StorySerializer(stories, many=True, context={'request': request}).data
+
+            self.assertEqual(1, render_many.call_count)
+            self.assertFalse(one_at_a_time.called)
+        self.assertEqual(["<p>This is a <strong>Martor</strong> field.</p>"] * 3,
+                         [story['html'] for story in data])
+
         
\ No newline at end of file
@@ -19,9 +19,16 @@ from . import views
 app_name = 'stories'
 urlpatterns = [
     path('', views.Recent.as_view(), name='recent'),
+    path('trending/', views.Trending.as_view(), name='trending'),
+    path('search/', views.Search.as_view(), name='search'),
     path('list-by-author/<int:pk>/', views.ByAuthor.as_view(), name='list-by-author'),
     path('edit/<int:pk>/', views.Edit.as_view(), name='edit'),
     path('publish/<int:pk>/', views.Publish.as_view(), name='publish'),
     path('create/', views.Create.as_view(), name='create'),
     path('read/<int:pk>/', views.Read.as_view(), name='read'),
+    path('series/<int:pk>/', views.Series.as_view(), name='series'),
+    path('inspiration/<int:pk>/', views.InspirationTree.as_view(), name='inspiration-tree'),
+    path('images/upload/', views.ImageUpload.as_view(), name='image-upload'),
+    path('images/<slug:digest>.<slug:ext>', views.Image.as_view(), name='image'),
+    path('images/<slug:variant>/<slug:digest>.<slug:ext>', views.Image.as_view(), name='image-variant'),
 ]
@@ -1,4 +1,17 @@
+import hashlib
+import json
+import queue
+import time
+from html import unescape
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+
+import pkg_resources
 from django.conf import settings
+from django.core.cache import caches
+from django.utils.html import strip_tags
 from markdown import Markdown, markdown
 
 from martor.settings import (
@@ -7,18 +20,269 @@ from martor.settings import (
     MARTOR_MARKDOWN_EXTENSION_CONFIGS
 )
 
-engine = None
-def markdownify(text):
-    """ This is a more efficient version of the markdownify.  The one from martor reinitializes all the 
-          extensions with every call, this one does it once per run of the process and iff needed """
-    
-    global engine # Not really global, really only local to this file
-    
-    if not engine:
-        engine = Markdown(safe_mode=MARTOR_MARKDOWN_SAFE_MODE,
-                          extensions=MARTOR_MARKDOWN_EXTENSIONS,
-                          extension_configs=MARTOR_MARKDOWN_EXTENSION_CONFIGS)
-    else:
+
+def package_version(name):
+    try:
+        return pkg_resources.get_distribution(name).version
+    except pkg_resources.DistributionNotFound:
+        return None
+
+
+def config_fingerprint():
+    """ A short digest of everything that changes the html produced for a given piece of markdown:
+          the extensions, their configs and the versions of the packages doing the rendering.
+          It is part of every cache key so changing any of them orphans the old entries instead
+          of serving html rendered with the old setup, and it is stored next to the html saved
+          in the database so the stale rows can be found and rendered again """
+    config = json.dumps({
+        'safe_mode': MARTOR_MARKDOWN_SAFE_MODE,
+        'extensions': MARTOR_MARKDOWN_EXTENSIONS,
+        'extension_configs': MARTOR_MARKDOWN_EXTENSION_CONFIGS,
+        'packages': {name: package_version(name)
+                     for name in ('Markdown', 'pymdown-extensions', 'martor')},
+    }, sort_keys=True, default=str)
+    return hashlib.sha1(config.encode('utf-8')).hexdigest()[:12]
+
+MARKDOWN_CONFIG_VERSION = config_fingerprint()
+
+
+class LRUCache(object):
+    """ A small process local cache used when no django cache has been configured for the
+          rendered markdown.  Only implements the bits of the django cache API we use """
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set_many(self, data, timeout=None):
+        for key, value in data.items():
+            self.set(key, value, timeout)
+        return []
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+local_cache = LRUCache(getattr(settings, 'MARKDOWN_CACHE_MAX_ENTRIES', 1000))
+
+
+def markdown_cache():
+    """ Return the cache the rendered markdown is stored in, MARKDOWN_CACHE names an alias in
+          CACHES, if it is not set we fall back to a per process LRU """
+    alias = getattr(settings, 'MARKDOWN_CACHE', None)
+    if alias:
+        return caches[alias]
+    return local_cache
+
+
+def markdown_cache_key(text):
+    """ Key the html on the markdown source and the markdown configuration that rendered it """
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return 'markdown:%s:%s' % (MARKDOWN_CONFIG_VERSION, digest)
+
+
+def build_engine():
+    """ Build a Markdown instance configured the way martor is configured """
+    return Markdown(safe_mode=MARTOR_MARKDOWN_SAFE_MODE,
+                    extensions=MARTOR_MARKDOWN_EXTENSIONS,
+                    extension_configs=MARTOR_MARKDOWN_EXTENSION_CONFIGS)
+
+
+class MarkdownEnginePool(object):
+    """ A Markdown instance is expensive to build (every extension gets initialized) and holds
+          state while it converts, so it can't be shared between threads.  This keeps a bounded
+          set of them around, each one checked out by a single thread at a time.  When all of
+          them are busy the caller waits for one to be checked back in. """
+
+    def __init__(self, size=4, factory=build_engine):
+        self.size = size
+        self.factory = factory
+        self._idle = queue.LifoQueue()
+        self._lock = Lock()
+        self._built = 0
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'builds': 0,
+            'build_time': 0.0,
+        }
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._stats[name] += amount
+
+    def _build(self):
+        started = time.perf_counter()
+        try:
+            engine = self.factory()
+        except Exception:
+            with self._lock:
+                self._built -= 1
+            raise
+        with self._lock:
+            self._stats['builds'] += 1
+            self._stats['build_time'] += time.perf_counter() - started
+        return engine
+
+    def _reserve(self):
+        """ Claim the right to build another engine, False if the pool is already full """
+        with self._lock:
+            if self._built < self.size:
+                self._built += 1
+                return True
+        return False
+
+    def checkout(self):
+        """ Return an idle engine, build one if we are below size, otherwise wait for one """
+        self._count('checkouts')
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        if self._reserve():
+            return self._build()
+
+        self._count('waits')
+        return self._idle.get()
+
+    def checkin(self, engine):
+        """ Hand an engine back, resetting it so the next user starts clean """
         engine.reset()
-        
-    return engine.convert(text)
+        self._idle.put(engine)
+
+    @contextmanager
+    def engine(self):
+        engine = self.checkout()
+        try:
+            yield engine
+        finally:
+            self.checkin(engine)
+
+    def render(self, text):
+        with self.engine() as engine:
+            return engine.convert(text)
+
+    def warm(self, count=None):
+        """ Build engines up front (at worker startup) so the first requests don't pay for it """
+        count = self.size if count is None else min(count, self.size)
+        while self._built < count and self._reserve():
+            self._idle.put(self._build())
+        return self._built
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['built'] = self._built
+            stats['idle'] = self._idle.qsize()
+            return stats
+
+engine_pool = MarkdownEnginePool(getattr(settings, 'MARKDOWN_ENGINE_POOL_SIZE', 4))
+
+
+def markdownify(text):
+    """ This is a more efficient version of the markdownify.  The one from martor reinitializes all the
+          extensions with every call, this one borrows an already built engine from the pool """
+    return engine_pool.render(text)
+
+
+def cached_markdownify(text):
+    """ markdownify, but look in the markdown cache first and store whatever we had to render """
+    cache = markdown_cache()
+    key = markdown_cache_key(text)
+
+    html = cache.get(key)
+    if html is None:
+        html = markdownify(text)
+        cache.set(key, html, getattr(settings, 'MARKDOWN_CACHE_TIMEOUT', None))
+    return html
+
+
+def render_many(objects, field='text', workers=None):
+    """ Render the markdown in `field` for a batch of objects (a page of stories for example) and
+          return {pk: html}.  All the cache lookups are done with one get_many and only the misses
+          are rendered, spread over `workers` threads when there are enough of them to bother """
+    if workers is None:
+        workers = getattr(settings, 'MARKDOWN_RENDER_WORKERS', 1)
+
+    cache = markdown_cache()
+    keys = {}   # pk -> cache key
+    texts = {}  # cache key -> markdown (identical texts only get rendered once)
+    for obj in objects:
+        text = getattr(obj, field)
+        key = markdown_cache_key(text)
+        keys[obj.pk] = key
+        texts[key] = text
+
+    rendered = cache.get_many(list(texts))
+    missing = [key for key in texts if key not in rendered]
+
+    if missing:
+        sources = [texts[key] for key in missing]
+        if workers > 1 and len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(missing))) as executor:
+                fresh = dict(zip(missing, executor.map(markdownify, sources)))
+        else:
+            fresh = dict(zip(missing, map(markdownify, sources)))
+
+        cache.set_many(fresh, getattr(settings, 'MARKDOWN_CACHE_TIMEOUT', None))
+        rendered.update(fresh)
+
+    return {pk: rendered[key] for pk, key in keys.items()}
+
+
+def text_digest(text):
+    """ Stands for the text (see Story.teaser_digest) """
+    return hashlib.sha1((text or '').encode('utf-8')).hexdigest()
+
+
+def plain_text(html):
+    """ The words of rendered markdown without the markup, on one line """
+    return ' '.join(unescape(strip_tags(html or '')).split())
+
+
+def word_count(html):
+    return len(plain_text(html).split())
+
+
+def truncate_words(text, length):
+    """ Cut the text to at most length characters between two words, with an ellipsis if
+          anything was cut """
+    if len(text) <= length:
+        return text
+    room = length - 1 # for the ellipsis
+    cut = text[:room]
+    if not text[room].isspace() and ' ' in cut:
+        cut = cut[:cut.rindex(' ')] # Don't end half way through a word
+    return cut.rstrip(' ,.;:!?-') + '\u2026'
+
+
+def make_teaser(html, length):
+    return truncate_words(plain_text(html), length)
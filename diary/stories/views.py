@@ -1,41 +1,160 @@
+import json
 import urllib
+from urllib.parse import urlencode
 
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import HttpResponseRedirect
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect
 from django.shortcuts import render
-from django.views.generic import ListView, DetailView
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+from django.views.generic import ListView, DetailView, View
 from django.views.generic.edit import UpdateView, CreateView, ModelFormMixin
 from django.urls import reverse
-from django.utils.translation import gettext as _
+from django.utils.translation import gettext as _, gettext_lazy
 from django.utils import timezone
 
+from .images import content_type, image_url, open_image, store_image
+from .inspiration import tree
 from .models import Story
 from authors.models import Author
 from .forms import StoryForm, PublishForm
+from .page_cache import AnonymousPageCacheMixin
+from .pagination import KeysetPaginationMixin, RankedPage
+from .search import search_authors, search_stories
 
 # Create your views here.
 
-class Recent(ListView):
+# The length filters offered on the recent list: label, minimum and maximum minutes to read
+LENGTH_FILTERS = (
+    (gettext_lazy("Any length"), None, None),
+    (gettext_lazy("Quick reads"), None, 5),
+    (gettext_lazy("Long reads"), 15, None),
+)
+
+
+def length_range(params):
+    """ (minimum, maximum) minutes to read asked for with ?min_minutes= and ?max_minutes=,
+          None for either one that isn't given """
+    def minutes(name):
+        try:
+            return max(int(params[name]), 0)
+        except (KeyError, ValueError):
+            return None
+    return minutes('min_minutes'), minutes('max_minutes')
+
+
+def length_query(minimum, maximum):
+    params = {name: value for name, value in (('min_minutes', minimum), ('max_minutes', maximum))
+              if value is not None}
+    return urlencode(params)
+
+
+class Recent(AnonymousPageCacheMixin, KeysetPaginationMixin, ListView):
     """ List recent entries that have been published """
 
+    def page_cache_tags(self):
+        return ['recent']
+
     def get_queryset(self):
-        return Story.objects.recent()
+        return Story.objects.recent().by_length(*length_range(self.request.GET))
+
+    def get_context_data(self, **kwargs):
+        context = super(Recent, self).get_context_data(**kwargs)
+        current = length_range(self.request.GET)
+        context['length_filters'] = [(label, '?' + length_query(minimum, maximum), (minimum, maximum) == current)
+                                     for label, minimum, maximum in LENGTH_FILTERS]
+        if context.get('page_obj') and context['page_obj'].has_next and any(m is not None for m in current):
+            # Keep the filter on the next page link
+            context['page_obj'].next_query += '&' + length_query(*current)
+        return context
+
 
+class Trending(ListView):
+    """ The published stories getting the most votes lately """
+    template_name = 'stories/story_list.html'
 
-class ByAuthor(ListView):
+    def get_queryset(self):
+        return Story.objects.trending()
+
+    def get_context_data(self, **kwargs):
+        context = super(Trending, self).get_context_data(**kwargs)
+        context['section_title'] = _("Trending")
+        return context
+
+
+class ByAuthor(AnonymousPageCacheMixin, KeysetPaginationMixin, ListView):
     """ List recent entries that have been published """
 
+    def page_cache_tags(self):
+        return ['author:%d' % self.kwargs['pk'], 'author-stories:%d' % self.kwargs['pk']]
+
     def get_template_names(self):
         return ['stories/story-list-by-author.html']
 
     def get_queryset(self):
-        return Story.objects.by_author(author=self.kwargs['pk'])
+        # The cards show part of the html, so we need the text
+        return Story.objects.by_author(author=self.kwargs['pk']).with_text()
 
     def get_context_data(self):
         """ Not sure why the call arguments are empty like this, it should have an
              object_list and **kwargs, but those are throwing errors......"""
         context = super(ByAuthor, self).get_context_data()
         context['author'] = Author.objects.get(pk=self.kwargs['pk'])
+        # The cards show a slice of each story's html, render them as a batch
+        context['object_list'] = Story.render_all(context['object_list'])
+        return context
+
+
+class Search(KeysetPaginationMixin, ListView):
+    """ Full text search of the published stories (best match first) and the authors """
+    template_name = 'stories/search_results.html'
+    page_class = RankedPage
+
+    def get_queryset(self):
+        return search_stories(self.request.GET.get('q', '').strip())
+
+    def get_context_data(self, **kwargs):
+        context = super(Search, self).get_context_data(**kwargs)
+        context['q'] = self.request.GET.get('q', '').strip()
+        if context['q'] and not self.request.GET.get(self.cursor_param):
+            context['authors'] = search_authors(context['q'])
+        if context.get('page_obj') and context['page_obj'].has_next:
+            # Keep the query on the next page link
+            context['page_obj'].next_query += '&' + urlencode({'q': context['q']})
+        return context
+
+
+class Series(AnonymousPageCacheMixin, ListView):
+    """ Every chapter of the series a story belongs to on one page """
+    template_name = 'stories/story_series.html'
+
+    def page_cache_tags(self):
+        return (['story:%d' % story.pk for story in self.object_list]
+                + ['author:%d' % self.object_list[0].author_id])
+
+    def get_queryset(self):
+        chapters = Story.objects.series(self.kwargs['pk'])
+        if not chapters:
+            raise Http404(_("No published story found"))
+        return Story.render_all(chapters)
+
+
+class InspirationTree(AnonymousPageCacheMixin, DetailView):
+    """ The stories that led to this one and the tree of stories it inspired """
+    template_name = 'stories/inspiration_tree.html'
+
+    def page_cache_tags(self):
+        # Anything new in the tree is a save of a story somewhere in it, too many tags to
+        #   list, so this page follows the recent list
+        return ['story:%d' % self.object.pk, 'recent']
+
+    def get_queryset(self):
+        return Story.objects.published().select_related('author')
+
+    def get_context_data(self, **kwargs):
+        context = super(InspirationTree, self).get_context_data(**kwargs)
+        context['ancestors'], context['root'] = tree(self.object)
         return context
 
 
@@ -116,13 +235,24 @@ class Publish(LoginRequiredMixin, CommonStoryFormMixin, UpdateView):
 
 
 
-class Read(DetailView):
+class Read(AnonymousPageCacheMixin, DetailView):
     model = Story
 
+    def page_cache_tags(self):
+        # The page also shows the titles of the stories this one follows or was inspired by
+        tags = ['story:%d' % self.object.pk, 'author:%d' % self.object.author_id]
+        for pk in (self.object.preceded_by_id, self.object.inspired_by_id):
+            if pk:
+                tags.append('story:%d' % pk)
+        return tags
+
+    def get_queryset(self):
+        return Story.objects.for_reading()
+
     def get_object(self, queryset=None):
         obj = super(Read, self).get_object(queryset)
 
-        if not obj.published_at and obj.author.user != self.request.user:
+        if not obj.published_at and obj.author.user_id != self.request.user.id:
             obj.title = _("This entry is private")
             obj.text = _("This entry can only be read by it's author")
 
@@ -134,6 +264,43 @@ class Read(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(Read, self).get_context_data(**kwargs)
-        context['inspired'] = Story.objects.inspired(inspiration=self.object)
+        context['inspired'] = Story.objects.load_neighbourhood(self.object)
 
         return context
+
+
+class Image(View):
+    """ An image from our store (see stories.images).  A name only ever means one image, so it
+          can be cached for as long as browsers and proxies care to """
+
+    def get(self, request, digest, ext, variant=None):
+        etag = quote_etag('%s-%s' % (digest, variant or 'original'))
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            image = open_image(digest, ext, variant)
+            if image is None:
+                raise Http404(_("No such image"))
+            response = FileResponse(image, content_type=content_type(ext))
+        response['ETag'] = etag
+        response['Cache-Control'] = 'public, max-age=%d, immutable' % getattr(settings, 'IMAGE_CACHE_SECONDS', 31536000)
+        return response
+
+
+class ImageUpload(LoginRequiredMixin, View):
+    """ The editor's image uploads, kept in our store.  Answers like martor's imgur uploader, so
+          pointing MARTOR_UPLOAD_URL here is all it takes """
+
+    def post(self, request):
+        image = request.FILES.get('markdown-image-upload')
+        if image is None:
+            return HttpResponse(_('Invalid request!'))
+
+        if image.size > getattr(settings, 'IMAGE_MAX_UPLOAD_SIZE', 10 * 1024 * 1024):
+            data = {'status': 413, 'error': _('The image is too big')}
+        else:
+            stored = store_image(image.read())
+            if stored:
+                data = {'status': 200, 'link': image_url(*stored), 'name': image.name}
+            else:
+                data = {'status': 415, 'error': _('Unsupported Media Type')}
+        return HttpResponse(json.dumps(data), content_type='application/json')
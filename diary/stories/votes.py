@@ -0,0 +1,104 @@
+import time
+from collections import Counter, OrderedDict, defaultdict
+from threading import Lock
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from stories import ranking
+from stories.signals import adjust_counter
+
+
+def insert_new(model, rows):
+    """ Insert the rows and return the ones actually written.  One bulk insert, unless another
+          process wrote one of them since we looked, then each row is tried on its own and the
+          duplicates are left out (so they are never counted) """
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(rows)
+        return rows
+    except IntegrityError:
+        pass
+
+    written = []
+    for row in rows:
+        try:
+            with transaction.atomic():
+                model.objects.bulk_create([row])
+            written.append(row)
+        except IntegrityError:
+            pass
+    return written
+
+
+class VoteBuffer(object):
+    """ Votes and flags come in bursts (one click each), so instead of an INSERT per click they
+          are collected here and written with one bulk_create per kind of row.  Repeat clicks by
+          the same user on the same story are coalesced before they ever reach the database.
+          The buffer is written out when it holds max_size rows, or when the oldest row has
+          waited max_age seconds (checked as votes arrive and at the end of every request). """
+
+    def __init__(self, max_size=100, max_age=5.0):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._lock = Lock()
+        self._pending = OrderedDict()  # (model, user_id, entry_id) -> unsaved row
+        self._oldest = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, model, user_id, entry_id, **fields):
+        """ Queue a row, returns False if the same user already has one queued for the entry """
+        key = (model, user_id, entry_id)
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending[key] = model(user_id=user_id, entry_id=entry_id, **fields)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            due = self._is_due()
+
+        if due:
+            self.flush()
+        return True
+
+    def _is_due(self):
+        return (len(self._pending) >= self.max_size
+                or (self._oldest is not None and time.monotonic() - self._oldest >= self.max_age))
+
+    def flush_if_due(self, **kwargs):
+        """ Flush if the buffer is full or old enough, usable as a signal receiver """
+        with self._lock:
+            due = self._is_due()
+        if due:
+            self.flush()
+
+    def flush(self):
+        """ Write everything queued, skipping rows the database already has, and bump the
+              story counters and trending scores by what was actually written.  Returns the number of rows written """
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+            self._oldest = None
+
+        by_model = defaultdict(list)
+        for (model, user_id, entry_id), row in pending.items():
+            by_model[model].append(row)
+
+        written = 0
+        for model, rows in by_model.items():
+            existing = set(model.objects.filter(entry_id__in={row.entry_id for row in rows},
+                                                user_id__in={row.user_id for row in rows})
+                           .values_list('user_id', 'entry_id'))
+            rows = [row for row in rows if (row.user_id, row.entry_id) not in existing]
+
+            rows = insert_new(model, rows)
+            for entry_id, count in Counter(row.entry_id for row in rows).items():
+                adjust_counter(model, entry_id, count)
+            ranking.record_votes(model, rows)
+            written += len(rows)
+
+        return written
+
+vote_buffer = VoteBuffer(getattr(settings, 'VOTE_BUFFER_SIZE', 100),
+                         getattr(settings, 'VOTE_BUFFER_MAX_AGE', 5.0))